@@ -0,0 +1,249 @@
+#!/usr/bin/env python
+
+# Benchmarks for the river tools on synthetic river networks.
+#
+# The networks are dendritic: every basin is a complete tree in which every node has
+# --branching tributaries, so a branching of 1 gives one long chain. They are written as
+# newline delimited GeoJSON, and kept in the work directory for later runs. Every case
+# times the steps of chain_rivers.py and create_lods.py separately, and the results can be
+# saved as a baseline and compared with one: a step that got slower than the tolerance or
+# orders that changed are reported, and make the benchmark exit with an error.
+#
+# benchmark_baseline.json next to this script holds the reference checksums of the default
+# cases and options, and is compared with unless another --baseline is given. It has no
+# times, those depend on the machine: timings are only compared with a baseline saved on the
+# same machine with --save-baseline. The reference is written with --checksums-only.
+
+import os
+import sys
+import json
+import time
+import array
+import argparse
+import tempfile
+import numpy as np
+
+from geojson_io import readFeatures, FeatureWriter
+from chain_rivers import getEndpoints, buildNodeIds, getStrahlerAndShreve, getStrahlerAndShreveColumnar, setOrders
+from create_lods import lodThresholds, write_lods, featureToPolylines, encodeTile
+import instrument
+
+STEPS = ['parse', 'graph', 'orders', 'orders-python', 'output', 'lods', 'vctr']
+
+# The default cases, as (segments, branching)
+CASES = [(1000, 2), (1000, 1), (100000, 2), (100000, 1), (1000000, 3)]
+
+# The reference results of the default cases
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_baseline.json')
+
+# Steps that took less than this in the baseline are too noisy to compare
+MIN_SECONDS = 0.05
+
+# Nodes are laid out on a grid with this many columns
+GRID = 4096
+SPACING = 0.001
+
+# Read sizes like 10k or 2M
+def parseSize(text):
+    scale = {'k': 1000, 'm': 1000000}.get(text[-1:].lower(), 1)
+    return int(float(text[:-1] if scale > 1 else text) * scale)
+
+def parseCase(text):
+    parts = text.split(':')
+    return parseSize(parts[0]), int(parts[1]) if len(parts) > 1 else 2
+
+def caseName(segments, branching):
+    return ('chain' if branching == 1 else 'tree' + str(branching)) + '-' + str(segments)
+
+# Write a synthetic network of the given number of segments. Node k of a basin drains
+# into node (k - 1) // branching, node 0 is the outlet. Segments get vertices positions,
+# interpolated between their endpoints, and are written in a shuffled order.
+def generateNetwork(path, segments, branching=2, basins=1, vertices=4, seed=42):
+    rnd = np.random.RandomState(seed)
+    perBasin = -(-segments // basins)
+
+    # The upstream node of every segment, numbered within its basin, and its basin
+    local = np.arange(segments) % perBasin + 1
+    basin = np.arange(segments) // perBasin
+    parent = (local - 1) // branching
+
+    upstream = basin * (perBasin + 1) + local
+    downstream = basin * (perBasin + 1) + parent
+    order = rnd.permutation(segments)
+
+    fraction = np.linspace(0, 1, vertices)
+    with open(path, 'wb') as o, FeatureWriter(o, newlineDelimited=True) as w:
+        for start in range(0, segments, 100000):
+            chunk = order[start:start+100000]
+            a = np.stack((upstream[chunk] % GRID, upstream[chunk] // GRID), axis=1) * SPACING
+            b = np.stack((downstream[chunk] % GRID, downstream[chunk] // GRID), axis=1) * SPACING
+            coords = np.round(a[:, None, :] + (b - a)[:, None, :] * fraction[None, :, None], 6)
+
+            for i, c in zip(chunk, coords.tolist()):
+                w.write({'type': 'Feature', 'properties': {'ARCID': int(i), 'UP_CELLS': int(local[i])},
+                         'geometry': {'type': 'LineString', 'coordinates': c}})
+
+def timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return time.perf_counter() - start, result
+
+def readEndpoints(path):
+    endpoints = array.array('d')
+    with open(path, 'rb') as b:
+        for feature in readFeatures(b):
+            ends = getEndpoints(feature)
+            if ends:
+                endpoints.extend(ends[0])
+                endpoints.extend(ends[1])
+    return np.frombuffer(endpoints, dtype=np.float64).reshape(-1, 2, 2)
+
+def writeOutput(path, output, strahler, shreve):
+    with open(path, 'rb') as b, open(output, 'wb') as o, FeatureWriter(o, True) as w:
+        for i, feature in enumerate(readFeatures(b)):
+            w.write(setOrders(feature, strahler[i], shreve[i]))
+
+def splitLods(output, directory, lods):
+    thresholds = lodThresholds(lods)
+    files = [open(os.path.join(directory, 'lod' + str(i) + '.ndjson'), 'wb') for i in range(lods)]
+    try:
+        writers = [FeatureWriter(o, True) for o in files]
+        with open(output, 'rb') as b:
+            counts = write_lods(readFeatures(b), writers, thresholds)
+        for w in writers:
+            w.close()
+    finally:
+        for o in files:
+            o.close()
+    return counts
+
+def encodeOutput(output):
+    polylines = []
+    with open(output, 'rb') as b:
+        for feature in readFeatures(b):
+            polylines.extend(featureToPolylines(feature))
+    return len(encodeTile([], polylines, [], None))
+
+# Run the steps of a case, returns the best time of every step and a checksum of the results
+def runCase(path, steps, repeat, lods, pythonLimit):
+    times = {}
+    def best(step, function, *args):
+        result = None
+        for r in range(repeat):
+            seconds, result = timed(function, *args)
+            times[step] = min(times.get(step, seconds), seconds)
+        return result
+
+    endpoints = best('parse', readEndpoints, path)
+    nodeCount, source, target = best('graph', buildNodeIds, endpoints)
+    strahler, shreve = best('orders', getStrahlerAndShreveColumnar, nodeCount, source, target)
+
+    if 'orders-python' in steps and len(source) <= pythonLimit:
+        first = [tuple(e) for e in endpoints[:, 0].tolist()]
+        last = [tuple(e) for e in endpoints[:, 1].tolist()]
+        pythonStrahler, pythonShreve = best('orders-python', getStrahlerAndShreve, first, last)
+        if not (np.array_equal(pythonStrahler, strahler) and np.array_equal(pythonShreve, shreve)):
+            raise AssertionError('the python and columnar orders differ for ' + path)
+
+    directory = tempfile.mkdtemp()
+    output = os.path.join(directory, 'out.ndjson')
+    try:
+        if 'output' in steps or 'lods' in steps or 'vctr' in steps:
+            best('output', writeOutput, path, output, strahler, shreve)
+        if 'lods' in steps:
+            best('lods', splitLods, output, directory, lods)
+        if 'vctr' in steps:
+            best('vctr', encodeOutput, output)
+    finally:
+        for name in os.listdir(directory):
+            os.remove(os.path.join(directory, name))
+        os.rmdir(directory)
+
+    checksum = {'segments': len(source), 'nodes': int(nodeCount), 'maxStrahler': int(strahler.max()),
+                'maxShreve': int(shreve.max()), 'sumShreve': int(shreve.astype(np.int64).sum())}
+    return dict((step, seconds) for step, seconds in times.items() if step in steps), checksum
+
+# Compare the results with a baseline, returns the list of regressions
+def compare(name, times, checksum, baseline, tolerance):
+    regressions = []
+    if name not in baseline:
+        return regressions
+
+    if baseline[name]['checksum'] != checksum:
+        regressions.append(name + ': results differ from the baseline, ' + json.dumps(checksum) +
+                           ' instead of ' + json.dumps(baseline[name]['checksum']))
+
+    for step, seconds in sorted(times.items()):
+        before = baseline[name].get('times', {}).get(step)
+        if before and before >= MIN_SECONDS and seconds > before * tolerance:
+            regressions.append('{0} {1}: {2:.3f} s, was {3:.3f} s ({4:+.0%})'.format(name, step, seconds, before, seconds / before - 1))
+
+    return regressions
+
+def main(args):
+    if not os.path.isdir(args.work_dir):
+        os.makedirs(args.work_dir)
+
+    # The results can only be compared with those of networks generated the same way
+    options = {'basins': args.basins, 'vertices': args.vertices, 'lods': args.lods}
+    baseline = {}
+    if args.baseline and os.path.isfile(args.baseline):
+        with open(args.baseline) as f:
+            saved = json.load(f)
+        if saved.get('options', options) == options:
+            baseline = saved['cases']
+        else:
+            print ('not comparing with ' + args.baseline + ', it was saved with ' + json.dumps(saved['options'], sort_keys=True))
+    elif args.baseline:
+        print ('no baseline at ' + args.baseline)
+
+    steps = [s for s in STEPS if s not in args.skip]
+    results = {}
+    regressions = []
+
+    for segments, branching in args.cases or CASES:
+        name = caseName(segments, branching)
+        path = os.path.join(args.work_dir, '{0}-b{1}-v{2}.ndjson'.format(name, args.basins, args.vertices))
+        if not os.path.isfile(path):
+            if (args.verbose):
+                print ('generating ' + path)
+            generateNetwork(path, segments, branching, args.basins, args.vertices)
+
+        times, checksum = runCase(path, steps, args.repeat, args.lods, args.python_limit)
+        results[name] = {'checksum': checksum} if args.checksums_only else {'times': times, 'checksum': checksum}
+        regressions.extend(compare(name, times, checksum, baseline, args.tolerance))
+
+        print (name + ': ' + ', '.join('{0} {1:.3f} s ({2:.0f}/s)'.format(step, times[step], segments / max(times[step], 1e-9))
+                                       for step in steps if step in times))
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as o:
+            saved = {'options': options, 'cases': results}
+            if not args.checksums_only:
+                saved['peakRss'] = instrument.peakRss()
+            json.dump(saved, o, indent=2, sort_keys=True)
+
+    for regression in regressions:
+        print ('REGRESSION ' + regression)
+    return 1 if regressions else 0
+
+if __name__ == "__main__":
+    # parse arguments
+    parser = argparse.ArgumentParser(description='Benchmark chain_rivers.py and create_lods.py on synthetic river networks.')
+    parser.add_argument('-v','--verbose', help="increase output verbosity", action='store_true')
+    parser.add_argument('-c','--case', dest='cases', type=parseCase, action='append', help='a case as SEGMENTS[:BRANCHING], e.g. 10M:2 or 100k:1 for a chain, can be repeated')
+    parser.add_argument('--basins', type=int, default=1, help='the number of separate basins in every network')
+    parser.add_argument('--vertices', type=int, default=4, help='the number of vertices per segment')
+    parser.add_argument('--skip', choices=STEPS, action='append', default=[], help='leave out a step, can be repeated')
+    parser.add_argument('--python-limit', type=parseSize, default=parseSize('1M'), help='only run the python order engine up to this number of segments')
+    parser.add_argument('-l','--lods', type=int, default=11, help='the number of LODs to split into')
+    parser.add_argument('-r','--repeat', type=int, default=1, help='the number of runs to take the best time of')
+    parser.add_argument('-w','--work-dir', default=os.path.join(tempfile.gettempdir(), 'river-benchmarks'), help='the directory the generated networks are kept in')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE, help='a JSON file of earlier results to compare with, by default the reference checksums in benchmark_baseline.json. The times are compared when the baseline has them.')
+    parser.add_argument('--no-baseline', dest='baseline', action='store_const', const=None, help="don't compare with a baseline")
+    parser.add_argument('--save-baseline', help='write the results to a JSON file, for later comparisons')
+    parser.add_argument('--checksums-only', help="save only the checksums of the results in the baseline, not the times of this machine", action='store_true')
+    parser.add_argument('--tolerance', type=float, default=1.25, help='the factor a step may be slower than its baseline')
+    args = parser.parse_args()
+
+    sys.exit(main(args))
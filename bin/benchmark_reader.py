@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+
+# Compare the throughput of the streaming GeoJSON reader in geojson_io.py with the
+# regex + eval parsing that chain_rivers.py and create_lods.py used before.
+
+import os
+import re
+import json
+import time
+import random
+import argparse
+import tempfile
+
+import geojson_io
+
+try:
+    import regex
+except ImportError:
+    regex = re
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Write a FeatureCollection with one river segment per line, the layout the tools were written for,
+# or minified with the whole collection on a single line
+def writeSample(path, count, vertices, minified=False):
+    rnd = random.Random(42)
+    separator = ',' if minified else ',\n'
+    with open(path, 'w') as o:
+        o.write('{"type":"FeatureCollection","features":[' + ('' if minified else '\n'))
+        for i in range(count):
+            coords = [[round(rnd.uniform(-180, 180), 6), round(rnd.uniform(-90, 90), 6)] for v in range(vertices)]
+            feature = {'type': 'Feature', 'properties': {'ARCID': i, 'UP_CELLS': rnd.randint(0, 100000)},
+                       'geometry': {'type': 'LineString', 'coordinates': coords}}
+            o.write(('' if i == 0 else separator) + json.dumps(feature, separators=(',', ':')))
+        o.write(']}' if minified else '\n]}\n')
+
+def readRegex(path):
+    count = 0
+    with open(path) as f:
+        for l in f:
+            l = l.rstrip()
+            if not l: continue
+
+            coords = regex.search(r'"coordinates":(\[.*\])', l)
+            if coords:
+                coordsNums = eval(coords.group(1))
+                count += 1
+    return count
+
+def readStreaming(path):
+    count = 0
+    with open(path, 'rb') as f:
+        for feature in geojson_io.readFeatures(f):
+            coordsNums = feature['geometry']['coordinates']
+            count += 1
+    return count
+
+def measure(name, reader, path, repeat):
+    size = os.path.getsize(path)
+    best = None
+    for r in range(repeat):
+        start = time.perf_counter()
+        count = reader(path)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    print('{0:<24} {1:>10} features {2:>8.3f} s {3:>12.0f} features/s {4:>8.1f} MB/s'.format(
+        name, count, best, count / best, size / best / 1e6))
+
+def main(args):
+    paths = [(f, False) for f in args.files]
+    samples = []
+    if not paths:
+        for minified in (False, True):
+            sample = tempfile.NamedTemporaryFile(suffix='.json', delete=False).name
+            writeSample(sample, args.features, args.vertices, minified)
+            samples.append(sample)
+            paths.append((sample, minified))
+
+    try:
+        for path, minified in paths:
+            print(path + ' (' + str(os.path.getsize(path)) + ' bytes' + (', minified' if minified else '') + ')')
+            # The regex only finds one feature per line
+            if not minified:
+                measure('regex + eval', readRegex, path, args.repeat)
+
+            loads = geojson_io.loads
+            geojson_io.loads = json.loads
+            measure('streaming (json)', readStreaming, path, args.repeat)
+            geojson_io.loads = loads
+
+            if orjson:
+                measure('streaming (orjson)', readStreaming, path, args.repeat)
+    finally:
+        for sample in samples:
+            os.remove(sample)
+
+if __name__ == "__main__":
+    # parse arguments
+    parser = argparse.ArgumentParser(description='Benchmark GeoJSON feature parsing: regex + eval against the streaming reader.')
+    parser.add_argument('-n','--features', type=int, default=100000, help='the number of features in the generated samples')
+    parser.add_argument('--vertices', type=int, default=20, help='the number of vertices per generated feature')
+    parser.add_argument('-r','--repeat', type=int, default=3, help='the number of runs to take the best time of')
+    parser.add_argument('files', nargs='*', help='geojson files to benchmark instead of the generated samples, one feature per line and minified')
+    args = parser.parse_args()
+
+    main(args)
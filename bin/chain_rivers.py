@@ -2,171 +2,1082 @@
 
 import os
 import sys
-import regex
+import math
 import numpy as np
-import datetime
 import argparse
+import array
+import mmap
+import concurrent.futures
+from collections import deque
 
-# Calculate the Strahler and Shreve Orders for stream magnitude, recursively.
-def getStrahlerAndShreve ( sourceLine, sourceCoords, sIndex, evaluated, coordsList, coordsDict ):
-    # If we have already evaluated this line, get the values from the coordsList
-    if sIndex in evaluated:        
-        return [coordsList[sIndex-1][3],coordsList[sIndex-1][4]]
-    
-    # Otherwise, append this index to the evaluated list so we don't do it twice
-    evaluated.add(sIndex)
-
-    # Set defaults
-    allTributaries = []
-    highestTributaryStrahler = 1
-
-    # Get the coordinates to be evaluated, the first coordinates in the line
-    firstCoordsOfSource = sourceCoords[0]
-        
-    # Loop over the lines to see if the last coordinates in that line match the first in ours
-    if tuple(firstCoordsOfSource) in coordsDict:
-        tributaries = coordsDict[tuple(firstCoordsOfSource)]        
-
-        for t in tributaries:
-            l = coordsList[t-1]
-            line = l[1]
-            coords = l[2]
-
-            # If so, we need to calculate the Stream orders of our 'children'
-            strahlerShreve = getStrahlerAndShreve(line, coords, t, evaluated, coordsList, coordsDict)
-
-            allTributaries.append(strahlerShreve)
-            highestTributaryStrahler = max(highestTributaryStrahler, strahlerShreve[0])
-
-    # Calculate the Strahler order, which only increases if multiple tributaries with the 
-    # same (highest) order come together at this point
-    # if there are no tributaries, this should be 1
-    hits = 0
-    strahlerOrder = 1
-    for t in allTributaries:
-        if t[0] == highestTributaryStrahler:
-            hits = hits + 1
-
-    if hits > 1:
-        strahlerOrder = highestTributaryStrahler + 1
+from geojson_io import readFeatures, FeatureWriter, setProperties, loads
+import river_cache
+import instrument
+
+# Calculate the Strahler and Shreve Orders for stream magnitude, iteratively.
+# The segments are visited in topological order (Kahn's algorithm over the endpoint
+# graph): a segment is only evaluated once all of its tributaries have been evaluated,
+# so the depth of the network is no longer bounded by the recursion limit.
+# firstCoords and lastCoords hold hashable keys of the first and last points of every segment,
+# the node ids from buildNodeIds, the orders are returned as two lists in the same order.
+def getStrahlerAndShreve ( firstCoords, lastCoords ):
+    count = len(firstCoords)
+
+    # A tributary ends where the segment downstream of it starts
+    startsAt = {}
+    for i, c in enumerate(firstCoords):
+        if not c in startsAt:
+            startsAt[c] = [i]
+        else:
+            startsAt[c].append(i)
+
+    downstream = [startsAt.get(c, ()) for c in lastCoords]
+
+    # The number of tributaries that still have to be evaluated, per segment
+    pending = [0] * count
+    for d in downstream:
+        for s in d:
+            pending[s] += 1
+
+    # Running state per segment: the highest tributary Strahler order, the number of
+    # tributaries with that order and the sum of the tributary Shreve orders
+    highest = [0] * count
+    hits = [0] * count
+    shreveSum = [0] * count
+
+    # Strahler and Shreve orders default to 1 for segments without tributaries
+    strahler = [1] * count
+    shreve = [1] * count
+    done = [False] * count
+
+    queue = deque(i for i in range(count) if pending[i] == 0)
+    nextUnvisited = 0
+    visited = 0
+
+    while visited < count or queue:
+        if not queue:
+            # Segments that are left over are part of a loop in the network, break it
+            # at the point the first of them starts so every segment still gets an order.
+            # All segments starting there are evaluated with the orders that reached the
+            # point so far, none of them hands its orders to the others, which is where
+            # getStrahlerAndShreveColumnar breaks loops as well.
+            while done[nextUnvisited]:
+                nextUnvisited += 1
+            for s in startsAt[firstCoords[nextUnvisited]]:
+                if not done[s]:
+                    done[s] = True
+                    visited += 1
+                    queue.append(s)
+
+        t = queue.popleft()
+        if not done[t]:
+            done[t] = True
+            visited += 1
+
+        # The Strahler order only increases if multiple tributaries with the
+        # same (highest) order come together at this point, the Shreve order
+        # is the sum of the Shreve orders of all tributaries
+        if highest[t] > 0:
+            strahler[t] = highest[t] + 1 if hits[t] > 1 else highest[t]
+            shreve[t] = shreveSum[t]
+
+        # Hand the orders of this segment down to the segments it flows into
+        for s in downstream[t]:
+            if done[s]:
+                continue
+            if strahler[t] > highest[s]:
+                highest[s] = strahler[t]
+                hits[s] = 1
+            elif strahler[t] == highest[s]:
+                hits[s] += 1
+            shreveSum[s] += shreve[t]
+
+            pending[s] -= 1
+            if pending[s] == 0:
+                queue.append(s)
+
+    return strahler, shreve
+
+# Give every distinct endpoint an integer node id. endpoints is a float64 array of shape
+# (n, 2, 2) holding the first and last coordinates of every segment, the ids of the
+# nodes every segment starts (source) and ends (target) at are returned as int64 arrays.
+# With a tolerance, endpoints closer together than the tolerance share a node.
+def buildNodeIds(endpoints, tolerance=0):
+    count = len(endpoints)
+    points = np.ascontiguousarray(endpoints, dtype=np.float64).reshape(2 * count, 2)
+
+    # Viewing every (x, y) pair as one complex number lets np.unique sort a flat array,
+    # which is much faster than sorting rows and gives the same (x, y) order
+    nodes, inverse = np.unique(points.view(np.complex128).reshape(-1), return_inverse=True)
+
+    if tolerance > 0:
+        labels = snapNodes(np.stack((nodes.real, nodes.imag), axis=1), tolerance)
+        nodes, labels = np.unique(labels, return_inverse=True)
+        inverse = labels.reshape(-1)[inverse]
+
+    inverse = inverse.reshape(count, 2).astype(np.int64)
+    return len(nodes), inverse[:, 0], inverse[:, 1]
+
+# The cells a point is compared with besides its own: only the neighbours ahead of it,
+# so every pair of neighbouring cells is visited once
+NEIGHBOURS = [(0, 1), (1, -1), (1, 0), (1, 1)]
+
+# Join the points that lie within the tolerance of each other, returns a label per point.
+# The points are quantized to a grid with cells the size of the tolerance, so points within
+# the tolerance are in the same or in neighbouring cells. The cells are packed into integer
+# keys and sorted, the candidates in a cell are then found by binary search. Chains of close
+# points are joined as a whole.
+def snapNodes(points, tolerance):
+    count = len(points)
+    if count == 0:
+        return np.zeros(0, dtype=np.int64)
+
+    cells = np.floor(points / tolerance)
+    # Keep a margin of one cell around the data, so neighbour keys never wrap around. The
+    # range is checked before the cells are cast, which would overflow silently.
+    cells -= cells.min(axis=0) - 1
+    extent = cells.max(axis=0) + 2
+    if not extent[0] * extent[1] < 2.0 ** 62:
+        raise ValueError('the snapping tolerance ' + str(tolerance) + ' is too small for the extent of the data')
+    cells = cells.astype(np.int64)
+    width = int(extent[1])
+
+    keys = cells[:, 0] * width + cells[:, 1]
+    order = np.argsort(keys, kind='stable')
+    sortedKeys = keys[order]
+    positions = np.arange(count)
+
+    first = []
+    second = []
+    for dx, dy in [(0, 0)] + NEIGHBOURS:
+        if (dx, dy) == (0, 0):
+            # Within a cell, only the points after this one
+            lo = positions + 1
+            hi = np.searchsorted(sortedKeys, sortedKeys, 'right')
+        else:
+            neighbour = sortedKeys + dx * width + dy
+            lo = np.searchsorted(sortedKeys, neighbour, 'left')
+            hi = np.searchsorted(sortedKeys, neighbour, 'right')
+
+        counts = np.maximum(hi - lo, 0)
+        total = counts.sum()
+        if total == 0:
+            continue
+
+        a = np.repeat(positions, counts)
+        b = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts) + np.repeat(lo, counts)
+        a = order[a]
+        b = order[b]
+
+        close = ((points[a] - points[b]) ** 2).sum(axis=1) <= tolerance * tolerance
+        first.append(a[close])
+        second.append(b[close])
+
+    if not first:
+        return positions
+    return labelComponents(count, np.concatenate(first), np.concatenate(second))
+
+# Group the segments by node in compressed sparse row form: the segments belonging
+# to node k are indices[indptr[k]:indptr[k+1]]
+def buildCSR(nodeIds, nodeCount):
+    indptr = np.zeros(nodeCount + 1, dtype=np.int64)
+    np.cumsum(np.bincount(nodeIds, minlength=nodeCount), out=indptr[1:])
+    indices = np.argsort(nodeIds, kind='stable')
+
+    return indptr, indices
+
+# Expand a set of CSR rows into one array holding all of their members
+def gatherCSR(indptr, indices, rows):
+    starts = indptr[rows]
+    counts = indptr[rows + 1] - starts
+    total = counts.sum()
+    if total == 0:
+        return indices[:0]
+
+    # offsets[j] is the position of member j within its own row
+    offsets = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+    return indices[np.repeat(starts, counts) + offsets]
+
+# Calculate the Strahler and Shreve Orders level by level on the columnar graph. Each level
+# holds all segments whose tributaries have been evaluated, and its orders are reduced onto
+# the nodes the segments flow into with vectorized operations. Returns two int32 arrays.
+# Segments without tributaries get the orders in initialStrahler and initialShreve when
+# given, which lets part of a network be recalculated on top of known upstream orders.
+# totals, a float64 array with a row per segment, is accumulated downstream in the same
+# pass: every row gets the sum of the rows of its tributaries added (see getMeasures).
+# rank receives the level every segment was evaluated in.
+def getStrahlerAndShreveColumnar(nodeCount, source, target, initialStrahler=None, initialShreve=None, totals=None, rank=None):
+    count = len(source)
+    outgoing = buildCSR(source, nodeCount)
+    nodeTotals = np.zeros((nodeCount, totals.shape[1])) if totals is not None else None
+
+    # The number of tributaries still to be evaluated, per node
+    pending = np.bincount(target, minlength=nodeCount)
+
+    # The segment that continues every segment where the river doesn't branch or join: the
+    # single segment leaving a node with a single tributary, or -1
+    single = (pending[target] == 1) & (np.diff(outgoing[0])[target] == 1)
+    successor = np.full(count, -1, dtype=np.int64)
+    successor[single] = outgoing[1][outgoing[0][target[single]]]
+    successor = successor.tolist()
+
+    # Running state per node: the highest tributary Strahler order, the number of
+    # tributaries with that order and the sum of the tributary Shreve orders
+    highest = np.zeros(nodeCount, dtype=np.int32)
+    hits = np.zeros(nodeCount, dtype=np.int32)
+    shreveSum = np.zeros(nodeCount, dtype=np.int32)
+
+    strahler = np.ones(count, dtype=np.int32)
+    shreve = np.ones(count, dtype=np.int32)
+    if initialStrahler is not None:
+        strahler[:] = initialStrahler
+        shreve[:] = initialShreve
+    done = np.zeros(count, dtype=bool)
+
+    level = np.flatnonzero(pending[source] == 0)
+    visited = 0
+    nextUnvisited = 0
+    depth = -1
+
+    while visited < count:
+        depth += 1
+        if len(level) == 0:
+            # Segments that are left over are part of a loop in the network,
+            # break it at the node the first of them starts at
+            while done[nextUnvisited]:
+                nextUnvisited += 1
+            level = gatherCSR(outgoing[0], outgoing[1], source[nextUnvisited:nextUnvisited+1])
+            level = level[~done[level]]
+
+        done[level] = True
+        visited += len(level)
+        if rank is not None:
+            rank[level] = depth
+
+        if len(level) == 1:
+            # Long unbranched stretches give levels of a single segment, which are
+            # cheaper to evaluate with scalar operations than with array operations
+            s = level[0]
+            start = source[s]
+            if highest[start] > 0:
+                strahler[s] = highest[start] + 1 if hits[start] > 1 else highest[start]
+                shreve[s] = shreveSum[start]
+            if totals is not None:
+                totals[s] += nodeTotals[start]
+
+            # The run of segments continuing it has the same orders, and is done in one step
+            run = [s]
+            t = successor[s]
+            while t >= 0 and not done[t]:
+                run.append(t)
+                t = successor[t]
+            if len(run) > 1:
+                run = np.array(run)
+                rest = run[1:]
+                strahler[rest] = strahler[s]
+                shreve[rest] = shreve[s]
+                done[rest] = True
+                visited += len(rest)
+                if rank is not None:
+                    rank[rest] = depth + np.arange(1, len(run))
+                depth += len(rest)
+                if totals is not None:
+                    totals[run] = np.cumsum(totals[run], axis=0)
+                pending[target[run[:-1]]] -= 1
+                s = run[-1]
+
+            node = target[s]
+            if strahler[s] > highest[node]:
+                highest[node] = strahler[s]
+                hits[node] = 1
+            elif strahler[s] == highest[node]:
+                hits[node] += 1
+            shreveSum[node] += shreve[s]
+            pending[node] -= 1
+            if totals is not None:
+                nodeTotals[node] += totals[s]
+
+            if pending[node] <= 0:
+                level = outgoing[1][outgoing[0][node]:outgoing[0][node+1]]
+                level = level[~done[level]]
+            else:
+                level = level[:0]
+            continue
+
+        # The Strahler order only increases if multiple tributaries with the same (highest)
+        # order come together, the Shreve order is the sum of all tributary Shreve orders
+        start = source[level]
+        joined = highest[start] > 0
+        strahler[level] = np.where(joined, highest[start] + (hits[start] > 1), strahler[level])
+        shreve[level] = np.where(joined, shreveSum[start], shreve[level])
+
+        # Reduce the orders of this level onto the nodes the segments flow into
+        nodes, inverse = np.unique(target[level], return_inverse=True)
+        levelStrahler = strahler[level]
+
+        levelHighest = np.zeros(len(nodes), dtype=np.int32)
+        np.maximum.at(levelHighest, inverse, levelStrahler)
+        levelHits = np.bincount(inverse, weights=levelStrahler == levelHighest[inverse], minlength=len(nodes)).astype(np.int32)
+
+        current = highest[nodes]
+        hits[nodes] = np.where(levelHighest > current, levelHits,
+                               np.where(levelHighest == current, hits[nodes] + levelHits, hits[nodes]))
+        highest[nodes] = np.maximum(current, levelHighest)
+        shreveSum[nodes] += np.bincount(inverse, weights=shreve[level], minlength=len(nodes)).astype(np.int32)
+        pending[nodes] -= np.bincount(inverse, minlength=len(nodes))
+        if totals is not None:
+            totals[level] += nodeTotals[start]
+            for column in range(totals.shape[1]):
+                nodeTotals[nodes, column] += np.bincount(inverse, weights=totals[level, column], minlength=len(nodes))
+
+        # The segments starting at nodes without pending tributaries form the next level
+        level = gatherCSR(outgoing[0], outgoing[1], nodes[pending[nodes] <= 0])
+        level = level[~done[level]]
+
+    return strahler, shreve
+
+# Label the weakly connected components of the graph, the independent drainage basins.
+# The larger label of every edge is hooked onto the smaller one, after which the label
+# paths are compressed by pointer jumping, until every edge lies within a single component.
+def labelComponents(nodeCount, source, target):
+    labels = np.arange(nodeCount)
+
+    while True:
+        a = labels[source]
+        b = labels[target]
+        differ = a != b
+        if not differ.any():
+            return labels
+
+        np.minimum.at(labels, np.maximum(a, b)[differ], np.minimum(a, b)[differ])
+
+        while True:
+            jumped = labels[labels]
+            if np.array_equal(jumped, labels):
+                break
+            labels = jumped
+
+# Calculate the orders for a batch of whole basins, with node ids local to the batch
+def getBatchOrders(source, target, initialStrahler=None, initialShreve=None):
+    nodes, inverse = np.unique(np.concatenate((source, target)), return_inverse=True)
+    inverse = inverse.reshape(-1)
+
+    return getStrahlerAndShreveColumnar(len(nodes), inverse[:len(source)], inverse[len(source):],
+                                        initialStrahler, initialShreve)
+
+# Calculate the orders, the upstream totals and the ranks for a batch of whole basins
+def getBatchTotals(source, target, totals):
+    nodes, inverse = np.unique(np.concatenate((source, target)), return_inverse=True)
+    inverse = inverse.reshape(-1)
+    rank = np.zeros(len(source), dtype=np.int64)
+
+    strahler, shreve = getStrahlerAndShreveColumnar(len(nodes), inverse[:len(source)], inverse[len(source):], totals=totals, rank=rank)
+    return strahler, shreve, totals, rank
+
+# Calculate the Strahler and Shreve Orders of the basins in the graph in parallel. The basins
+# are grouped into batches of roughly equal size, and the results are merged back by segment
+# index, so they don't depend on the number of jobs. totals and rank are filled like
+# getStrahlerAndShreveColumnar does, the ranks are only comparable within a basin.
+def getStrahlerAndShreveParallel(nodeCount, source, target, jobs, totals=None, rank=None):
+    count = len(source)
+    component = labelComponents(nodeCount, source, target)[source]
+
+    # Sort the segments by basin, keeping the input order within every basin
+    order = np.argsort(component, kind='stable')
+    starts = np.flatnonzero(np.diff(component[order])) + 1
+
+    # Cut the sorted segments at the first basin boundary after every multiple of the batch size
+    size = max(1, count // (jobs * 4))
+    cuts = np.searchsorted(starts, np.arange(size, count, size))
+    cuts = np.unique(starts[cuts[cuts < len(starts)]])
+    batches = np.split(order, cuts)
+
+    strahler = np.ones(count, dtype=np.int32)
+    shreve = np.ones(count, dtype=np.int32)
+
+    with concurrent.futures.ProcessPoolExecutor(jobs) as executor:
+        if totals is not None:
+            results = executor.map(getBatchTotals, [source[b] for b in batches], [target[b] for b in batches], [totals[b] for b in batches])
+            for b, (batchStrahler, batchShreve, batchTotals, batchRank) in zip(batches, results):
+                strahler[b] = batchStrahler
+                shreve[b] = batchShreve
+                totals[b] = batchTotals
+                if rank is not None:
+                    rank[b] = batchRank
+            return strahler, shreve
+
+        results = executor.map(getBatchOrders, [source[b] for b in batches], [target[b] for b in batches])
+        for b, (batchStrahler, batchShreve) in zip(batches, results):
+            strahler[b] = batchStrahler
+            shreve[b] = batchShreve
+
+    return strahler, shreve
+
+# The mean radius of the earth in meters, segment lengths are great circle distances
+EARTH_RADIUS = 6371008.8
+
+# The optional per segment measures and the properties they are written to. The lengths are in
+# meters, assuming longitude, latitude coordinates.
+MEASURES = {
+    'upstream_length': 'UP_LENGTH',
+    'upstream_count': 'UP_COUNT',
+    'outlet_distance': 'OUTLET_DIST',
+    'hack': 'HACK',
+    'main_stem': 'MAIN_STEM',
+}
+
+# The array of segment lengths in the caches and sidecars
+LENGTH_ARRAY = 'segment_length'
+
+# Lines with fewer points than this are measured with scalar math, which is faster for
+# the short lines most segments have than setting up arrays
+SCALAR_LENGTH_POINTS = 64
+
+# The length of the lines of a LineString or MultiLineString feature in meters
+def getLength(feature):
+    geometry = feature.get('geometry') or {}
+    coords = geometry.get('coordinates') or []
+    lines = coords if geometry.get('type') == 'MultiLineString' else [coords]
+
+    length = 0.0
+    for line in lines:
+        if len(line) < 2:
+            continue
+        if len(line) < SCALAR_LENGTH_POINTS:
+            lon0 = math.radians(line[0][0])
+            lat0 = math.radians(line[0][1])
+            for c in line[1:]:
+                lon = math.radians(c[0])
+                lat = math.radians(c[1])
+                a = math.sin((lat - lat0) / 2) ** 2 + math.cos(lat0) * math.cos(lat) * math.sin((lon - lon0) / 2) ** 2
+                length += 2 * EARTH_RADIUS * math.asin(math.sqrt(min(a, 1)))
+                lon0, lat0 = lon, lat
+            continue
+        points = np.radians(np.array([c[:2] for c in line], dtype=np.float64))
+        lon, lat = points[:, 0], points[:, 1]
+        a = np.sin(np.diff(lat) / 2) ** 2 + np.cos(lat[:-1]) * np.cos(lat[1:]) * np.sin(np.diff(lon) / 2) ** 2
+        length += 2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.minimum(a, 1))).sum()
+    return length
+
+# Read the lengths of the features at the given byte ranges of a file
+def readLengths(path, offsets, lengths):
+    result = np.zeros(len(offsets))
+    with open(path, 'rb') as b:
+        data = mmap.mmap(b.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            for i, (offset, length) in enumerate(zip(offsets, lengths)):
+                result[i] = getLength(loads(data[offset:offset + length]))
+        finally:
+            data.close()
+    return result
+
+# Add up values along the paths of pointers by pointer jumping: every value becomes the sum of
+# itself and the values of the elements its pointers lead to, until a pointer of -1. Takes the
+# log2 of the longest path in steps over the whole array.
+def pathSums(pointers, values):
+    pointers = pointers.copy()
+    values = values.copy()
+    active = np.flatnonzero(pointers >= 0)
+    while len(active):
+        values[active] += values[pointers[active]]
+        pointers[active] = pointers[pointers[active]]
+        active = active[pointers[active] >= 0]
+    return values
+
+# The element at the end of the path of pointers of every element, where an element points to itself
+def pathEnds(pointers):
+    while True:
+        jumped = pointers[pointers]
+        if np.array_equal(jumped, pointers):
+            return pointers
+        pointers = jumped
+
+# Calculate the orders and the requested measures of every segment in the pass of
+# getStrahlerAndShreveColumnar, returns the orders and a dict of measure name to array:
+#
+#   upstream_length  the length of the segment and all segments upstream of it
+#   upstream_count   the number of segments in the network upstream, the segment included
+#   outlet_distance  the length of the path from the start of the segment to the outlet
+#   hack             the Hack order: 1 for the main stem from the outlet up, which follows
+#                    the tributary with the largest upstream length at every junction, 2
+#                    for the streams flowing into it, and so on
+#   main_stem        the id of the segment where the stream the segment is part of ends,
+#                    which is the same for the whole stream and doesn't change when other
+#                    segments are added or removed. Without ids (see outletIds) it is the
+#                    index of that segment in the order of the input.
+#
+# The upstream measures are accumulated in the pass, the others follow the downstream
+# segment of every segment by pointer jumping on whole arrays. Where a segment splits, the
+# first segment leaving the node (in the order of the input) is followed.
+def getMeasures(nodeCount, source, target, lengths, measures, jobs=1, ids=None):
+    count = len(source)
+    totals = np.column_stack((lengths, np.ones(count)))
+    rank = np.zeros(count, dtype=np.int64)
+    if jobs > 1:
+        strahler, shreve = getStrahlerAndShreveParallel(nodeCount, source, target, jobs, totals, rank)
     else:
-        strahlerOrder = highestTributaryStrahler
-
-    # Calculate the Shreve order by adding all tributaries's Shreve orders
-    # if there are no tributaries, this should be 1
-    shreveOrder = 0
-    if len(allTributaries) > 0:        
-        for t in allTributaries:
-            shreveOrder = shreveOrder + t[1]
+        strahler, shreve = getStrahlerAndShreveColumnar(nodeCount, source, target, totals=totals, rank=rank)
+
+    values = {'upstream_length': totals[:, 0], 'upstream_count': totals[:, 1].astype(np.int64)}
+    if not set(measures) - set(values):
+        return strahler, shreve, dict((name, values[name]) for name in measures)
+
+    # The segment downstream of every segment, or -1 at an outlet. A segment evaluated in the same
+    # or an earlier level only flows back into a loop, which is cut there.
+    index = np.arange(count)
+    first = np.full(nodeCount, count, dtype=np.int64)
+    np.minimum.at(first, source, index)
+    downstream = first[target]
+    outlet = downstream == count
+    downstream[outlet] = 0
+    downstream[outlet | (rank[downstream] <= rank)] = -1
+
+    # The main tributary of every node has the largest upstream length, then the largest
+    # upstream count, then the lowest index
+    order = np.lexsort((index, -totals[:, 1], -totals[:, 0], target))
+    leading = np.ones(count, dtype=bool)
+    leading[1:] = target[order][1:] != target[order][:-1]
+    main = np.zeros(count, dtype=bool)
+    main[order[leading]] = True
+
+    values['outlet_distance'] = pathSums(downstream, np.asarray(lengths, dtype=np.float64))
+    values['hack'] = 1 + pathSums(downstream, ((downstream >= 0) & ~main).astype(np.int64))
+    values['main_stem'] = outletIds(pathEnds(np.where((downstream >= 0) & main, downstream, index)), ids)
+    return strahler, shreve, dict((name, values[name]) for name in measures)
+
+# Get the first and last (x, y) coordinates of a LineString or MultiLineString feature
+def getEndpoints(feature):
+    geometry = feature.get('geometry') or {}
+    coords = geometry.get('coordinates')
+    if not coords:
+        return None
+
+    if geometry.get('type') == 'MultiLineString':
+        return tuple(coords[0][0][:2]), tuple(coords[-1][-1][:2])
+    return tuple(coords[0][:2]), tuple(coords[-1][:2])
+
+# Add the stream orders, and the measures when given, to the properties of a feature
+def setOrders(feature, strahlerOrder, shreveOrder, measures=None):
+    properties = {'STRAHLER': int(strahlerOrder), 'SHREVE': int(shreveOrder)}
+    if measures:
+        properties.update(measures)
+    return setProperties(feature, properties)
+
+# The measures as (property, list) pairs, converted for the output once for all segments
+def measureColumns(measures):
+    return [(MEASURES[name], (np.round(values, 1) if values.dtype.kind == 'f' else values).tolist()) for name, values in measures.items()]
+
+# The properties of the measures of segment i
+def measureProperties(columns, i):
+    return dict((name, values[i]) for name, values in columns)
+
+# Get the id of a feature, used to match the features of a diff with those of an earlier output
+def getId(feature, idProperty):
+    return (feature.get('properties') or {}).get(idProperty)
+
+# The feature ids as an array: integers when they all are, strings otherwise
+def idArray(ids):
+    if all(type(i) is int for i in ids):
+        return np.array(ids, dtype=np.int64)
+    return np.array([str(i) for i in ids])
+
+# The ids of the outlet segments of main stems given by index, or the indices themselves when
+# not every segment has an id
+def outletIds(outlets, ids):
+    if ids is None or any(i is None for i in ids):
+        return outlets
+    return idArray(list(ids))[outlets]
+
+# Read the ids of the features at the given byte ranges of a file
+def readIds(path, offsets, lengths, idProperty):
+    result = []
+    with open(path, 'rb') as b:
+        data = mmap.mmap(b.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            for offset, length in zip(offsets, lengths):
+                result.append(getId(loads(data[offset:offset + length]), idProperty))
+        finally:
+            data.close()
+    return result
+
+# Look up ids in an id array, returns the index of every id or -1 for unknown ids
+def findIds(ids, keys):
+    index = np.full(len(keys), -1, dtype=np.int64)
+    if len(ids) == 0 or len(keys) == 0:
+        return index
+
+    if ids.dtype.kind == 'i':
+        usable = np.array([type(k) is int for k in keys], dtype=bool)
+        values = np.array([k if type(k) is int else 0 for k in keys], dtype=np.int64)
     else:
-        shreveOrder = 1
+        usable = np.ones(len(keys), dtype=bool)
+        values = np.array([str(k) for k in keys])
 
-    # Add the calculated Strahler and Shreve orders to the coordsList
-    coordsList[sIndex-1][3] = strahlerOrder
-    coordsList[sIndex-1][4] = shreveOrder
-    
-    return [strahlerOrder, shreveOrder]
+    order = np.argsort(ids, kind='stable')
+    position = np.minimum(np.searchsorted(ids[order], values), len(ids) - 1)
+    found = usable & (ids[order][position] == values)
+    index[found] = order[position[found]]
+    return index
 
-def main(args):
-    for f in args.files:
-        # Set vars
-        coordsList = []
-        coordsDict = {}
-
-        # Get the basename for this file, add '_out' to it for the output file
-        input_name = os.path.basename(f.name)
-        output_file = os.path.splitext(input_name)[0] + '_out.json'
-        
-        if (args.time):
-            startTime = datetime.datetime.now().replace(microsecond=0)
+# Mark every segment downstream of the seed segments, including the seeds themselves
+def downstreamClosure(nodeCount, source, target, seeds):
+    outgoing = buildCSR(source, nodeCount)
+    affected = np.zeros(len(source), dtype=bool)
+    frontier = np.unique(seeds)
+    affected[frontier] = True
+
+    while len(frontier):
+        frontier = gatherCSR(outgoing[0], outgoing[1], np.unique(target[frontier]))
+        frontier = np.unique(frontier[~affected[frontier]])
+        affected[frontier] = True
+
+    return affected
 
+# Compact columnar processing of a single file: only the segment endpoints and the byte
+# offsets of the features are kept in memory, the input file is streamed a second time
+# when the output is written.
+def chainColumnar(f, output_file, args, metrics):
+    metrics.start('Graph construction')
+
+    # Reuse the graph of an earlier run when the input hasn't changed since
+    options = {'snap': args.snap}
+    graph = river_cache.loadCache(f.name, args.cache_dir, options=options) if args.cache else None
+
+    if graph:
         if (args.verbose):
-            print ('reading input file and constructing dictionary')
-        
-        for i, l in enumerate(f):
-            l = l.rstrip()
-            if not l: continue
-
-            # The coordinates are extracted from the geojson and evaluated into a list 
-            coords = regex.search(r'"coordinates":(\[.*\])', l)
-            
-            if coords:
-                coordsNums = eval(coords.group(1))
-                nums = np.array([coordsNums[0], coordsNums[-1]])
-                # the Strahler and Shreve orders are set to default 1 here.
-                coordsList.append([i, l, nums, 1, 1])
-
-                tup = tuple(coordsNums[-1])
-                
-                if not tup in coordsDict:
-                    coordsDict[tup] = [i]
+            print ('opened the cached river graph of ' + f.name)
+
+        nodeCount = graph['nodeCount']
+        endpoints = graph['endpoints']
+        source = graph['source']
+        target = graph['target']
+        offsets = graph['offsets']
+        featureIds = readIds(f.name, offsets, graph['lengths'], args.id_property) if 'main_stem' in (args.measures or []) else None
+
+        if args.measures:
+            if LENGTH_ARRAY in graph['arrays']:
+                segmentLengths = river_cache.loadCache(f.name, args.cache_dir, [LENGTH_ARRAY], options)[LENGTH_ARRAY]
+            else:
+                segmentLengths = readLengths(f.name, offsets, graph['lengths'])
+                river_cache.updateCache(f.name, {LENGTH_ARRAY: segmentLengths}, args.cache_dir)
+    else:
+        if (args.verbose):
+            print ('reading input file into columnar arrays')
+
+        endpoints = array.array('d')
+        offsets = array.array('q')
+        lengths = array.array('q')
+        segmentLengths = array.array('d')
+        featureIds = [] if 'main_stem' in (args.measures or []) else None
+
+        progress = metrics.progress('features read')
+        with open(f.name, 'rb') as b:
+            for offset, length, feature in readFeatures(b, offsets=True):
+                progress.update()
+                ends = getEndpoints(feature)
+                if ends:
+                    endpoints.extend(ends[0])
+                    endpoints.extend(ends[1])
+                    offsets.append(offset)
+                    lengths.append(length)
+                    if args.measures:
+                        segmentLengths.append(getLength(feature))
+                    if featureIds is not None:
+                        featureIds.append(getId(feature, args.id_property))
+
+        endpoints = np.frombuffer(endpoints, dtype=np.float64).reshape(-1, 2, 2)
+        offsets = np.frombuffer(offsets, dtype=np.int64)
+        lengths = np.frombuffer(lengths, dtype=np.int64)
+        segmentLengths = np.frombuffer(segmentLengths, dtype=np.float64)
+
+        nodeCount, source, target = buildNodeIds(endpoints, args.snap)
+
+        if (args.cache):
+            arrays = {'endpoints': endpoints, 'source': source, 'target': target, 'offsets': offsets, 'lengths': lengths}
+            if args.measures:
+                arrays[LENGTH_ARRAY] = segmentLengths
+            river_cache.writeCache(f.name, nodeCount, arrays, args.cache_dir, options)
+
+    metrics.stop(len(source))
+    metrics.count(features=len(source), nodes=nodeCount, edges=len(source))
+
+    if (args.verbose):
+        print ('start stream order calculations for ' + str(len(source)) + ' segments and ' + str(nodeCount) + ' nodes')
+
+    metrics.start('Order calculations')
+    measures = {}
+
+    if args.measures:
+        # The measures are calculated in the same pass as the orders
+        strahler, shreve, measures = getMeasures(nodeCount, source, target, segmentLengths, args.measures, args.jobs, featureIds)
+        if (args.cache):
+            river_cache.updateCache(f.name, {'strahler': strahler, 'shreve': shreve}, args.cache_dir)
+    elif graph and 'strahler' in graph['arrays']:
+        # The orders only depend on the graph, so the cached ones are still valid
+        orders = river_cache.loadCache(f.name, args.cache_dir, river_cache.ORDER_ARRAYS, options)
+        strahler = orders['strahler']
+        shreve = orders['shreve']
+    else:
+        if args.jobs > 1:
+            strahler, shreve = getStrahlerAndShreveParallel(nodeCount, source, target, args.jobs)
+        else:
+            strahler, shreve = getStrahlerAndShreveColumnar(nodeCount, source, target)
+
+        if (args.cache):
+            river_cache.updateCache(f.name, {'strahler': strahler, 'shreve': shreve}, args.cache_dir)
+
+    metrics.stop(len(source))
+
+    if (args.verbose):
+        print ('writing output to ' + output_file)
+
+    metrics.start('Output')
+    progress = metrics.progress('features written', len(offsets))
+    columns = measureColumns(measures)
+
+    # The byte ranges and ids of the written features, for the sidecar
+    outputOffsets = array.array('q')
+    outputLengths = array.array('q')
+    ids = []
+
+    with open(f.name, 'rb') as b, open(output_file, 'wb') as o, FeatureWriter(o, args.ndjson) as w:
+        # Features without a line geometry were left out of the graph, and are skipped here as well
+        i = 0
+        for offset, length, feature in readFeatures(b, offsets=True):
+            if i < len(offsets) and offset == offsets[i]:
+                position = w.write(setOrders(feature, strahler[i], shreve[i], measureProperties(columns, i)))
+                progress.update()
+                if (args.sidecar):
+                    outputOffsets.append(position[0])
+                    outputLengths.append(position[1])
+                    ids.append(getId(feature, args.id_property))
+                i += 1
+
+    if (args.sidecar):
+        arrays = {
+            'endpoints': endpoints, 'source': source, 'target': target,
+            'offsets': np.frombuffer(outputOffsets, dtype=np.int64), 'lengths': np.frombuffer(outputLengths, dtype=np.int64),
+            'strahler': strahler, 'shreve': shreve, 'ids': idArray(ids)}
+        if measures:
+            arrays[LENGTH_ARRAY] = segmentLengths
+            arrays.update(measures)
+        river_cache.writeCache(output_file, nodeCount, arrays, args.cache_dir, options)
+
+    metrics.stop(len(offsets))
+
+# Apply a diff to an earlier output that has a sidecar, see --sidecar. The diff is a GeoJSON file
+# of features with an id: a feature with a new id is added, a feature with a known id replaces
+# the earlier one and a feature without a geometry removes it. Only the orders of the segments
+# downstream of the edits are recalculated, on top of the known orders of their tributaries.
+# The output is rewritten in place: only the edited features and those whose orders changed are
+# encoded again, all other features are copied over as they are.
+# With measures, whose values upstream of an edit change as well (like the distance to the
+# outlet), the orders and measures of the whole graph are recalculated from the sidecar.
+def updateFile(f, args):
+    metrics = instrument.Metrics(f.name, args.time, args.verbose, args.tracemalloc)
+    metrics.start('Order recalculation')
+
+    graph = river_cache.loadCache(f.name, args.cache_dir, river_cache.SIDECAR_ARRAYS)
+    if not graph:
+        print (f.name + ': no up to date sidecar, run chain_rivers.py with --sidecar first')
+        return metrics.report()
+
+    # The last edit of every id counts
+    edits = {}
+    with open(args.update, 'rb') as b:
+        for feature in readFeatures(b):
+            key = getId(feature, args.id_property)
+            if key is None:
+                raise ValueError('a feature in ' + args.update + ' has no ' + args.id_property + ' property')
+            edits[key] = feature
+
+    keys = list(edits)
+    found = findIds(graph['ids'], keys)
+    count = graph['count']
+
+    removed = []
+    modified = {}
+    added = []
+    for key, index in zip(keys, found):
+        ends = getEndpoints(edits[key])
+        if index < 0:
+            if ends:
+                added.append((edits[key], ends))
+            elif (args.verbose):
+                print ('skipping the removal of unknown id ' + str(key))
+        elif ends:
+            modified[int(index)] = (edits[key], ends)
+        else:
+            removed.append(int(index))
+
+    # The new graph: the kept segments in their old order, followed by the added ones
+    keep = np.ones(count, dtype=bool)
+    keep[removed] = False
+    origin = np.concatenate((np.flatnonzero(keep), np.full(len(added), -1, dtype=np.int64)))
+    newIndex = np.full(count, -1, dtype=np.int64)
+    newIndex[keep] = np.arange(keep.sum())
+
+    endpoints = np.concatenate((np.asarray(graph['endpoints'])[keep],
+                                np.array([e for feature, e in added], dtype=np.float64).reshape(-1, 2, 2)))
+    features = {}
+    for index, (feature, ends) in modified.items():
+        endpoints[newIndex[index]] = ends
+        features[newIndex[index]] = feature
+    for i, (feature, ends) in enumerate(added):
+        features[keep.sum() + i] = feature
+
+    # The edits are joined to the network with the tolerance it was built with
+    options = graph.get('options') or {}
+    nodeCount, source, target = buildNodeIds(endpoints, options.get('snap', 0))
+
+    kept = origin >= 0
+    ids = np.asarray(graph['ids'])[keep].tolist() + [getId(feature, args.id_property) for feature, ends in added]
+    measures = {}
+    sidecarMeasures = [name for name in [LENGTH_ARRAY] + list(args.measures or []) if name in graph['arrays']]
+    previous = river_cache.loadCache(f.name, args.cache_dir, sidecarMeasures) if args.measures else None
+
+    if args.measures:
+        if previous is None or LENGTH_ARRAY not in previous:
+            print (f.name + ': the sidecar has no segment lengths, run chain_rivers.py with --sidecar and --measures first')
+            return metrics.report()
+
+        segmentLengths = np.concatenate((np.asarray(previous[LENGTH_ARRAY])[keep], [getLength(feature) for feature, ends in added]))
+        for index, (feature, ends) in modified.items():
+            segmentLengths[newIndex[index]] = getLength(feature)
+
+        strahler, shreve, measures = getMeasures(nodeCount, source, target, segmentLengths, args.measures, ids=ids)
+        recalculate = np.arange(len(origin))
+
+        # Rewrite the features whose orders or measures (as written) changed
+        changed = ~kept
+        changed[kept] = ((strahler[kept] != np.asarray(graph['strahler'])[origin[kept]]) |
+                         (shreve[kept] != np.asarray(graph['shreve'])[origin[kept]]))
+        for name, values in measures.items():
+            # A main stem given by index before is given by id now
+            if name not in previous or np.asarray(previous[name]).dtype.kind != values.dtype.kind:
+                changed[:] = True
+                continue
+            before = np.asarray(previous[name])[origin[kept]]
+            if values.dtype.kind == 'f':
+                changed[kept] |= np.round(values[kept], 1) != np.round(before, 1)
+            else:
+                changed[kept] |= values[kept] != before
+        changed[list(features)] = True
+    else:
+        # The edited segments are affected, and so are the segments that used to be downstream
+        # of a removed or modified segment, as well as everything downstream of those
+        changedBefore = np.array(removed + list(modified), dtype=np.int64)
+        downstreamBefore = newIndex[np.isin(graph['source'], np.asarray(graph['target'])[changedBefore])]
+        seeds = np.concatenate((np.array(list(features), dtype=np.int64), downstreamBefore[downstreamBefore >= 0]))
+        affected = downstreamClosure(nodeCount, source, target, seeds)
+
+        # Recalculate the affected segments together with their unaffected tributaries,
+        # whose orders are known and don't change
+        strahler = np.ones(len(origin), dtype=np.int32)
+        shreve = np.ones(len(origin), dtype=np.int32)
+        strahler[kept] = np.asarray(graph['strahler'])[origin[kept]]
+        shreve[kept] = np.asarray(graph['shreve'])[origin[kept]]
+
+        recalculate = np.flatnonzero(affected)
+        tributaries = np.flatnonzero(np.isin(target, source[recalculate]) & ~affected)
+        subset = np.concatenate((recalculate, tributaries))
+        ones = np.ones(len(recalculate), dtype=np.int32)
+
+        subsetStrahler, subsetShreve = getBatchOrders(source[subset], target[subset],
+                                                      np.concatenate((ones, strahler[tributaries])),
+                                                      np.concatenate((ones, shreve[tributaries])))
+        subsetStrahler = subsetStrahler[:len(recalculate)]
+        subsetShreve = subsetShreve[:len(recalculate)]
+
+        changed = np.zeros(len(origin), dtype=bool)
+        changed[recalculate] = (strahler[recalculate] != subsetStrahler) | (shreve[recalculate] != subsetShreve)
+        changed[list(features)] = True
+        strahler[recalculate] = subsetStrahler
+        shreve[recalculate] = subsetShreve
+
+    metrics.stop(len(recalculate))
+    metrics.count(features=len(origin), nodes=nodeCount, edges=len(origin), edits=len(edits),
+                  recalculated=len(recalculate), rewritten=changed.sum())
+
+    if (args.verbose):
+        print (str(len(added)) + ' added, ' + str(len(modified)) + ' modified and ' + str(len(removed)) + ' removed segments, ' +
+               str(len(recalculate)) + ' segments recalculated, ' + str(int(changed.sum())) + ' features rewritten')
+
+    # Write the new output next to the old one, and replace it once it is complete
+    metrics.start('Output')
+    offsets = array.array('q')
+    lengths = array.array('q')
+    temporary = f.name + '.tmp'
+    columns = measureColumns(measures)
+    oldOffsets = graph['offsets']
+    oldLengths = graph['lengths']
+
+    with open(f.name, 'rb') as b, open(temporary, 'wb') as o, FeatureWriter(o, f.name.endswith('.ndjson')) as w:
+        data = mmap.mmap(b.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            for i in range(len(origin)):
+                if changed[i]:
+                    if i in features:
+                        feature = features[i]
+                    else:
+                        feature = loads(data[oldOffsets[origin[i]]:oldOffsets[origin[i]] + oldLengths[origin[i]]])
+                    position = w.write(setOrders(feature, strahler[i], shreve[i], measureProperties(columns, i)))
                 else:
-                    coordsDict[tup].append(i)
+                    position = w.writeEncoded(data[oldOffsets[origin[i]]:oldOffsets[origin[i]] + oldLengths[origin[i]]])
+                offsets.append(position[0])
+                lengths.append(position[1])
+        finally:
+            data.close()
+
+    os.replace(temporary, f.name)
+    arrays = {
+        'endpoints': endpoints, 'source': source, 'target': target,
+        'offsets': np.frombuffer(offsets, dtype=np.int64), 'lengths': np.frombuffer(lengths, dtype=np.int64),
+        'strahler': strahler, 'shreve': shreve, 'ids': idArray(ids)}
+    if measures:
+        arrays[LENGTH_ARRAY] = segmentLengths
+        arrays.update(measures)
+    river_cache.writeCache(f.name, nodeCount, arrays, args.cache_dir, options)
+
+    metrics.stop(len(origin))
+    return metrics.report()
+
+# Calculate the stream orders for a single file, returns the metrics report of the run
+def chainFile(f, args):
+    # Set vars
+    coordsList = []
+    endpoints = array.array('d')
+
+    # Get the basename for this file, add '_out' to it for the output file
+    input_name = os.path.basename(f.name)
+    output_file = os.path.splitext(input_name)[0] + ('_out.ndjson' if args.ndjson else '_out.json')
+
+    metrics = instrument.Metrics(f.name, args.time, args.verbose, args.tracemalloc)
+
+    if (args.columnar or args.sidecar or args.measures):
+        chainColumnar(f, output_file, args, metrics)
+        return metrics.report()
+
+    metrics.start('Input read')
+
+    if (args.verbose):
+        print ('reading input file and collecting segment endpoints')
+
+    progress = metrics.progress('features read')
+    for i, feature in enumerate(readFeatures(f)):
+        progress.update()
+        # The endpoints are taken from the decoded geometry
+        ends = getEndpoints(feature)
         
-        if (args.time):
-            endTime = datetime.datetime.now().replace(microsecond=0)
-            print ('Dictionary construction time taken: ' + str(endTime-startTime))
+        if ends:
+            nums = np.array(ends)
+            # the Strahler and Shreve orders are set to default 1 here.
+            coordsList.append([i, feature, nums, 1, 1])
 
-        # Open the ouput file so we can write to it
-        with open(output_file,'w+') as o:
-            if (args.time):
-                startTime = datetime.datetime.now().replace(microsecond=0)
+            endpoints.extend(ends[0])
+            endpoints.extend(ends[1])
 
-            if (args.verbose):
-                print ('start stream order calculations')            
+    # Segments are joined by integer node ids rather than by coordinate tuples
+    nodeCount, source, target = buildNodeIds(np.frombuffer(endpoints, dtype=np.float64).reshape(-1, 2, 2), args.snap)
+    firstCoords = source.tolist()
+    lastCoords = target.tolist()
 
-            # Keep a list of evaluated lines for optimization (so we don't evaluate twice)
-            evaluated = set({})
+    metrics.stop(len(coordsList))
+    metrics.count(features=len(coordsList), nodes=nodeCount, edges=len(coordsList))
 
-            # For all input file lines
-            for l in coordsList:
-                index = l[0]
-                line = l[1]
-                coords = l[2]
+    # Open the ouput file so we can write to it
+    with open(output_file,'wb') as o:
+        metrics.start('Order calculations')
 
-                # the evaluated list is being appended to during the loop due to the recursive nature
-                if not index in evaluated:
-                    getStrahlerAndShreve(line, coords, index, evaluated, coordsList, coordsDict)
+        if (args.verbose):
+            print ('start stream order calculations for ' + str(len(coordsList)) + ' segments')
 
-                    # Print as a status indicator for the process
-                    if (args.verbose):
-                        print('done ' + str(index) + ' : ' + str(len(coordsList)))
-            
-            if (args.time):
-                endTime = datetime.datetime.now().replace(microsecond=0)
-                print ('Order calculations time taken: ' + str(endTime-startTime))
+        # A single pass over the network in topological order
+        strahler, shreve = getStrahlerAndShreve(firstCoords, lastCoords)
 
-            # When done, write everything to the ouput file
-            if (args.time):
-                startTime = datetime.datetime.now().replace(microsecond=0)
+        for l, strahlerOrder, shreveOrder in zip(coordsList, strahler, shreve):
+            l[3] = strahlerOrder
+            l[4] = shreveOrder
+        
+        metrics.stop(len(coordsList))
 
-            if (args.verbose):
-                print ('writing output to ' + output_file)
+        # When done, write everything to the ouput file
+        metrics.start('Output')
 
-            # Write geojson prefix
-            o.write('{"type":"FeatureCollection", "features": [\n')
+        if (args.verbose):
+            print ('writing output to ' + output_file)
 
-            # Write lines
+        # Write the features, the writer adds the geojson prefix and postfix
+        progress = metrics.progress('features written', len(coordsList))
+        with FeatureWriter(o, args.ndjson) as w:
             for l in coordsList:
-                newLine = regex.sub(r'properties":{(.*?)}', r'properties":{\1,"STRAHLER":'+str(l[3])+',"SHREVE":'+str(l[4])+'}', l[1])                
-                o.write(newLine + '\n')
+                w.write(setOrders(l[1], l[3], l[4]))
+                progress.update()
 
-            # And add a postfix
-            o.write(']}\n\n')        
-            
-            if (args.time):
-                endTime = datetime.datetime.now().replace(microsecond=0)
-                print ('Output written, time taken: ' + str(endTime-startTime))
+        metrics.stop(len(coordsList))
 
-if __name__ == "__main__":
-    sys.setrecursionlimit(2000)
+    return metrics.report()
 
+# Used by the process pool, where the files are opened by the workers themselves
+def chainPath(path, args):
+    with open(path) as f:
+        return chainFile(f, args)
+
+# Parse the comma separated names of --measures
+def measureNames(value):
+    names = [name.strip() for name in value.split(',') if name.strip()]
+    for name in names:
+        if name != 'all' and name not in MEASURES:
+            raise argparse.ArgumentTypeError('unknown measure ' + repr(name) + ', choose from ' + ', '.join(list(MEASURES) + ['all']))
+    return list(MEASURES) if 'all' in names else names
+
+def main(args):
+    # A single file is only split into its drainage basins by the columnar mode, otherwise
+    # --jobs would have no effect
+    columnar = args.columnar or args.sidecar or args.measures
+    if args.jobs > 1 and len(args.files) == 1 and not (columnar or args.update):
+        print ('--jobs is ignored for a single file unless --columnar (or --sidecar or --measures) is given', file=sys.stderr)
+    elif args.jobs > 1 and args.update:
+        print ('--jobs is ignored by --update, the edits are applied serially', file=sys.stderr)
+
+    if args.update:
+        runs = [updateFile(f, args) for f in args.files]
+    elif args.jobs > 1 and len(args.files) > 1:
+        # Process the files in parallel, the basins within each file are then done serially
+        paths = [f.name for f in args.files]
+        for f in args.files:
+            f.close()
+
+        options = argparse.Namespace(**vars(args))
+        options.files = None
+        options.jobs = 1
+
+        with concurrent.futures.ProcessPoolExecutor(args.jobs) as executor:
+            runs = list(executor.map(chainPath, paths, [options] * len(paths)))
+    else:
+        runs = [chainFile(f, args) for f in args.files]
+
+    if args.metrics:
+        instrument.writeReport(args.metrics, 'chain_rivers', runs)
+
+if __name__ == "__main__":
     # parse arguments
     parser = argparse.ArgumentParser(description='Calculate the Strahler and Shreve stream orders for the given river segments in GeoJSON.')
     parser.add_argument('-v','--verbose', help="increase output verbosity", action='store_true')
     parser.add_argument('-t','--time', help="calculate and display time taken", action='store_true')
+    parser.add_argument('-n','--ndjson', help="write newline delimited geojson instead of a FeatureCollection", action='store_true')
+    parser.add_argument('-c','--columnar', help="use the compact columnar NumPy representation of the river graph", action='store_true')
+    parser.add_argument('--cache', help="in columnar mode, keep a memory mapped cache of the river graph next to the input and reuse it while the input is unchanged", action='store_true')
+    parser.add_argument('--cache-dir', help="the directory to keep the caches in instead of next to the inputs")
+    parser.add_argument('--sidecar', help="write a sidecar with the river graph and orders next to the output, which --update can apply edits to later (implies --columnar)", action='store_true')
+    parser.add_argument('--update', metavar='DIFF', help="apply the added, modified and removed (null geometry) features in DIFF to the given outputs with sidecars, recalculating only the orders downstream of the edits")
+    parser.add_argument('--id-property', default='ARCID', help="the property that identifies a segment in the sidecar and the diff")
+    parser.add_argument('-m','--measures', type=measureNames, metavar='NAME[,NAME...]', help="also calculate these comma separated measures of every segment in the same pass as the orders and add them to its properties (implies --columnar), or all of them with 'all': " + ', '.join(name + ' (' + prop + ')' for name, prop in MEASURES.items()))
+    parser.add_argument('--snap', type=float, default=0, help="join segment endpoints that are within this distance of each other (in coordinate units), so small coordinate noise doesn't break the network")
+    parser.add_argument('-j','--jobs', type=int, default=1, help="the number of worker processes, used for the files or, for a single file, for its separate drainage basins, which needs --columnar (or --sidecar or --measures)")
     parser.add_argument('files', type=argparse.FileType('r'), nargs='+', help='one or more geojson files')
+    instrument.addArguments(parser)
     args = parser.parse_args()
 
-    main(args)
+    instrument.runProfiled(args.profile, main, args)
     
\ No newline at end of file
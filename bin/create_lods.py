@@ -2,308 +2,310 @@
 
 import os
 import sys
-import regex
-import datetime
 import argparse
 import json
 import numpy as np
 import struct
-
-def writeHeader(output_name, feature_table_length):
-  total_length = 44 + feature_table_length
-  with open(output_name, 'wb') as output_file:
-    magic = 'vctr'
-
-    # magic	4-byte ANSI string	"vctr". This can be used to identify the arraybuffer as a Vector tile.
-    output_file.write(struct.pack('4s', magic.encode('utf-8')))
-    # version	uint32	The version of the Vector Data format. It is currently 1.
-    output_file.write(struct.pack('I', 1))
-    # byteLength	uint32	The length of the entire tile, including the header, in bytes.
-    output_file.write(struct.pack('I', total_length))
-    # featureTableJSONByteLength	uint32	The length of the feature table JSON section in bytes.
-    output_file.write(struct.pack('I', feature_table_length))
-    # featureTableBinaryByteLength	uint32	The length of the feature table binary section in bytes. 
-    # If featureTableJSONByteLength is zero, this will also be zero.
-    output_file.write(struct.pack('I', 0))
-    # batchTableJSONByteLength	uint32	The length of the batch table JSON section in bytes. 
-    # Zero indicates that there is no batch table.
-    output_file.write(struct.pack('I', 0))
-    # batchTableBinaryByteLength	uint32	The length of the batch table binary section in bytes. 
-    # If batchTableJSONByteLength is zero, this will also be zero.
-    output_file.write(struct.pack('I', 0))
-    # polygonIndicesByteLength	uint32	The length of the polygon indices buffer in bytes.
-    output_file.write(struct.pack('I', 0))
-    # polygonPositionsByteLength	uint32	The length of the polygon positions buffer in bytes.
-    output_file.write(struct.pack('I', 0))
-    # polylinePositionsByteLength	uint32	The length of the polyline positions buffer in bytes.
-    output_file.write(struct.pack('I', 0))
-    # pointPositionsByteLength	uint32	The length of the point positions buffer in bytes.
-    output_file.write(struct.pack('I', 0))
-
-def writeBody(output_name):  
-  region = [0.0, 0.0, 3.1, 3.1, 0.0, 11.0]
-  center = [2.05, 2.05, 5.5]
-  polygon1 = {
-    'properties': { 'name': 'poly1', 'area': 4 },
-    'positions': [[1.0, 1.0, 0.0], [2.0, 2.0, 0.0], [3.0, 3.0, 0.0]],
-    'indices': [0, 1, 2, 0],
-    'minimum_height': 0.0,
-    'maximum_height': 0.0
-  }  
-  polygon2 = {
-    'properties': {'name': 'poly2', 'area' : 2},
-    'positions': [[1.1, 1.1, 11.0], [2.1, 2.1, 11.0], [3.1, 3.1, 11.0]],
-    'indices': [0, 1, 2, 0],
-    'minimum_height': 11.0,
-    'maximum_height': 11.0
-  }
-  polygons = [polygon1, polygon2]
-
-  polyline1 = {
-    'properties': { 'name': 'line1' },
-    'positions': [[1.0, 1.0, 0.0], [2.0, 2.0, 0.0], [3.0, 3.0, 0.0]]
-  } 
-  polyline2 = {
-    'properties': { 'name': 'line2' },
-    'positions': [[1.1, 1.1, 11.0], [2.1, 2.1, 11.0], [3.1, 3.1, 11.0]]
-  } 
-  
-  point1 = {
-    'properties': { 'name': 'point1' },
-    'position': [1.0, 1.0, 0.0]
-  } 
-  point2 = {
-    'properties': { 'name': 'point2', 'suddenAttribute': 'argh' },
-    'positions': [1.1, 1.1, 11.0]
-  } 
-
-  polylines = [polyline1, polyline2]
-  points = [point1, point2]
-
-  json_batch_table = constructBatchTableHeader(polygons, polylines, points)
-  batch_binary = constructBatchTableBinary(polygons, polylines, points)
-
-  print('batch table length: ' + str(len(json_batch_table)))
-  print('batch table binary length: ' + str(len(batch_binary)))
-
-  json_feature_table = constructFeatureTableHeader(region, center, polygons, polylines, points)
-  feature_binary = constructFeatureTableBinary(polygons, polylines, points)
-
-  print('feature table length: ' + str(len(json_feature_table)))
-  print('feature table binary length: ' + str(len(feature_binary)))
-
-  print(json_batch_table)
-  print(json_feature_table)
-
-def constructFeatureTableHeader(region, center, polygons, polylines, points):
-  polygon_counts = []
-  polygon_index_counts = []  
-  polygon_minimum_heights = []
-  polygon_maximum_heights = []
-  polygon_batch_ids = []
-
+import bisect
+
+from geojson_io import readFeatures, FeatureWriter, dumps
+from simplify import simplifyFeatures, lodTolerances, parseFilter
+import river_cache
+import river_index
+import instrument
+
+# The largest quantized position value, positions are stored as uint16 u, v (and height)
+# values between 0 and MAX_SHORT relative to the REGION of the tile
+MAX_SHORT = 32767
+
+# The feature and batch table sections of the tile start on an 8-byte boundary. The geometry
+# sections that follow are not padded: their lengths give the number of indices and positions,
+# and uint32 indices followed by uint16 positions stay aligned to their own size.
+ALIGNMENT = 8
+
+def constructHeader(sections):
+  # sections are the encoded featureTableJSON, featureTableBinary, batchTableJSON, batchTableBinary,
+  # polygonIndices, polygonPositions, polylinePositions and pointPositions, in that order
+  lengths = [len(s) for s in sections]
+  total_length = 44 + sum(lengths)
+
+  # magic	4-byte ANSI string	"vctr". This can be used to identify the arraybuffer as a Vector tile.
+  # version	uint32	The version of the Vector Data format. It is currently 1.
+  # byteLength	uint32	The length of the entire tile, including the header, in bytes.
+  # featureTableJSONByteLength	uint32	The length of the feature table JSON section in bytes.
+  # featureTableBinaryByteLength	uint32	The length of the feature table binary section in bytes.
+  # If featureTableJSONByteLength is zero, this will also be zero.
+  # batchTableJSONByteLength	uint32	The length of the batch table JSON section in bytes.
+  # Zero indicates that there is no batch table.
+  # batchTableBinaryByteLength	uint32	The length of the batch table binary section in bytes.
+  # If batchTableJSONByteLength is zero, this will also be zero.
+  # polygonIndicesByteLength	uint32	The length of the polygon indices buffer in bytes.
+  # polygonPositionsByteLength	uint32	The length of the polygon positions buffer in bytes.
+  # polylinePositionsByteLength	uint32	The length of the polyline positions buffer in bytes.
+  # pointPositionsByteLength	uint32	The length of the point positions buffer in bytes.
+  return struct.pack('<4sI', b'vctr', 1) + struct.pack('<9I', total_length, *lengths)
+
+# Encode polygons, polylines and points into a vctr tile. Positions are [longitude, latitude, height]
+# in degrees and meters, polygons also need the triangle 'indices' into their own positions.
+# The region defaults to the bounds of all positions.
+def encodeTile(polygons, polylines, points, region=None, center=None):
+  if region is None:
+    region = computeRegion(polygons, polylines, points)
+
+  # The batch table assigns the batch ids of the features
+  json_batch_table, batch_binary = constructBatchTable(polygons, polylines, points)
+
+  feature_binary, references = constructFeatureTableBinary(polygons, polylines, points)
+  json_feature_table = constructFeatureTableHeader(region, center, polygons, polylines, points, references)
+
+  polygon_positions = [p['positions'] for p in polygons]
+  polygon_indices = []
+  offset = 0
   for p in polygons:
-    polygon_counts.append(len(p['positions']))
-    polygon_index_counts.append(len(p['indices']))
-
-    if p['minimum_height']: 
-      polygon_minimum_heights.append(p['minimum_height'])
-    else:
-      polygon_minimum_heights.append(0.0)
-
-    if p['maximum_height']: 
-      polygon_maximum_heights.append(p['maximum_height'])
-    else:
-      polygon_maximum_heights.append(0.0)
-      
-    if p['batch_id']: 
-      polygon_batch_ids.append(p['batch_id'])
-    else:
-      polygon_batch_ids.append(0)
-
-  polyline_counts = []
-  polyline_batch_ids = []
-
-  for p in polylines:
-    polyline_counts.append(len(p['positions']))
-    
-    if p['batch_id']: 
-      polyline_batch_ids.append(p['batch_id'])
-    else:
-      polyline_batch_ids.append(0)
-
-  point_batch_ids = []
-
-  for p in points:    
-    if p['batch_id']: 
-      point_batch_ids.append(p['batch_id'])
-    else:
-      point_batch_ids.append(0)
-
-
+    polygon_indices.append(np.asarray(p['indices'], dtype=np.uint32) + offset)
+    offset += len(p['positions'])
+
+  sections = [
+    json_feature_table.encode('utf-8'),
+    feature_binary,
+    json_batch_table.encode('utf-8') if polygons or polylines or points else b'',
+    batch_binary,
+    concatenate(polygon_indices, np.uint32).tobytes(),
+    encodePositions(polygon_positions, region, heights=False),
+    encodePositions([p['positions'] for p in polylines], region),
+    encodePositions([[p['position']] for p in points], region)
+  ]
+
+  # The JSON sections are padded relative to the start of the tile, after the 44 byte header
+  offset = 44
+  for i, s in enumerate(sections[:4]):
+    sections[i] = padToByte(s, offset if i in (0, 2) else None)
+    offset += len(sections[i])
+
+  return constructHeader(sections) + b''.join(sections)
+
+def writeTile(output_name, polygons, polylines, points, region=None, center=None):
+  tile = encodeTile(polygons, polylines, points, region, center)
+  with open(output_name, 'wb') as output_file:
+    output_file.write(tile)
+  return tile
+
+def concatenate(arrays, dtype):
+  if not arrays:
+    return np.zeros(0, dtype=dtype)
+  return np.concatenate([np.asarray(a, dtype=dtype) for a in arrays])
+
+# The REGION of a tile: west, south, east, north in radians and the minimum and maximum height
+def computeRegion(polygons, polylines, points):
+  positions = [p['positions'] for p in polygons] + [p['positions'] for p in polylines] + [[p['position']] for p in points]
+  positions = concatenate([np.asarray(p, dtype=np.float64).reshape(-1, 3) for p in positions if len(p)], np.float64).reshape(-1, 3)
+  if len(positions) == 0:
+    return [0.0, 0.0, 0.0, 0.0, 0.0, 0.0]
+
+  lower = positions.min(axis=0)
+  upper = positions.max(axis=0)
+  return [np.radians(lower[0]), np.radians(lower[1]), np.radians(upper[0]), np.radians(upper[1]), lower[2], upper[2]]
+
+# Quantize positions to the region and zig-zag delta encode them. The u (longitude) values of all
+# positions come first, then the v (latitude) values and, with heights, the height values.
+def encodePositions(positionLists, region, heights=True):
+  positions = [np.asarray(p, dtype=np.float64).reshape(-1, 3) for p in positionLists if len(p)]
+  if not positions:
+    return b''
+  positions = np.concatenate(positions)
+
+  west, south, east, north, minimum_height, maximum_height = region
+  columns = [
+    quantize(np.radians(positions[:, 0]), west, east),
+    quantize(np.radians(positions[:, 1]), south, north)
+  ]
+  if heights:
+    columns.append(quantize(positions[:, 2], minimum_height, maximum_height))
+
+  return np.concatenate([zigZagDeltaEncode(c) for c in columns]).tobytes()
+
+def quantize(values, lower, upper):
+  extent = upper - lower
+  if extent <= 0:
+    return np.zeros(len(values), dtype=np.int32)
+  return np.clip(np.round((values - lower) / extent * MAX_SHORT), 0, MAX_SHORT).astype(np.int32)
+
+def zigZagDeltaEncode(values):
+  deltas = np.diff(values, prepend=0).astype(np.int32)
+  return ((deltas << 1) ^ (deltas >> 31)).astype(np.uint16)
+
+# Convert a LineString or MultiLineString feature into polylines for a vctr tile
+def featureToPolylines(feature):
+  geometry = feature.get('geometry') or {}
+  coordinates = geometry.get('coordinates') or []
+  if geometry.get('type') == 'LineString':
+    coordinates = [coordinates]
+  elif geometry.get('type') != 'MultiLineString':
+    return []
+
+  polylines = []
+  for line in coordinates:
+    positions = np.zeros((len(line), 3))
+    positions[:, :2] = [c[:2] for c in line]
+    if len(line) and len(line[0]) > 2:
+      positions[:, 2] = [c[2] for c in line]
+    polylines.append({'properties': feature.get('properties'), 'positions': positions})
+  return polylines
+
+def constructFeatureTableHeader(region, center, polygons, polylines, points, references):
   header = {
-    #   'REGION': struct.pack('6f', *region),
-    'REGION': region,
-    #   'RTC_CENTER': struct.pack('3f', *center),
-    'RTC_CENTER': center,
-    #   'POLYGONS_LENGTH': struct.pack('I', len(polygons)),
+    'REGION': [float(r) for r in region],
     'POLYGONS_LENGTH': len(polygons),
-    #   'POLYLINES_LENGTH': struct.pack('I', len(polylines)),
     'POLYLINES_LENGTH': len(polylines),
-    #   'POINTS_LENGTH': struct.pack('I', len(points)),
     'POINTS_LENGTH': len(points),
-
-    # POLYGON_COUNTS	uint32[]	The number of vertices that belong to each polygon. This refers to the polygon 
-    # section of the positions buffer in the body. Each polygon count refers to a contiguous number of vertices 
-    # in the position buffer that represents the polygon.	
-    # ✅ Yes, when the global POLYGONS_LENGTH is greater than zero.
-    #   'POLYGON_COUNTS': struct.pack('%sL' % len(polygon_counts), *polygon_counts),
-    'POLYGON_COUNTS': polygon_counts,
-
-    # POLYGON_INDEX_COUNTS	uint32[]	The number of indices that belong to each polygon. This refers to the indices 
-    # buffer of the body. Each index count refers to a contiguous number of indices that represent the triangulated polygon.	
-    # ✅ Yes, when the global POLYGONS_LENGTH is greater than zero.
-    #   'POLYGON_INDEX_COUNTS': struct.pack('%sL' % len(polygon_index_counts), *polygon_index_counts),
-    'POLYGON_INDEX_COUNTS': polygon_index_counts,
-
-    # POLYGON_MINIMUM_HEIGHTS	float32[]	The minimum height of each polygon in meters above the WGS84 ellipsoid.	
-    # 🔴 No. If the minimum height for each polygon is not specified, the global MINIMUM_HEIGHT will be used.
-    # #   'POLYGON_MINIMUM_HEIGHTS': struct.pack('%sf' % len(polygon_minimum_heights), *polygon_minimum_heights),    
-    'POLYGON_MINIMUM_HEIGHTS': polygon_minimum_heights,
-
-    # POLYGON_MAXIMUM_HEIGHTS	float32[]	The maximum height of each polygon in meters above the WGS84 ellipsoid.	
-    # 🔴 No. If the maximum height for each polygon is not specified, the global MAXIMUM_HEIGHT will be used.
-    #   'POLYGON_MAXIMUM_HEIGHTS': struct.pack('%sf' % len(polygon_maximum_heights), *polygon_maximum_heights),
-    'POLYGON_MAXIMUM_HEIGHTS': polygon_maximum_heights,
-
-    # POLYGON_BATCH_IDS	uint16[]	The batchId of the polygon that can be used to retrieve metadata from the Batch Table.	
-    # 🔴 No
-    #   'POLYGON_BATCH_IDS': struct.pack('%sI' % len(polygon_batch_ids), *polygon_batch_ids),
-    'POLYGON_BATCH_IDS': polygon_batch_ids,
-
-    # POLYLINE_COUNTS	uint32[]	The number of vertices that belong to each polyline. This refers to the polyline section 
-    # of the positions buffer in the body. Each polyline count refers to a contiguous number of vertices in the position 
-    # buffer that represents the polyline. From the first point on the polyline, each successive point creates a segment 
-    # connected to the previous.	
-    # ✅ Yes, when the global POLYLINES_LENGTH is greater than zero.
-    #   'POLYLINE_COUNTS': struct.pack('%sL' % len(polyline_counts), *polyline_counts),
-    'POLYLINE_COUNTS': polyline_counts,
-
-    # POLYLINE_BATCH_IDS	uint16[]	The batchId of the polyline that can be used to retrieve metadata from the Batch Table.	
-    # 🔴 No
-    #   'POLYLINE_BATCH_IDS': struct.pack('%sI' % len(polyline_batch_ids), *polyline_batch_ids),
-    'POLYLINE_BATCH_IDS': polyline_batch_ids,
-
-    # POINT_BATCH_IDS	uint16[]	The batchId of the point that can be used to retrieve metadata from the Batch Table.	
-    # 🔴 No
-    #   'POINT_BATCH_IDS': struct.pack('%sI' % len(point_batch_ids), *point_batch_ids)
-    'POINT_BATCH_IDS': point_batch_ids
   }
-  return json.dumps(header)
+
+  # RTC_CENTER	float32[3]	The center of the tile, Cesium derives it from the REGION when it is left out.
+  if center is not None:
+    header['RTC_CENTER'] = [float(c) for c in center]
+
+  # POLYGON_COUNTS	uint32[]	The number of vertices that belong to each polygon. This refers to the polygon 
+  # section of the positions buffer in the body. Each polygon count refers to a contiguous number of vertices 
+  # in the position buffer that represents the polygon.	
+  # POLYGON_INDEX_COUNTS	uint32[]	The number of indices that belong to each polygon. This refers to the indices 
+  # buffer of the body. Each index count refers to a contiguous number of indices that represent the triangulated polygon.	
+  # POLYGON_MINIMUM_HEIGHTS	float32[]	The minimum height of each polygon in meters above the WGS84 ellipsoid.	
+  # POLYGON_MAXIMUM_HEIGHTS	float32[]	The maximum height of each polygon in meters above the WGS84 ellipsoid.	
+  # POLYGON_BATCH_IDS	uint16[]	The batchId of the polygon that can be used to retrieve metadata from the Batch Table.	
+  # POLYLINE_COUNTS	uint32[]	The number of vertices that belong to each polyline. This refers to the polyline section 
+  # of the positions buffer in the body. Each polyline count refers to a contiguous number of vertices in the position 
+  # buffer that represents the polyline. From the first point on the polyline, each successive point creates a segment 
+  # connected to the previous.	
+  # POLYLINE_BATCH_IDS	uint16[]	The batchId of the polyline that can be used to retrieve metadata from the Batch Table.	
+  # POINT_BATCH_IDS	uint16[]	The batchId of the point that can be used to retrieve metadata from the Batch Table.	
+  # The arrays are stored in the feature table binary, the JSON only refers to them.
+  header.update(references)
+
+  return json.dumps(header, separators=(',', ':'))
 
 def constructFeatureTableBinary(polygons, polylines, points):
-  stuff = ''
-  result = struct.pack('%ss' % len(stuff), stuff.encode('utf-8'))
-
-  return padToByte(result)
-
-def constructBatchTableHeader(polygons, polylines, points):
-  batch = {'id' : []}
-  i = 0
-  
-  addBatchedKeys(batch, polygons)
-  addBatchedKeys(batch, polylines)
-  addBatchedKeys(batch, points)
-
-  i = addBatchedProperties(batch, i, polygons)  
-  i = addBatchedProperties(batch, i, polylines)  
-  i = addBatchedProperties(batch, i, points)
-
-  return json.dumps(batch)
-
-def constructBatchTableBinary(polygons, polylines, points):
-  stuff = ''
-  result = struct.pack('%ss' % len(stuff), stuff.encode('utf-8'))
-
-  return padToByte(result)
-
-def addBatchedKeys(batch, propsObjectList):
-  for p in propsObjectList:
-    if 'properties' in p.keys():      
-      for key in p['properties']:        
-        if not key in batch:
-          batch[key] = []
-
-def addBatchedProperties(batch, i, propsObjectList):
-  for p in propsObjectList:
-    if 'properties' in p.keys():
-      p['batch_id'] = i
-      batch['id'].append(i)
-      i += 1
-
-      for key in p['properties']:
-        batch[key].append(p['properties'][key])
-      for key in batch:
-        if not key == 'id' and not key in p['properties']:
-          batch[key].append(None)
-  return i
-
-def padToByte(binary):
-  result = ''
-  filler = 4 - len(binary) % 4
-  extra_spaces = ''
-  if not filler == 4:
-    for i in range(0, filler):
-      extra_spaces = extra_spaces + ' '
-  
-  result = binary + struct.pack('%ss' % len(extra_spaces), extra_spaces.encode('utf-8'))  
-  return result
-    
-template = {
-  'asset': { 'version': '1.0' },
-  'geometricError': 500,
-  'root': {
-    'transform': [
-      # 16 numbers comma separated
-    ],
-    'boundingVolume': {
-      'box': [
-        # 16 numbers comma separated
-      ]
-    },
-    'geometricError': 100,
-    'refine': 'REPLACE',
-    'content': {
-      'url': ''
-    },
-    'children': [
-      {
-        'boundingVolume': {
-          'box': [
-            # 16 numbers comma separated
-          ]
-        },
-        'geometricError': 10,
-        'content': {
-          'url': ''
-        },
-        'children': [
-          {
-            'boundingVolume': {
-              'box': [
-                # 16 numbers comma separated
-              ]
-            },
-            'geometricError': 0,
-            'content': {
-              'url': ''
-            }
-          }
-        ]
-      }
-    ]
-  }
-}
+  arrays = []
+  if polygons:
+    arrays.append(('POLYGON_COUNTS', np.array([len(p['positions']) for p in polygons], dtype=np.uint32)))
+    arrays.append(('POLYGON_INDEX_COUNTS', np.array([len(p['indices']) for p in polygons], dtype=np.uint32)))
+    arrays.append(('POLYGON_MINIMUM_HEIGHTS', np.array([p.get('minimum_height') or 0.0 for p in polygons], dtype=np.float32)))
+    arrays.append(('POLYGON_MAXIMUM_HEIGHTS', np.array([p.get('maximum_height') or 0.0 for p in polygons], dtype=np.float32)))
+  if polylines:
+    arrays.append(('POLYLINE_COUNTS', np.array([len(p['positions']) for p in polylines], dtype=np.uint32)))
+
+  # Batch ids are uint16 unless there are too many features to fit
+  batch_type = np.uint16 if len(polygons) + len(polylines) + len(points) <= 65535 else np.uint32
+  for name, features in (('POLYGON_BATCH_IDS', polygons), ('POLYLINE_BATCH_IDS', polylines), ('POINT_BATCH_IDS', points)):
+    if features:
+      arrays.append((name, np.array([p.get('batch_id', 0) for p in features], dtype=batch_type)))
+
+  binary = b''
+  references = {}
+  for name, values in arrays:
+    binary = padToByte(binary)
+    references[name] = {'byteOffset': len(binary)}
+    if values.dtype == np.uint32 and name.endswith('_BATCH_IDS'):
+      references[name]['componentType'] = 'UNSIGNED_INT'
+    binary += values.tobytes()
+
+  return binary, references
+
+# The binary batch table component types of integer columns, smallest first
+INTEGER_TYPES = [
+  ('UNSIGNED_BYTE', np.uint8), ('BYTE', np.int8), ('UNSIGNED_SHORT', np.uint16),
+  ('SHORT', np.int16), ('UNSIGNED_INT', np.uint32), ('INT', np.int32)
+]
+
+class BatchColumn(object):
+  '''The values of one property of the features of a tile, with the batch ids of the features
+  that have it. The rows without a value become null.'''
+
+  def __init__(self, rows, values):
+    self.rows = rows
+    self.values = values
+
+  def kind(self):
+    types = set(map(type, self.values))
+    if types <= {int}:
+      return 'integer'
+    if types <= {int, float}:
+      return 'number'
+    return 'json'
+
+  # The values of all rows as a list, None where a feature doesn't have the property
+  def toList(self, rows):
+    if len(self.rows) == rows:
+      return self.values
+    column = [None] * rows
+    for row, value in zip(self.rows, self.values):
+      column[row] = value
+    return column
+
+  # The component type and typed array of the column for the binary batch table, or None, None
+  # when the column can't be one: it isn't numeric or some features don't have it
+  def toArray(self, rows, kind=None):
+    kind = kind or self.kind()
+    if kind not in ('integer', 'number') or len(self.rows) != rows or not rows:
+      return None, None
+    if kind == 'integer':
+      try:
+        values = np.fromiter(self.values, dtype=np.int64, count=rows)
+      except OverflowError:
+        return 'DOUBLE', np.array(self.values, dtype=np.float64)
+      lower, upper = values.min(), values.max()
+      for componentType, dtype in INTEGER_TYPES:
+        if np.iinfo(dtype).min <= lower and upper <= np.iinfo(dtype).max:
+          return componentType, values.astype(dtype)
+    return 'DOUBLE', np.array(self.values, dtype=np.float64)
+
+# Assign the batch ids of the features and build the batch table JSON and binary from their
+# properties. Every property is added once, to the column of its key, so features are never
+# padded with the keys they don't have. Numeric properties that every feature has are stored
+# in the binary as typed arrays, the others as JSON arrays with null where a feature doesn't
+# have the property.
+def constructBatchTable(polygons, polylines, points):
+  # The batch ids and the values of every key
+  columns = {}
+  rows = 0
+  for features in (polygons, polylines, points):
+    # Every feature gets a batch id, also when it has no properties
+    for p in features:
+      p['batch_id'] = rows
+      properties = p.get('properties')
+      if properties:
+        for key, value in properties.items():
+          column = columns.get(key)
+          if column is None:
+            column = columns[key] = ([], [])
+          column[0].append(rows)
+          column[1].append(value)
+      rows += 1
+
+  batch_type = INTEGER_TYPES[2] if rows <= 65535 else INTEGER_TYPES[4]
+  batch = {}
+  binary = b''
+  # The id column holds the batch ids, unless the features have id properties of their own
+  arrays = [('id', batch_type[0], np.arange(rows, dtype=batch_type[1]))] if rows and 'id' not in columns else []
+  for key, (batch_ids, values) in columns.items():
+    column = BatchColumn(batch_ids, values)
+    componentType, array = column.toArray(rows)
+    if array is None:
+      batch[key] = column.toList(rows)
+    else:
+      arrays.append((key, componentType, array))
+
+  for key, componentType, values in arrays:
+    binary = padToByte(binary)
+    batch[key] = {'byteOffset': len(binary), 'componentType': componentType, 'type': 'SCALAR'}
+    binary += values.tobytes()
+
+  return json.dumps(batch), padToByte(binary)
+
+# Pad a section to the next 8-byte boundary. JSON sections are padded with spaces, relative to
+# the offset the section starts at in the tile, binary sections with zeros.
+def padToByte(binary, offset=None):
+  filler = (ALIGNMENT - (len(binary) + (offset or 0)) % ALIGNMENT) % ALIGNMENT
+  return binary + (b' ' if offset is not None else b'\0') * filler
 
 def is_dir(dirname):
     # Checks if a path is an actual directory
@@ -313,68 +315,167 @@ def is_dir(dirname):
     else:
         return dirname
 
-def write_lods(input_file, lod_files):
-    for l in input_file:
-        l = l.rstrip()
-        if not l: continue
-
-        # Get the Strahler Order
-        match1 = regex.search(r'"SHREVE":(.*?)}', l)
-        match2 = regex.search(r'"STRAHLER":(.*?),', l)
-        
-        if match1 and match2:
-            shreve = eval(match1.group(1))
-            strahler = eval(match2.group(1))
-
-            # always write to the highest LOD
-            length = len(lod_files)
-            lod_files[length-1].write(l + '\n')
-            
-            # write the lines with higher strahler orders to the other LODS
-            for i, f in enumerate(lod_files):
-                if shreve > (length - i):
-                    lod_files[i-1].write(l + '\n')
+# Read the features to split. When chain_rivers.py left a river graph cache with stream orders
+# for the input, the orders are taken from there and only the byte ranges of the features are read.
+# With a bounding box, only the features that intersect it are read: just their byte ranges when
+# the file has a spatial index (see river_index.py), otherwise the whole file is filtered
+def readLodFeatures(input_file, bbox=None):
+    if bbox:
+        index = river_index.loadIndex(input_file.name)
+        if index:
+            return river_index.readFeatures(input_file.name, index, bbox)
+        return (feature for feature in readLodFeatures(input_file) if river_index.intersects(river_index.featureBounds(feature), bbox))
+
+    graph = river_cache.loadCache(input_file.name, arrays=river_cache.GRAPH_ARRAYS + river_cache.ORDER_ARRAYS)
+    if graph:
+        return river_cache.readCachedFeatures(input_file.name, graph)
+    return readFeatures(input_file)
+
+# The order thresholds of the LODs, from the coarsest to the most detailed LOD. A feature
+# is written to every LOD whose threshold its order meets, the last LOD holds all features.
+# Log spacing suits Shreve orders, which grow with the number of sources upstream,
+# linear spacing suits Strahler orders.
+def lodThresholds(lods, spacing='log', base=2):
+    if spacing == 'log':
+        return [base ** (lods - 1 - i) for i in range(lods)]
+    return [lods - i for i in range(lods)]
+
+def parseThresholds(text):
+    thresholds = [float(t) for t in text.split(',')]
+    if thresholds != sorted(thresholds, reverse=True):
+        raise argparse.ArgumentTypeError('thresholds should be given from the coarsest (highest) to the most detailed LOD')
+    return thresholds
+
+# The number of features that are simplified together
+BATCH_SIZE = 10000
+
+# Route every feature to all LODs whose threshold its order meets, in a single pass.
+# Without tolerances each feature is encoded once and handed to the buffered writers of the LODs.
+# With tolerances, the features are simplified in batches with the tolerance of every LOD first.
+# With lod_tiles, the polylines of every LOD are collected for a vctr tile as well.
+def write_lods(features, lod_writers, thresholds, order='SHREVE', lod_tiles=None, tolerances=None):
+    # The thresholds are descending, so negating them gives an ascending list to bisect
+    negated = [-t for t in thresholds]
+    counts = [0] * len(lod_writers)
+    batch = []
+
+    for feature in features:
+        properties = feature.get('properties') or {}
+        value = properties.get(order)
+        if value is None:
+            continue
+
+        first = bisect.bisect_left(negated, -value)
+        if first == len(lod_writers):
+            continue
+
+        if tolerances:
+            batch.append((feature, first))
+            if len(batch) >= BATCH_SIZE:
+                write_simplified(batch, lod_writers, counts, lod_tiles, tolerances)
+                batch = []
+            continue
+
+        data = dumps(feature)
+        for i in range(first, len(lod_writers)):
+            lod_writers[i].writeEncoded(data)
+            counts[i] += 1
+
+        if lod_tiles is not None:
+            polylines = featureToPolylines(feature)
+            for i in range(first, len(lod_tiles)):
+                lod_tiles[i].extend(polylines)
+
+    if batch:
+        write_simplified(batch, lod_writers, counts, lod_tiles, tolerances)
+
+    return counts
+
+def write_simplified(batch, lod_writers, counts, lod_tiles, tolerances):
+    for i, w in enumerate(lod_writers):
+        members = [feature for feature, first in batch if first <= i]
+        for feature in simplifyFeatures(members, tolerances[i]):
+            w.write(feature)
+            if lod_tiles is not None:
+                lod_tiles[i].extend(featureToPolylines(feature))
+        counts[i] += len(members)
 
 def main(args):
-    if (False):
-        for f in args.files:
-            # Get the basename for this file, add '_out' to it for the output file
-            input_name = os.path.basename(f.name)
-            base_name = os.path.splitext(input_name)[0]
-
-            lod_files = []
-            for i in range(1, args.lods+1):
-                name = args.output_dir + base_name + '_lod'+str(i)+'.json'
-                o = open(name, 'w+')
+    thresholds = args.thresholds or lodThresholds(args.lods, args.spacing, args.base)
+    order = args.order.upper()
+    tolerances = lodTolerances(args.simplify, len(thresholds), args.simplify_factor) if args.simplify else None
+    runs = []
+
+    for f in args.files:
+        # Get the basename for this file, add '_lod<i>' to it for the output files
+        input_name = os.path.basename(f.name)
+        base_name = os.path.splitext(input_name)[0]
+        extension = '.ndjson' if args.ndjson else '.json'
+
+        metrics = instrument.Metrics(f.name, args.time, args.verbose, args.tracemalloc)
+        metrics.start('LOD split')
+
+        lod_files = []
+        lod_writers = []
+        try:
+            for i in range(1, len(thresholds)+1):
+                name = os.path.join(args.output_dir, base_name + '_lod' + str(i) + extension)
+                o = open(name, 'wb')
                 lod_files.append(o)
-                
-                # Write geojson prefix
-                o.write('{"type":"FeatureCollection", "features": [\n')
-                
-            # Write lines
-            write_lods(f, lod_files)
-
-            # And add a postfix
-            for i in range(1, args.lods+1):
-                f = lod_files[i-1]
-                print(f)
-                last_line = f.seek(-3,2).read()
-                # last_chars = regex.search(r'.{0,2}\z', lod_files[i-1].readline())
-                print ('last ::'+ str(last_line) + '::')
-
-                lod_files[i-1].write(']}\n\n')
+                lod_writers.append(FeatureWriter(o, args.ndjson))
+
+            lod_tiles = [[] for t in thresholds] if args.vctr else None
+            progress = metrics.progress('features read')
+            features = progress.track(readLodFeatures(f, args.bbox))
+            if args.filter:
+                features = (feature for feature in features if args.filter(feature))
+
+            counts = write_lods(features, lod_writers, thresholds, order, lod_tiles, tolerances)
+
+            # The writers close the feature collections
+            for w in lod_writers:
+                w.close()
+        finally:
+            for o in lod_files:
+                o.close()
+
+        metrics.stop(progress.count)
+        metrics.count(features=progress.count, **dict(('lod' + str(i+1), count) for i, count in enumerate(counts)))
+
+        if (args.vctr):
+            metrics.start('vctr encoding')
+            for i, polylines in enumerate(lod_tiles):
+                writeTile(os.path.join(args.output_dir, base_name + '_lod' + str(i+1) + '.vctr'), [], polylines, [])
+            metrics.stop(sum(len(polylines) for polylines in lod_tiles))
+
+        if (args.verbose):
+            for i, (t, count) in enumerate(zip(thresholds, counts)):
+                print (base_name + '_lod' + str(i+1) + extension + ': ' + str(count) + ' features with ' + order + ' >= ' + str(t))
+
+        runs.append(metrics.report())
+
+    if args.metrics:
+        instrument.writeReport(args.metrics, 'create_lods', runs)
 
 if __name__ == "__main__":
     # parse arguments
-    parser = argparse.ArgumentParser(description='Calculate the Strahler and Shreve stream orders for the given river segments in GeoJSON.')
-    # parser.add_argument('-l','--lods', type=int, default=11)
-    # parser.add_argument('-o','--output_dir', type=is_dir, help='The output directory', default='.')
-    # parser.add_argument('files', type=argparse.FileType('r'), nargs='+', help='One or more geojson files')
+    parser = argparse.ArgumentParser(description='Split river segments with Strahler and Shreve stream orders into levels of detail.')
+    parser.add_argument('-v','--verbose', help="increase output verbosity", action='store_true')
+    parser.add_argument('-t','--time', help="calculate and display time taken", action='store_true')
+    parser.add_argument('-l','--lods', type=int, default=11, help='the number of LODs')
+    parser.add_argument('--order', choices=['shreve', 'strahler'], default='shreve', help='the stream order the LODs are selected by')
+    parser.add_argument('--spacing', choices=['log', 'linear'], default='log', help='how the order thresholds of the LODs are spaced')
+    parser.add_argument('--base', type=float, default=2, help='the ratio between the thresholds of consecutive LODs with log spacing')
+    parser.add_argument('--thresholds', type=parseThresholds, help='comma separated order thresholds, from the coarsest to the most detailed LOD, instead of --lods and --spacing')
+    parser.add_argument('-n','--ndjson', help="write newline delimited geojson instead of FeatureCollections", action='store_true')
+    parser.add_argument('--filter', type=parseFilter, help='only keep the features whose numeric property passes the filter, e.g. "UP_CELLS > 2000"')
+    parser.add_argument('--bbox', type=river_index.parseBbox, help='only keep the features that intersect west,south,east,north, reading only those when the input has a spatial index (see river_index.py)')
+    parser.add_argument('--simplify', type=float, default=0, help='simplify the most detailed LOD with this tolerance in degrees (Douglas-Peucker)')
+    parser.add_argument('--simplify-factor', type=float, default=2, help='the factor the simplification tolerance grows by for every coarser LOD')
+    parser.add_argument('--vctr', help="also write every LOD as a binary vector tile (vctr)", action='store_true')
+    parser.add_argument('-o','--output_dir', type=is_dir, help='The output directory', default='.')
+    parser.add_argument('files', type=argparse.FileType('r'), nargs='+', help='One or more geojson files')
+    instrument.addArguments(parser)
     args = parser.parse_args()
 
-    # with open('output.vct', 'wb') as output_file: 
-    # writeHeader('output.vct')         
-    writeBody('output.vct')
-
-    main(args)
-    
\ No newline at end of file
+    instrument.runProfiled(args.profile, main, args)
@@ -0,0 +1,328 @@
+#!/usr/bin/env python
+
+# Partition river segments into a quadtree of vctr tiles and describe it in a 3D Tiles tileset.json.
+#
+# Level k of the quadtree holds the features of LOD k+1 (see create_lods.py), so the root tile
+# only has the largest rivers and every level adds the rivers of the next LOD. A feature belongs
+# to the tile that contains the centre of its bounding box. Tiles REPLACE their parent, and the
+# bounding volume of every tile is the region covering its own content and that of its children.
+#
+# The features are streamed into a temporary file (see PolylineStore), so the memory use doesn't
+# grow with the positions and properties of the input, and every tile reads its own polylines
+# back. With --simplify, every polyline is simplified once per tolerance.
+
+import os
+import json
+import math
+import array
+import tempfile
+import argparse
+import numpy as np
+
+from geojson_io import loads
+from simplify import simplifyPolylines, lodTolerances, parseFilter
+import instrument
+import river_index
+from create_lods import lodThresholds, parseThresholds, readLodFeatures, featureToPolylines, encodeTile, computeRegion, is_dir, BATCH_SIZE
+
+# The radius of the earth in meters, used to express the geometric error in meters
+EARTH_RADIUS = 6378137.0
+
+# The geometric error of a tile is its width divided by this, the width of a tile in pixels
+# at which it is just detailed enough
+TILE_RESOLUTION = 256
+
+# The polylines of the features with their LOD, kept in a temporary file while the features
+# stream in, so only the centre, LOD and offsets of every polyline stay in memory. The tiles
+# read the polylines of one quadtree cell at a time back from it. The positions of a polyline
+# are float64 x, y, z triples, the properties of its feature JSON, every record padded to 8 bytes.
+class PolylineStore(object):
+
+    def __init__(self):
+        self.file = tempfile.TemporaryFile()
+        self.size = 0
+        self.offsets = array.array('q')
+        self.counts = array.array('q')
+        self.propertyOffsets = array.array('q')
+        self.propertyLengths = array.array('q')
+        self.centres = array.array('d')
+        self.levels = array.array('i')
+        self.lower = np.full(3, np.inf)
+        self.upper = np.full(3, -np.inf)
+
+    def __len__(self):
+        return len(self.levels)
+
+    def close(self):
+        self.file.close()
+
+    def append(self, data):
+        offset = self.size
+        data += b' ' * (-len(data) % 8)
+        self.file.seek(offset)
+        self.file.write(data)
+        self.size += len(data)
+        return offset
+
+    def read(self, offset, length):
+        self.file.seek(offset)
+        return self.file.read(length)
+
+    def appendPositions(self, positions):
+        return self.append(np.ascontiguousarray(positions, dtype='<f8').tobytes())
+
+    def readPositions(self, offset, count):
+        return np.frombuffer(self.read(offset, count * 24), dtype='<f8').reshape(-1, 3)
+
+    def add(self, feature, level):
+        polylines = [p for p in featureToPolylines(feature) if len(p['positions'])]
+        if not polylines:
+            return
+
+        properties = json.dumps(feature.get('properties'), separators=(',', ':')).encode('utf-8')
+        propertyOffset = self.append(properties)
+        for polyline in polylines:
+            positions = polyline['positions']
+            lower = positions.min(axis=0)
+            upper = positions.max(axis=0)
+            self.lower = np.minimum(self.lower, lower)
+            self.upper = np.maximum(self.upper, upper)
+
+            self.offsets.append(self.appendPositions(positions))
+            self.counts.append(len(positions))
+            self.propertyOffsets.append(propertyOffset)
+            self.propertyLengths.append(len(properties))
+            self.centres.extend((lower[:2] + upper[:2]) / 2)
+            self.levels.append(level)
+
+    # The region of all polylines, as computeRegion gives it
+    def region(self):
+        lower, upper = self.lower, self.upper
+        return [np.radians(lower[0]), np.radians(lower[1]), np.radians(upper[0]), np.radians(upper[1]), lower[2], upper[2]]
+
+    # Simplify the given polylines with a tolerance, a batch at a time, and append the results.
+    # Returns the offsets and counts of the simplified positions, zero for the other polylines.
+    def simplify(self, selected, tolerance):
+        offsets = np.zeros(len(self), dtype=np.int64)
+        counts = np.zeros(len(self), dtype=np.int64)
+        for start in range(0, len(selected), BATCH_SIZE):
+            batch = selected[start:start + BATCH_SIZE]
+            positions = [self.readPositions(self.offsets[i], self.counts[i]) for i in batch]
+            for i, simplified in zip(batch, simplifyPolylines(positions, tolerance)):
+                offsets[i] = self.appendPositions(simplified)
+                counts[i] = len(simplified)
+        return offsets, counts
+
+    # The polylines at the given indices, with the positions at the given offsets and counts
+    def polylines(self, indices, offsets, counts):
+        properties = {}
+        polylines = []
+        for i in indices:
+            key = self.propertyOffsets[i]
+            if key not in properties:
+                properties[key] = loads(self.read(key, self.propertyLengths[i]))
+            polylines.append({'properties': properties[key], 'positions': self.readPositions(offsets[i], counts[i])})
+        return polylines
+
+# Read the features into a PolylineStore, with the index of the coarsest LOD every feature
+# belongs to
+def collectPolylines(features, thresholds, order):
+    store = PolylineStore()
+    for feature in features:
+        value = (feature.get('properties') or {}).get(order)
+        if value is None:
+            continue
+
+        # The thresholds are descending, the first one met is the coarsest LOD
+        level = next((i for i, t in enumerate(thresholds) if value >= t), None)
+        if level is None:
+            continue
+
+        store.add(feature, level)
+
+    return store
+
+# The geometric error of the tiles at a level, in meters
+def geometricError(bounds, level, levels):
+    if level == levels - 1:
+        return 0.0
+
+    west, south, east, north = bounds
+    latitude = math.radians((south + north) / 2)
+    width = EARTH_RADIUS * math.radians(max(east - west, north - south)) * max(math.cos(latitude), 0.1)
+    return width / (2 ** level) / TILE_RESOLUTION
+
+def unionRegion(regions):
+    regions = np.array(regions)
+    return [float(regions[:, 0].min()), float(regions[:, 1].min()), float(regions[:, 2].max()),
+            float(regions[:, 3].max()), float(regions[:, 4].min()), float(regions[:, 5].max())]
+
+# Write one vctr tile per quadtree node that has content, returns the nodes keyed by (level, x, y)
+# With tolerances, every polyline is simplified once per distinct tolerance, for the levels
+# that use it, before the tiles read the polylines of their cell back.
+def writeTiles(store, levels, bounds, output_dir, verbose=False, tolerances=None):
+    west, south, east, north = bounds
+    nodes = {}
+    lodLevels = np.frombuffer(store.levels, dtype=np.int32)
+    centres = np.frombuffer(store.centres, dtype=np.float64).reshape(-1, 2)
+    original = (np.frombuffer(store.offsets, dtype=np.int64), np.frombuffer(store.counts, dtype=np.int64))
+
+    # The quadtree cell of the centre of every polyline at the deepest level, those of the
+    # levels above follow by dropping bits
+    deepest = 2 ** (levels - 1)
+    cellX = np.clip(((centres[:, 0] - west) / max(east - west, 1e-12) * deepest).astype(np.int64), 0, deepest - 1)
+    cellY = np.clip(((centres[:, 1] - south) / max(north - south, 1e-12) * deepest).astype(np.int64), 0, deepest - 1)
+
+    simplified = {}
+    for level in range(levels):
+        selected = np.flatnonzero(lodLevels <= level)
+        if len(selected) == 0:
+            continue
+
+        positions = original
+        if tolerances:
+            tolerance = tolerances[level]
+            if tolerance not in simplified:
+                # All polylines of the levels with this tolerance at once
+                last = max(l for l in range(levels) if tolerances[l] == tolerance)
+                simplified[tolerance] = store.simplify(np.flatnonzero(lodLevels <= last), tolerance)
+            positions = simplified[tolerance]
+
+        size = 2 ** level
+        x = cellX[selected] >> (levels - 1 - level)
+        y = cellY[selected] >> (levels - 1 - level)
+
+        cells, inverse = np.unique(y * size + x, return_inverse=True)
+        order = np.argsort(inverse, kind='stable')
+        starts = np.searchsorted(inverse[order], np.arange(len(cells) + 1))
+
+        for c, cell in enumerate(cells):
+            members = selected[order[starts[c]:starts[c+1]]]
+            tilePolylines = store.polylines(members, *positions)
+            region = computeRegion([], tilePolylines, [])
+
+            key = (level, int(cell % size), int(cell // size))
+            uri = os.path.join('tiles', str(key[0]), str(key[1]), str(key[2]) + '.vctr')
+            name = os.path.join(output_dir, uri)
+            if not os.path.isdir(os.path.dirname(name)):
+                os.makedirs(os.path.dirname(name))
+
+            with open(name, 'wb') as o:
+                o.write(encodeTile([], tilePolylines, [], region))
+
+            nodes[key] = {'region': region, 'uri': uri.replace(os.sep, '/'), 'count': len(members)}
+
+        if (verbose):
+            print ('level ' + str(level) + ': ' + str(len(cells)) + ' tiles, ' + str(len(selected)) + ' polylines')
+
+    return nodes
+
+# Build the tileset.json tree from the written tiles, adding empty ancestors where needed.
+# With root, the tileset of the part of the tree below that tile is built, from nodes in it.
+def buildTileset(nodes, bounds, levels, root=(0, 0, 0)):
+    for key in list(nodes):
+        level, x, y = key
+        while level > root[0]:
+            level, x, y = level - 1, x // 2, y // 2
+            if (level, x, y) not in nodes:
+                nodes[(level, x, y)] = {}
+
+    childKeys = {}
+    for key in nodes:
+        level, x, y = key
+        if level > root[0]:
+            childKeys.setdefault((level - 1, x // 2, y // 2), []).append(key)
+
+    def build(key):
+        level = key[0]
+        node = nodes[key]
+        children = [build(c) for c in sorted(childKeys.get(key, []))]
+
+        regions = [c['boundingVolume']['region'] for c in children]
+        if 'region' in node:
+            regions.append(node['region'])
+
+        tile = {
+            'boundingVolume': { 'region': unionRegion(regions) },
+            'geometricError': geometricError(bounds, level, levels),
+            'refine': 'REPLACE'
+        }
+        if 'uri' in node:
+            tile['content'] = { 'uri': node['uri'] }
+        if children:
+            tile['children'] = children
+        return tile
+
+    return {
+        'asset': { 'version': '1.0' },
+        'geometricError': geometricError(bounds, root[0], levels) * 2,
+        'root': build(root)
+    }
+
+def main(args):
+    thresholds = args.thresholds or lodThresholds(args.lods, args.spacing, args.base)
+    order = args.order.upper()
+    tolerances = lodTolerances(args.simplify, len(thresholds), args.simplify_factor) if args.simplify else None
+    runs = []
+
+    for f in args.files:
+        input_name = os.path.basename(f.name)
+        base_name = os.path.splitext(input_name)[0]
+        output_dir = os.path.join(args.output_dir, base_name)
+
+        metrics = instrument.Metrics(f.name, args.time, args.verbose, args.tracemalloc)
+        metrics.start('Reading')
+
+        features = readLodFeatures(f, args.bbox)
+        if args.filter:
+            features = (feature for feature in features if args.filter(feature))
+
+        store = collectPolylines(features, thresholds, order)
+        metrics.stop(len(store))
+        if not len(store):
+            store.close()
+            print (f.name + ': no features with a ' + order + ' order')
+            continue
+
+        bounds = [math.degrees(r) for r in store.region()[:4]]
+
+        metrics.start('Tiling')
+        try:
+            nodes = writeTiles(store, len(thresholds), bounds, output_dir, args.verbose, tolerances)
+        finally:
+            store.close()
+        tileset = buildTileset(nodes, bounds, len(thresholds))
+
+        with open(os.path.join(output_dir, 'tileset.json'), 'w') as o:
+            json.dump(tileset, o, indent=1)
+
+        metrics.stop(len(store))
+        metrics.count(features=len(store), tiles=len([n for n in nodes.values() if 'uri' in n]))
+        runs.append(metrics.report())
+
+        if (args.verbose):
+            print ('Tileset written to ' + output_dir)
+
+    if args.metrics:
+        instrument.writeReport(args.metrics, 'create_tileset', runs)
+
+if __name__ == "__main__":
+    # parse arguments
+    parser = argparse.ArgumentParser(description='Tile river segments with stream orders into a quadtree of vector tiles with a 3D Tiles tileset.json.')
+    parser.add_argument('-v','--verbose', help="increase output verbosity", action='store_true')
+    parser.add_argument('-t','--time', help="calculate and display time taken", action='store_true')
+    parser.add_argument('-l','--lods', type=int, default=11, help='the number of LODs, which is the depth of the quadtree')
+    parser.add_argument('--order', choices=['shreve', 'strahler'], default='shreve', help='the stream order the LODs are selected by')
+    parser.add_argument('--spacing', choices=['log', 'linear'], default='log', help='how the order thresholds of the LODs are spaced')
+    parser.add_argument('--base', type=float, default=2, help='the ratio between the thresholds of consecutive LODs with log spacing')
+    parser.add_argument('--thresholds', type=parseThresholds, help='comma separated order thresholds, from the coarsest to the most detailed LOD, instead of --lods and --spacing')
+    parser.add_argument('--filter', type=parseFilter, help='only keep the features whose numeric property passes the filter, e.g. "UP_CELLS > 2000"')
+    parser.add_argument('--bbox', type=river_index.parseBbox, help='only tile the features that intersect west,south,east,north, reading only those when the input has a spatial index (see river_index.py)')
+    parser.add_argument('--simplify', type=float, default=0, help='simplify the deepest level with this tolerance in degrees (Douglas-Peucker)')
+    parser.add_argument('--simplify-factor', type=float, default=2, help='the factor the simplification tolerance grows by for every level up')
+    parser.add_argument('-o','--output_dir', type=is_dir, help='The output directory, every input gets a tileset directory in it', default='.')
+    parser.add_argument('files', type=argparse.FileType('r'), nargs='+', help='One or more geojson files')
+    instrument.addArguments(parser)
+    args = parser.parse_args()
+
+    instrument.runProfiled(args.profile, main, args)
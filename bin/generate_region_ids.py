@@ -0,0 +1,265 @@
+#!/usr/bin/env python
+
+# Download the lists of region codes of the region mapping layers from a WFS server and write
+# them to the region ID files named in regionMapping.json. This replaces the wget and perl
+# passes of buildprocess/generate-region-ids.sh, and should be run whenever boundary layers
+# are added or changed.
+#
+# The layers and columns are read from the regionIdsFile and regionDisambigIdsFile entries
+# of regionMapping.json and fetched by a bounded pool of threads. The getPropertyValue responses are parsed as they
+# arrive with iterparse, so the largest lists (SA1, tens of thousands of codes) are never
+# held as text. The order of the codes is kept, since the position of a code in its list
+# is the region index that region mapping uses.
+#
+# The codes are written with the JSON type of the existing list, so a regeneration doesn't
+# change them from strings to numbers or back. Codes of region types with textCodes are
+# always strings. New lists of integer codes are only written as numbers with --integers.
+#
+# Besides the JSON lists the client reads, lists of integer codes can be written in a compact
+# form: the differences between consecutive codes, which are small as the codes come in FID
+# order. --compact writes a NAME.deltas.json next to the list with a "deltas" array instead
+# of "values", and --binary a NAME.bin with the differences as zigzag varints:
+#
+#   'RIDS' | uint8 version | uint32 header length | header JSON | varints
+#
+# where the header holds the layer, property and count. The first varint is the first code.
+#
+# The server can be given with --server, e.g. a local stand-in WFS server for testing.
+
+import os
+import sys
+import json
+import struct
+import argparse
+import concurrent.futures
+import xml.etree.ElementTree as ElementTree
+from urllib.parse import urlencode
+from urllib.request import urlopen
+
+import instrument
+
+DEFAULT_SERVER = 'http://geoserver.nationalmap.nicta.com.au/region_map/ows'
+
+# The namespace of the layers on the region mapping server
+DEFAULT_NAMESPACE = 'region_map'
+
+BINARY_MAGIC = b'RIDS'
+BINARY_VERSION = 1
+
+# The codes that are written as integers: no sign, no leading zeroes (like POA_CODE 0800)
+def isIntegerCode(value):
+    return value.isdigit() and (value == '0' or value[0] != '0')
+
+# The (layer, property, server, path, textCodes) of the region ID lists in regionMapping.json,
+# the lists of codes and those of the disambiguation properties, once per file
+def readRegionLists(regionMapping, server=None, namespace=DEFAULT_NAMESPACE):
+    with open(regionMapping) as f:
+        regions = json.load(f)['regionWmsMap']
+
+    baseDir = os.path.dirname(os.path.dirname(os.path.abspath(regionMapping)))
+    lists = {}
+    for region in regions.values():
+        layer = region.get('analyticsWmsLayerName') or namespace + ':' + region.get('layerName', '')
+        for fileKey, propertyKey in (('regionIdsFile', 'regionProp'), ('regionDisambigIdsFile', 'disambigProp')):
+            path = region.get(fileKey)
+            if not path or path in lists or not region.get(propertyKey):
+                continue
+
+            lists[path] = {
+                'layer': layer,
+                'property': region[propertyKey],
+                'server': server or region.get('analyticsWmsServer') or DEFAULT_SERVER,
+                'path': os.path.join(baseDir, path),
+                'textCodes': bool(region.get('textCodes')),
+            }
+    return sorted(lists.values(), key=lambda l: l['path'])
+
+def propertyValueUrl(server, layer, column):
+    query = urlencode([('service', 'wfs'), ('version', '2.0'), ('request', 'getPropertyValue'),
+                       ('typenames', layer), ('valueReference', column)])
+    return server + ('&' if '?' in server else '?') + query
+
+def localName(tag):
+    return tag.rsplit('}', 1)[-1].rsplit(':', 1)[-1]
+
+# Stream the values out of a getPropertyValue response: the text of every element named after
+# the column, in the order of the members
+def parseValues(f, column):
+    column = localName(column)
+    values = []
+    for event, element in ElementTree.iterparse(f, events=('end',)):
+        name = localName(element.tag)
+        if name == column:
+            values.append((element.text or '').strip())
+        elif name == 'member':
+            # The values are done with, drop them from the tree
+            element.clear()
+        elif name == 'ExceptionText':
+            raise ValueError('the WFS server returned an exception: ' + (element.text or '').strip())
+    return values
+
+def fetchValues(regionList, timeout):
+    url = propertyValueUrl(regionList['server'], regionList['layer'], regionList['property'])
+    with urlopen(url, timeout=timeout) as response:
+        return parseValues(response, regionList['property'])
+
+# Whether the values of an existing region ID list are numbers, None when there is no list
+def hasIntegerValues(path):
+    try:
+        with open(path) as f:
+            document = json.load(f)
+    except (IOError, ValueError):
+        return None
+    values = document.get('values')
+    if values is None:
+        return None
+    return bool(values) and all(isinstance(v, int) for v in values)
+
+# Integer codes as integers when integers is true, anything else (names, codes with leading
+# zeroes) as strings
+def typedValues(values, integers=False):
+    if integers and values and all(isIntegerCode(v) for v in values):
+        return [int(v) for v in values]
+    return values
+
+def deltaEncode(values):
+    deltas = []
+    previous = 0
+    for value in values:
+        deltas.append(value - previous)
+        previous = value
+    return deltas
+
+def deltaDecode(deltas):
+    values = []
+    value = 0
+    for delta in deltas:
+        value += delta
+        values.append(value)
+    return values
+
+def writeVarint(out, value):
+    # Zigzag, so small negative differences stay small
+    value = (value << 1) if value >= 0 else ((-value << 1) - 1)
+    while value >= 0x80:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+
+def encodeBinary(layer, column, values):
+    header = json.dumps({'layer': layer, 'property': column, 'count': len(values)}, separators=(',', ':')).encode('utf-8')
+    out = bytearray(BINARY_MAGIC)
+    out += struct.pack('<BI', BINARY_VERSION, len(header))
+    out += header
+    for delta in deltaEncode(values):
+        writeVarint(out, delta)
+    return bytes(out)
+
+def decodeBinary(data):
+    '''Returns the header and the values of a binary region ID list.'''
+    if data[:4] != BINARY_MAGIC:
+        raise ValueError('not a binary region ID list')
+    version, length = struct.unpack_from('<BI', data, 4)
+    if version != BINARY_VERSION:
+        raise ValueError('unsupported binary region ID list version ' + str(version))
+    offset = 9 + length
+    header = json.loads(data[9:offset].decode('utf-8'))
+
+    deltas = []
+    value = shift = 0
+    for byte in data[offset:]:
+        value |= (byte & 0x7f) << shift
+        shift += 7
+        if not byte & 0x80:
+            deltas.append((value >> 1) if not value & 1 else -((value + 1) >> 1))
+            value = shift = 0
+    if len(deltas) != header['count']:
+        raise ValueError('truncated binary region ID list')
+    return header, deltaDecode(deltas)
+
+# Write a region ID list, returning the paths written. The list the client reads always
+# has the values, the compact forms are written next to it.
+def writeRegionList(regionList, values, compact=False, binary=False, integers=False):
+    layer = regionList['layer']
+    column = regionList['property']
+    path = regionList['path']
+
+    if not regionList.get('textCodes'):
+        existing = hasIntegerValues(path)
+        integers = existing if existing is not None else integers
+        values = typedValues(values, integers)
+    numeric = bool(values) and isinstance(values[0], int)
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as o:
+        json.dump({'layer': layer, 'property': column, 'values': values}, o, separators=(',', ':'))
+    paths = [path]
+
+    base = os.path.splitext(path)[0]
+    if compact and numeric:
+        with open(base + '.deltas.json', 'w') as o:
+            json.dump({'layer': layer, 'property': column, 'deltas': deltaEncode(values)}, o, separators=(',', ':'))
+        paths.append(base + '.deltas.json')
+
+    if binary and numeric:
+        with open(base + '.bin', 'wb') as o:
+            o.write(encodeBinary(layer, column, values))
+        paths.append(base + '.bin')
+    return paths
+
+def main(args):
+    regionLists = readRegionLists(args.region_mapping, args.server, args.namespace)
+    if args.only:
+        regionLists = [l for l in regionLists if any(name in l['path'] for name in args.only)]
+    if args.output_dir:
+        for regionList in regionLists:
+            regionList['path'] = os.path.join(args.output_dir, os.path.basename(regionList['path']))
+
+    metrics = instrument.Metrics(args.region_mapping, args.time, args.verbose, args.tracemalloc)
+    metrics.start('Fetching')
+    progress = metrics.progress('Region ID lists', len(regionLists))
+    failed = []
+    total = 0
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, args.jobs)) as pool:
+        futures = {pool.submit(fetchValues, regionList, args.timeout): regionList for regionList in regionLists}
+        for future in concurrent.futures.as_completed(futures):
+            regionList = futures[future]
+            try:
+                values = future.result()
+            except (IOError, ValueError, ElementTree.ParseError) as e:
+                print (regionList['layer'] + ', ' + regionList['property'] + ': ' + str(e), file=sys.stderr)
+                failed.append(regionList)
+                continue
+
+            paths = writeRegionList(regionList, values, args.compact, args.binary, args.integers)
+            total += len(values)
+            progress.update()
+            if (args.verbose):
+                print (regionList['layer'] + ', ' + regionList['property'] + ': ' + str(len(values)) + ' values written to ' + ', '.join(paths))
+
+    metrics.stop(total)
+    metrics.count(lists=len(regionLists) - len(failed), failed=len(failed), values=total)
+    if args.metrics:
+        instrument.writeReport(args.metrics, 'generate_region_ids', [metrics.report()])
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    # parse arguments
+    parser = argparse.ArgumentParser(description='Download the region ID lists named in regionMapping.json from a WFS server.')
+    parser.add_argument('-v','--verbose', help="increase output verbosity", action='store_true')
+    parser.add_argument('-t','--time', help="calculate and display time taken", action='store_true')
+    parser.add_argument('-j','--jobs', type=int, default=8, help="the number of lists fetched at the same time")
+    parser.add_argument('--server', help="fetch every list from this WFS server instead of the one in regionMapping.json, e.g. a local stand-in")
+    parser.add_argument('--namespace', default=DEFAULT_NAMESPACE, help="the namespace of the layers that have no analyticsWmsLayerName")
+    parser.add_argument('--timeout', type=float, default=120, help="the timeout of a request in seconds")
+    parser.add_argument('--only', nargs='+', metavar='NAME', help="only fetch the lists whose file name contains one of these, e.g. SA1_MAIN11")
+    parser.add_argument('--integers', help="write new lists of integer codes as numbers instead of strings, existing lists keep their type", action='store_true')
+    parser.add_argument('--compact', help="also write lists of integer codes as the differences between consecutive codes to a .deltas.json file", action='store_true')
+    parser.add_argument('--binary', help="also write lists of integer codes as zigzag varint differences to a .bin file", action='store_true')
+    parser.add_argument('-o','--output_dir', help="write the lists to this directory instead of the paths in regionMapping.json")
+    parser.add_argument('region_mapping', nargs='?', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'wwwroot', 'data', 'regionMapping.json'), help='the regionMapping.json to read the lists from')
+    instrument.addArguments(parser)
+    args = parser.parse_args()
+
+    sys.exit(instrument.runProfiled(args.profile, main, args))
@@ -0,0 +1,284 @@
+#!/usr/bin/env python
+
+# Streaming GeoJSON reading and writing, shared by chain_rivers.py and create_lods.py.
+#
+# Features are yielded one at a time from any GeoJSON layout: a FeatureCollection
+# (pretty printed, one feature per line or all on a single line), newline delimited
+# features or a GeoJSON text sequence. Only a bounded window of the input is kept in memory.
+# Features are written as a valid FeatureCollection or as newline delimited GeoJSON,
+# encoded into a buffer that is written out in bulk.
+
+import json
+
+# orjson is considerably faster than the standard library, use it when it is installed
+try:
+    import orjson
+    loads = orjson.loads
+    dumps = orjson.dumps
+except ImportError:
+    loads = json.loads
+    def dumps(value):
+        return json.dumps(value, separators=(',', ':')).encode('utf-8')
+
+CHUNK_SIZE = 1 << 20
+BUFFER_SIZE = 1 << 22
+
+# Whitespace between values, including the record separator used by GeoJSON text sequences
+WHITESPACE = b' \t\r\n\x1e'
+
+decoder = json.JSONDecoder()
+
+def binaryFile(f):
+    # Files opened by argparse.FileType('r') are text files, read the underlying bytes instead
+    return getattr(f, 'buffer', f)
+
+class StreamBuffer(object):
+    '''A window on a binary file that is refilled in chunks while it is being scanned.'''
+
+    def __init__(self, f, chunkSize=CHUNK_SIZE):
+        self.f = f
+        self.chunkSize = chunkSize
+        self.buf = b''
+        self.pos = 0
+        # The offset of buf[0] in the file
+        self.base = 0
+        self.eof = False
+        # The file offset up to which there is no newline, so single line collections are only
+        # searched for one once
+        self.lineless = 0
+        # buf decoded, and the index in it of a byte position (see text)
+        self.text = None
+        self.anchor = (0, 0)
+
+    def offset(self):
+        return self.base + self.pos
+
+    def fill(self):
+        # Read another chunk, returns False when the end of the file was reached
+        if self.eof:
+            return False
+
+        chunk = self.f.read(self.chunkSize)
+        if not chunk:
+            self.eof = True
+            return False
+
+        # Drop the part of the window that has been consumed
+        if self.pos > 0:
+            self.base += self.pos
+            self.buf = self.buf[self.pos:]
+            self.pos = 0
+
+        self.buf += chunk
+        self.text = None
+        return True
+
+    def decoded(self):
+        # The window decoded once per fill and the index of pos in it. Characters split by the
+        # end of the window are escaped, and are only read once the window has grown past them.
+        if self.text is None or self.pos < self.anchor[0]:
+            self.text = self.buf.decode('utf-8', 'surrogateescape')
+            self.anchor = (0, 0)
+        bytePos, charPos = self.anchor
+        if self.pos > bytePos:
+            charPos += len(self.buf[bytePos:self.pos].decode('utf-8', 'surrogateescape'))
+            self.anchor = (self.pos, charPos)
+        return self.text, charPos
+
+    def peek(self, skip=WHITESPACE):
+        # Skip whitespace (and any other given separators), returns the next byte or b'' at the end
+        while True:
+            buf = self.buf
+            pos = self.pos
+            while pos < len(buf) and buf[pos] in skip:
+                pos += 1
+            self.pos = pos
+
+            if pos < len(buf):
+                return buf[pos:pos+1]
+            if not self.fill():
+                return b''
+
+    def expect(self, token):
+        if self.peek() != token:
+            raise ValueError('expected ' + repr(token.decode()) + ' at byte ' + str(self.offset()))
+        self.pos += 1
+
+    def value(self, lineOnly=False):
+        # Decode the JSON value at the current position, returns its byte offset, length and value.
+        # With lineOnly, None is returned when the value doesn't fit the fast path.
+        self.peek()
+        offset = self.offset()
+
+        # Fast path: the value is the rest of the line, optionally followed by a comma,
+        # which is how most GeoJSON is written. Only look ahead a bounded distance, so a
+        # whole collection on a single line doesn't end up in memory, and only look at every
+        # byte once when there is no newline ahead.
+        if self.buf[self.pos:self.pos+1] == b'{' and (offset >= self.lineless or self.eof):
+            searched = max(offset, self.lineless)
+            end = self.buf.find(b'\n', searched - self.base)
+            if end == -1 and len(self.buf) - self.pos < self.chunkSize:
+                searched = self.base + len(self.buf)
+                if self.fill():
+                    end = self.buf.find(b'\n', searched - self.base)
+            if end == -1:
+                if self.eof:
+                    end = len(self.buf)
+                else:
+                    self.lineless = self.base + len(self.buf)
+
+            if end != -1:
+                candidate = self.buf[self.pos:end].rstrip().rstrip(b',').rstrip()
+                try:
+                    value = loads(candidate)
+                    self.pos += len(candidate)
+                    return offset, len(candidate), value
+                except ValueError:
+                    pass
+
+        if lineOnly:
+            return None
+
+        # General path: decode the window from the current position, reading more until it
+        # holds the complete value
+        while True:
+            text, start = self.decoded()
+            try:
+                value, end = decoder.raw_decode(text, start)
+            except ValueError:
+                if not self.fill():
+                    raise ValueError('invalid or truncated JSON value at byte ' + str(offset))
+                continue
+
+            # A number at the end of the window may go on in the next chunk
+            if end == len(text) and self.fill():
+                continue
+
+            length = len(text[start:end].encode('utf-8', 'surrogateescape'))
+            self.pos += length
+            self.anchor = (self.pos, end)
+            return offset, length, value
+
+def readMembers(b, offsets, members):
+    # Read the members of a top level object into members, streaming the features of a collection
+    b.expect(b'{')
+
+    while True:
+        c = b.peek(WHITESPACE + b',')
+        if c == b'}':
+            b.pos += 1
+            return
+        if not c:
+            raise ValueError('unterminated GeoJSON object')
+
+        key = b.value()[2]
+        b.expect(b':')
+
+        if key == 'features':
+            b.expect(b'[')
+            while True:
+                c = b.peek(WHITESPACE + b',')
+                if c == b']':
+                    b.pos += 1
+                    break
+                if not c:
+                    raise ValueError('unterminated features array')
+
+                item = b.value()
+                yield item if offsets else item[2]
+        else:
+            members[key] = b.value()[2]
+
+# Yield the features in the given GeoJSON file one by one. With offsets, every feature
+# is yielded as an (offset, length, feature) tuple, where offset and length give the
+# position of the encoded feature in the file.
+def readFeatures(f, offsets=False, chunkSize=CHUNK_SIZE):
+    b = StreamBuffer(binaryFile(f), chunkSize)
+
+    while True:
+        c = b.peek()
+        if not c:
+            return
+        if c != b'{':
+            raise ValueError('expected a GeoJSON object at byte ' + str(b.offset()))
+
+        # Newline delimited features are decoded directly
+        item = b.value(lineOnly=True)
+        if item and item[2].get('type') != 'FeatureCollection':
+            if item[2].get('type') == 'Feature':
+                yield item if offsets else item[2]
+            continue
+
+        # Anything else is streamed member by member, so the features of a
+        # collection never have to be in memory at the same time
+        if item:
+            b.pos -= item[1]
+        start = b.offset()
+        members = {}
+        for feature in readMembers(b, offsets, members):
+            yield feature
+
+        if members.get('type') == 'Feature':
+            yield (start, b.offset() - start, members) if offsets else members
+
+# Add the given values to the properties of a feature
+def setProperties(feature, values):
+    properties = feature.get('properties') or {}
+    properties.update(values)
+    feature['properties'] = properties
+
+    return feature
+
+class FeatureWriter(object):
+    '''Writes features to a binary file, as a FeatureCollection or as newline delimited GeoJSON.'''
+
+    def __init__(self, f, newlineDelimited=False, bufferSize=BUFFER_SIZE):
+        self.f = binaryFile(f)
+        self.newlineDelimited = newlineDelimited
+        self.bufferSize = bufferSize
+        self.parts = []
+        self.size = 0
+        self.count = 0
+        # The number of bytes already written to the file
+        self.written = 0
+
+        if not newlineDelimited:
+            self.append(b'{"type":"FeatureCollection","features":[\n')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def append(self, data):
+        self.parts.append(data)
+        self.size += len(data)
+        if self.size >= self.bufferSize:
+            self.flush()
+
+    def write(self, feature):
+        return self.writeEncoded(dumps(feature))
+
+    def writeEncoded(self, data):
+        # Write a feature that has already been encoded to JSON bytes,
+        # returns the offset and length of the feature in the file
+        if not self.newlineDelimited and self.count:
+            self.append(b',\n')
+        offset = self.written + self.size
+        self.append(data)
+        if self.newlineDelimited:
+            self.append(b'\n')
+        self.count += 1
+        return offset, len(data)
+
+    def flush(self):
+        self.f.write(b''.join(self.parts))
+        self.written += self.size
+        self.parts = []
+        self.size = 0
+
+    def close(self):
+        if not self.newlineDelimited:
+            self.parts.append(b'\n]}\n')
+        self.flush()
@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+
+# Instrumentation shared by chain_rivers.py and create_lods.py: high resolution timings
+# per phase, peak memory use, counts and throughput, rate limited progress reporting and
+# a JSON metrics report. Profiling with cProfile and tracemalloc can be switched on as well.
+#
+# A run is divided into phases with start(name) and stop(), starting a phase ends the
+# one before it. Phases can be given the number of items they handled, their throughput
+# is reported in items per second.
+
+import sys
+import json
+import time
+import cProfile
+import datetime
+import tracemalloc
+
+# resource is not available on Windows, the peak memory use is left out there
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# Seconds between progress reports
+PROGRESS_INTERVAL = 5.0
+
+# The peak resident set size of this process and of its finished child processes, in bytes
+def peakRss():
+    if resource is None:
+        return None
+
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    scale = 1 if sys.platform == 'darwin' else 1024
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale
+    return max(own, children)
+
+def formatBytes(size):
+    return '{0:.1f} MB'.format(size / 1048576.0)
+
+class Progress(object):
+    '''Reports the progress of a loop, at most once per interval.'''
+
+    def __init__(self, label, total=None, enabled=True, interval=PROGRESS_INTERVAL):
+        self.label = label
+        self.total = total
+        self.enabled = enabled
+        self.interval = interval
+        self.count = 0
+        self.started = time.perf_counter()
+        self.reported = self.started
+
+    def update(self, count=1):
+        self.count += count
+        if not self.enabled:
+            return
+
+        now = time.perf_counter()
+        if now - self.reported < self.interval:
+            return
+        self.reported = now
+
+        rate = self.count / max(now - self.started, 1e-9)
+        message = self.label + ': ' + str(self.count)
+        if self.total:
+            message += ' of ' + str(self.total) + ' ({0:.0%})'.format(self.count / float(self.total))
+        print (message + ', {0:.0f}/s'.format(rate))
+
+    def track(self, items):
+        # Yield the items, counting them
+        for item in items:
+            self.update()
+            yield item
+
+class Metrics(object):
+    '''The timings, counts and memory use of a run, for the console and for a JSON report.'''
+
+    def __init__(self, name, time=False, verbose=False, trace=False):
+        self.name = name
+        self.time = time
+        self.verbose = verbose
+        self.trace = trace
+        self.phases = []
+        self.counts = {}
+        self.current = None
+        self.started = self.clock()
+        self.startedAt = datetime.datetime.now().isoformat()
+
+        if trace and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def clock(self):
+        return time.perf_counter()
+
+    def start(self, phase):
+        self.stop()
+        if self.trace:
+            tracemalloc.reset_peak()
+        self.current = {'name': phase, 'start': self.clock()}
+
+    # End the current phase, optionally with the number of items it handled
+    def stop(self, items=None):
+        if self.current is None:
+            return
+
+        phase = self.current
+        self.current = None
+        seconds = self.clock() - phase.pop('start')
+        phase['seconds'] = seconds
+        if items is not None:
+            phase['items'] = int(items)
+            phase['itemsPerSecond'] = items / seconds if seconds > 0 else None
+        phase['peakRss'] = peakRss()
+        if self.trace:
+            phase['tracedPeak'] = tracemalloc.get_traced_memory()[1]
+        self.phases.append(phase)
+
+        if (self.time):
+            message = phase['name'] + ' time taken: {0:.3f} s'.format(seconds)
+            if phase.get('itemsPerSecond'):
+                message += ', {0:.0f} features/s'.format(phase['itemsPerSecond'])
+            if phase['peakRss']:
+                message += ', peak memory ' + formatBytes(phase['peakRss'])
+            print (message)
+
+    def count(self, **counts):
+        self.counts.update((key, int(value)) for key, value in counts.items())
+
+    def progress(self, label, total=None):
+        return Progress(label, total, self.verbose)
+
+    def report(self):
+        self.stop()
+        seconds = self.clock() - self.started
+        report = {'name': self.name, 'started': self.startedAt, 'seconds': seconds,
+                  'peakRss': peakRss(), 'counts': self.counts, 'phases': self.phases}
+        if 'features' in self.counts and seconds > 0:
+            report['featuresPerSecond'] = self.counts['features'] / seconds
+        return report
+
+# Write the reports of the runs of a tool to a JSON file
+def writeReport(path, tool, runs):
+    with open(path, 'w') as o:
+        json.dump({'tool': tool, 'argv': sys.argv[1:], 'peakRss': peakRss(), 'runs': runs}, o, indent=2)
+
+# Run function(*args) under cProfile when a path is given, writing the statistics there.
+# The statistics can be inspected with python -m pstats or snakeviz.
+def runProfiled(path, function, *args):
+    if not path:
+        return function(*args)
+
+    profile = cProfile.Profile()
+    try:
+        return profile.runcall(function, *args)
+    finally:
+        profile.dump_stats(path)
+
+def addArguments(parser):
+    parser.add_argument('--metrics', metavar='FILE', help="write the timings, counts and memory use of the run to a JSON file")
+    parser.add_argument('--profile', metavar='FILE', help="profile the run with cProfile and write the statistics to FILE")
+    parser.add_argument('--tracemalloc', help="trace the peak Python memory allocation of every phase (slows the run down)", action='store_true')
@@ -0,0 +1,283 @@
+#!/usr/bin/env python
+
+# Join CSV files of region codes and values (like wwwroot/data/2011Census_TOT_*.csv) to the
+# region ID lists of regionMapping.json ahead of time. The output is a table with a row per
+# region, in the order of the region ID list, so a client can look the value of region i up
+# at index i instead of joining the codes as strings when the CSV is loaded.
+#
+# The region type of a CSV is found like the client does, from the name of its first column
+# (the region type, its regionProp or one of its aliases, or a prefix of those, e.g. SA1).
+# When several region types match, the one whose ID list matches the most codes wins, so the
+# 7 digit 2011 SA1 codes aren't joined to the 2016 SA1 layer. --region-type picks one.
+#
+# The CSV is read a row at a time. Codes that are not in the region ID list, and codes that
+# appear more than once, are reported and left out. The table is written as compact JSON
+# (NAME.join.json: a column per CSV column, null where a region has no row) and, with
+# --binary, as a columnar binary (NAME.join.bin):
+#
+#   'RJIX' | uint8 version | uint32 header length | header JSON | padding to 8 bytes | columns
+#
+# where every numeric column is a little endian float64 array with NaN where a region has
+# no row, at the offset given in the header. Text columns are kept in the header.
+
+import os
+import sys
+import csv
+import json
+import struct
+import array
+import argparse
+
+import instrument
+from generate_region_ids import deltaDecode
+
+BINARY_MAGIC = b'RJIX'
+BINARY_VERSION = 1
+
+# The region ID list of a region type, as strings, from its values or deltas (see generate_region_ids.py)
+def readRegionIds(path):
+    with open(path) as f:
+        regionIds = json.load(f)
+    values = regionIds['values'] if 'values' in regionIds else deltaDecode(regionIds['deltas'])
+    return [str(value) for value in values]
+
+def regionNames(regionType, region):
+    return [regionType.lower(), region['regionProp'].lower()] + [alias.lower() for alias in region.get('aliases', [])]
+
+# The region types of regionMapping.json whose names match a column name
+def candidateRegionTypes(regionMapping, column):
+    column = column.strip().lower()
+    candidates = []
+    for regionType, region in regionMapping.items():
+        if not region.get('regionIdsFile'):
+            continue
+        if any(name == column or name.startswith(column + '_') for name in regionNames(regionType, region)):
+            candidates.append(regionType)
+    return candidates
+
+def normalizeCode(code, digits=None):
+    code = code.strip()
+    # Numeric codes can lose their leading zeroes in spreadsheets
+    if digits and code.isdigit() and len(code) < digits:
+        code = code.zfill(digits)
+    return code
+
+class RegionIndex(object):
+    '''The index of every code in the ID list of a region type.'''
+
+    def __init__(self, regionType, region, baseDir):
+        self.regionType = regionType
+        self.region = region
+        self.digits = region.get('digits')
+        self.ids = readRegionIds(os.path.join(baseDir, region['regionIdsFile']))
+        self.index = {}
+        for i, code in enumerate(self.ids):
+            self.index.setdefault(code, i)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def lookup(self, code):
+        return self.index.get(normalizeCode(code, self.digits))
+
+    def matches(self, codes):
+        return sum(1 for code in codes if self.lookup(code) is not None)
+
+# Pick the region type of a CSV from the codes in its first column
+def chooseRegionType(regionMapping, baseDir, column, codes, regionType=None):
+    candidates = [regionType] if regionType else candidateRegionTypes(regionMapping, column)
+    best = None
+    for candidate in candidates:
+        index = RegionIndex(candidate, regionMapping[candidate], baseDir)
+        score = (index.matches(codes), -len(index))
+        if best is None or score > best[0]:
+            best = (score, index)
+    return best[1] if best else None
+
+def parseNumber(value):
+    try:
+        return int(value)
+    except ValueError:
+        pass
+    try:
+        return float(value)
+    except ValueError:
+        return None
+
+class Table(object):
+    '''A column per CSV column with a row per region, filled one CSV row at a time.'''
+
+    def __init__(self, index, columns):
+        self.index = index
+        self.names = columns
+        self.columns = [[None] * len(index) for _ in columns]
+        # The regions that have a row, so a second row is reported also when the first had no values
+        self.matched = bytearray(len(index))
+        self.unmatched = []
+        self.duplicates = []
+        self.rows = 0
+
+    def add(self, code, values):
+        self.rows += 1
+        i = self.index.lookup(code)
+        if i is None:
+            self.unmatched.append(code)
+            return
+        if self.matched[i]:
+            self.duplicates.append(code)
+            return
+        self.matched[i] = 1
+        for column, value in zip(self.columns, values):
+            column[i] = value.strip()
+
+    def typedColumns(self):
+        '''Every column as numbers (None where missing) when all its values are numbers, otherwise as strings.'''
+        typed = []
+        for name, column in zip(self.names, self.columns):
+            numbers = [None if value in (None, '') else parseNumber(value) for value in column]
+            if all(number is not None or value in (None, '') for number, value in zip(numbers, column)):
+                typed.append((name, 'number', numbers))
+            else:
+                typed.append((name, 'string', column))
+        return typed
+
+    def header(self):
+        region = self.index.region
+        return {'regionType': self.index.regionType, 'regionProp': region['regionProp'],
+                'regionIdsFile': region['regionIdsFile'], 'count': len(self.index),
+                'rows': self.rows, 'matched': self.rows - len(self.unmatched) - len(self.duplicates),
+                'unmatched': self.unmatched, 'duplicates': self.duplicates}
+
+def joinCsv(f, regionMapping, baseDir, regionType=None, sampleSize=1000):
+    reader = csv.reader(f)
+    header = next(reader)
+
+    # Choose the region type from the first rows, then stream the rest
+    sample = []
+    for row in reader:
+        sample.append(row)
+        if len(sample) >= sampleSize:
+            break
+    index = chooseRegionType(regionMapping, baseDir, header[0], [row[0] for row in sample if row], regionType)
+    if index is None:
+        raise ValueError('no region type in regionMapping.json matches the column ' + header[0])
+
+    table = Table(index, header[1:])
+    for rows in (sample, reader):
+        for row in rows:
+            if row:
+                table.add(row[0], row[1:])
+    return table
+
+def writeJson(table, path):
+    document = table.header()
+    document['columns'] = dict((name, values) for name, kind, values in table.typedColumns())
+    with open(path, 'w') as o:
+        json.dump(document, o, separators=(',', ':'))
+
+# A little endian float64 array of numbers, with NaN for the missing ones
+def float64Array(values):
+    column = array.array('d', (float('nan') if v is None else v for v in values))
+    if sys.byteorder == 'big':
+        column.byteswap()
+    return column
+
+def writeBinary(table, path):
+    header = table.header()
+    header['columns'] = []
+    arrays = []
+    offset = 0
+    for name, kind, values in table.typedColumns():
+        if kind == 'number':
+            column = float64Array(values)
+            header['columns'].append({'name': name, 'type': 'float64', 'offset': offset, 'length': len(column)})
+            arrays.append(column)
+            offset += len(column) * column.itemsize
+        else:
+            header['columns'].append({'name': name, 'type': 'string', 'values': values})
+
+    headerBytes = json.dumps(header, separators=(',', ':')).encode('utf-8')
+    start = len(BINARY_MAGIC) + 5 + len(headerBytes)
+    padding = (8 - start % 8) % 8
+    with open(path, 'wb') as o:
+        o.write(BINARY_MAGIC)
+        o.write(struct.pack('<BI', BINARY_VERSION, len(headerBytes) + padding))
+        o.write(headerBytes + b' ' * padding)
+        for column in arrays:
+            o.write(column.tobytes())
+
+def readBinary(path):
+    '''Returns the header and a dict of column name to values of a binary join table.'''
+    with open(path, 'rb') as f:
+        data = f.read()
+    if data[:4] != BINARY_MAGIC:
+        raise ValueError('not a binary region join table')
+    version, length = struct.unpack_from('<BI', data, 4)
+    if version != BINARY_VERSION:
+        raise ValueError('unsupported binary region join table version ' + str(version))
+    header = json.loads(data[9:9 + length].decode('utf-8'))
+
+    columns = {}
+    for column in header['columns']:
+        if column['type'] == 'float64':
+            start = 9 + length + column['offset']
+            values = array.array('d', data[start:start + column['length'] * 8])
+            if sys.byteorder == 'big':
+                values.byteswap()
+            columns[column['name']] = values
+        else:
+            columns[column['name']] = column['values']
+    return header, columns
+
+def main(args):
+    with open(args.region_mapping) as f:
+        regionMapping = json.load(f)['regionWmsMap']
+    # The region ID files are relative to the directory above data/
+    baseDir = os.path.dirname(os.path.dirname(os.path.abspath(args.region_mapping)))
+    runs = []
+
+    for f in args.files:
+        metrics = instrument.Metrics(f.name, args.time, args.verbose, args.tracemalloc)
+        metrics.start('Joining')
+        try:
+            table = joinCsv(f, regionMapping, baseDir, args.region_type)
+        except ValueError as e:
+            print (f.name + ': ' + str(e))
+            continue
+        metrics.stop(table.rows)
+
+        metrics.start('Writing')
+        base = os.path.join(args.output_dir or os.path.dirname(f.name), os.path.splitext(os.path.basename(f.name))[0])
+        writeJson(table, base + '.join.json')
+        if args.binary:
+            writeBinary(table, base + '.join.bin')
+        metrics.stop(len(table.index))
+
+        header = table.header()
+        print (f.name + ': ' + header['regionType'] + ', ' + str(header['matched']) + ' of ' + str(header['rows']) + ' rows joined to ' +
+               str(header['count']) + ' regions, ' + str(len(table.unmatched)) + ' unmatched, ' + str(len(table.duplicates)) + ' duplicate')
+        if table.unmatched and (args.verbose):
+            print ('  unmatched codes: ' + ', '.join(table.unmatched[:args.show_unmatched]) +
+                   (' ...' if len(table.unmatched) > args.show_unmatched else ''))
+
+        metrics.count(features=table.rows, matched=header['matched'], unmatched=len(table.unmatched), duplicates=len(table.duplicates))
+        runs.append(metrics.report())
+
+    if args.metrics:
+        instrument.writeReport(args.metrics, 'join_regions', runs)
+
+if __name__ == "__main__":
+    # parse arguments
+    parser = argparse.ArgumentParser(description='Join CSV files of region codes to the region ID lists of regionMapping.json, writing a table ordered by region index.')
+    parser.add_argument('-v','--verbose', help="increase output verbosity", action='store_true')
+    parser.add_argument('-t','--time', help="calculate and display time taken", action='store_true')
+    parser.add_argument('-b','--binary', help="also write the table as a columnar binary", action='store_true')
+    parser.add_argument('--region-type', help="the region type of regionMapping.json to join to, instead of choosing it by the first column")
+    parser.add_argument('--region-mapping', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'wwwroot', 'data', 'regionMapping.json'), help='the regionMapping.json with the region types')
+    parser.add_argument('--show-unmatched', type=int, default=20, help="the number of unmatched codes shown with --verbose")
+    parser.add_argument('-o','--output_dir', help="the directory to write the tables to instead of next to the CSV files")
+    parser.add_argument('files', type=argparse.FileType('r'), nargs='+', help='one or more CSV files with the region codes in the first column')
+    instrument.addArguments(parser)
+    args = parser.parse_args()
+
+    instrument.runProfiled(args.profile, main, args)
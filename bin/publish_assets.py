@@ -0,0 +1,228 @@
+#!/usr/bin/env python
+
+# Prepare the outputs of create_lods.py, create_tileset.py, chain_rivers.py and
+# generate_region_ids.py for serving: write precompressed .gz and .br siblings of every file,
+# so the server doesn't compress on every request, and optionally a copy of every file named
+# after a hash of its content, so the files can be served as immutable and never need a
+# varnish PURGE after a deploy.
+#
+# The files under a directory that match the --include patterns are compressed in a pool of
+# worker processes at the highest levels (gzip 9, brotli 11). Brotli needs the brotli package,
+# without it only .gz files are written. A compressed file is only kept when it is smaller,
+# and files whose siblings are newer than themselves are skipped.
+#
+# With --hash, a copy of NAME.EXT is written as NAME.hash-HASH.EXT next to it, and manifest.json
+# in the directory maps the logical names to the hashed names, both relative to the directory.
+# The tile URIs of a tileset.json are rewritten to the hashed tile names in its hashed copy, so
+# a tileset only references immutable tiles. varnish/default.vcl caches the hashed names for a
+# year. The hash- marker keeps logical names that end in hex digits (a date, a revision) apart
+# from the hashed copies, which are never published themselves. --prune removes the hashed
+# copies that are not in the new manifest, those of every earlier run.
+
+import os
+import re
+import sys
+import json
+import gzip
+import fnmatch
+import hashlib
+import argparse
+import concurrent.futures
+
+import instrument
+
+# brotli compresses JSON considerably better than gzip, but isn't in the standard library
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+MANIFEST = 'manifest.json'
+
+# The number of hex digits of the content hash in a hashed name
+HASH_LENGTH = 12
+
+DEFAULT_INCLUDE = ['*.json', '*.ndjson', '*.geojson', '*.vctr', '*.bin']
+
+COMPRESSED_EXTENSIONS = ('.gz', '.br')
+
+# Marks the hash in the name of a hashed copy
+HASH_MARKER = 'hash-'
+
+# The names of hashed copies, the same pattern varnish/default.vcl caches as immutable
+HASHED_NAME = re.compile(r'\.' + HASH_MARKER + r'[0-9a-f]{' + str(HASH_LENGTH) + r'}\.[a-z0-9]+$')
+
+def contentHash(data):
+    return hashlib.sha256(data).hexdigest()[:HASH_LENGTH]
+
+def hashedName(path, digest):
+    base, ext = os.path.splitext(path)
+    return base + '.' + HASH_MARKER + digest + ext
+
+def isUpToDate(path, sibling):
+    try:
+        return os.stat(sibling).st_mtime_ns >= os.stat(path).st_mtime_ns
+    except OSError:
+        return False
+
+# Write a compressed sibling of path when it is smaller, removing an outdated one when it isn't.
+# Returns the size of the sibling, or None when there is none.
+def writeCompressed(path, extension, compress, data, force=False):
+    sibling = path + extension
+    if not force and isUpToDate(path, sibling):
+        return os.path.getsize(sibling)
+
+    compressed = compress(data)
+    if len(compressed) >= len(data):
+        if os.path.exists(sibling):
+            os.remove(sibling)
+        return None
+
+    with open(sibling + '.tmp', 'wb') as o:
+        o.write(compressed)
+    os.replace(sibling + '.tmp', sibling)
+    return len(compressed)
+
+# Compress a file, run in the worker processes. Returns its size and those of the siblings.
+def compressFile(path, gzipLevel=9, brotliQuality=11, force=False):
+    with open(path, 'rb') as f:
+        data = f.read()
+    # No file name or time in the header, so the same content always compresses to the same bytes
+    gz = writeCompressed(path, '.gz', lambda d: gzip.compress(d, gzipLevel, mtime=0), data, force)
+    br = writeCompressed(path, '.br', lambda d: brotli.compress(d, quality=brotliQuality), data, force) if brotli else None
+    return path, len(data), gz, br
+
+# The files under root matching the patterns, relative to root, leaving out compressed
+# siblings, the manifest and the hashed copies of earlier runs
+def findFiles(root, patterns):
+    found = []
+    for directory, dirs, files in os.walk(root):
+        dirs.sort()
+        for name in sorted(files):
+            relative = os.path.relpath(os.path.join(directory, name), root).replace(os.sep, '/')
+            if name.endswith(COMPRESSED_EXTENSIONS) or name.endswith('.tmp') or relative == MANIFEST or HASHED_NAME.search(name):
+                continue
+            if any(fnmatch.fnmatch(name, pattern) for pattern in patterns):
+                found.append(relative)
+    return found
+
+# The hashed copies under root, relative to root
+def hashedFiles(root):
+    found = []
+    for directory, dirs, files in os.walk(root):
+        for name in files:
+            if HASHED_NAME.search(name):
+                found.append(os.path.relpath(os.path.join(directory, name), root).replace(os.sep, '/'))
+    return found
+
+def readManifest(root):
+    try:
+        with open(os.path.join(root, MANIFEST)) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+# Replace the content URIs of a tileset.json, relative to the tileset, with their hashed names
+def rewriteTileset(tileset, directory, manifest):
+    nodes = [tileset.get('root') or {}]
+    while nodes:
+        node = nodes.pop()
+        content = node.get('content') or {}
+        for key in ('uri', 'url'):
+            if key in content:
+                logical = os.path.normpath(os.path.join(directory, content[key])).replace(os.sep, '/')
+                if logical in manifest:
+                    content[key] = os.path.relpath(manifest[logical], directory or '.').replace(os.sep, '/')
+        nodes.extend(node.get('children', []))
+    return tileset
+
+# Write the hashed copy of a file, returns its name relative to root
+def writeHashed(root, relative, manifest):
+    path = os.path.join(root, relative)
+    with open(path, 'rb') as f:
+        data = f.read()
+    if os.path.basename(relative) == 'tileset.json':
+        tileset = rewriteTileset(json.loads(data.decode('utf-8')), os.path.dirname(relative), manifest)
+        data = json.dumps(tileset, separators=(',', ':')).encode('utf-8')
+
+    hashed = hashedName(relative, contentHash(data))
+    # The name says what is in the file, an existing one is already right
+    if not os.path.exists(os.path.join(root, hashed)):
+        with open(os.path.join(root, hashed), 'wb') as o:
+            o.write(data)
+    return hashed
+
+def removeFile(path):
+    removed = 0
+    for name in [path] + [path + extension for extension in COMPRESSED_EXTENSIONS]:
+        if os.path.exists(name):
+            os.remove(name)
+            removed += 1
+    return removed
+
+def main(args):
+    root = args.directory
+    previous = readManifest(root)
+    files = findFiles(root, args.include or DEFAULT_INCLUDE)
+    metrics = instrument.Metrics(root, args.time, args.verbose, args.tracemalloc)
+    if brotli is None:
+        print ('The brotli package is not installed, only .gz files are written', file=sys.stderr)
+
+    manifest = {}
+    published = files
+    if args.hash:
+        metrics.start('Hashing')
+        # Tilesets last, their tiles have to be hashed first
+        for relative in sorted(files, key=lambda r: os.path.basename(r) == 'tileset.json'):
+            manifest[relative] = writeHashed(root, relative, manifest)
+        published = [manifest[relative] for relative in files]
+        metrics.stop(len(files))
+
+    metrics.start('Compressing')
+    progress = metrics.progress('Files', len(published))
+    sizes = [0, 0, 0]
+    with concurrent.futures.ProcessPoolExecutor(max_workers=args.jobs) as pool:
+        futures = [pool.submit(compressFile, os.path.join(root, relative), args.gzip_level, args.brotli_quality, args.force) for relative in published]
+        for future in concurrent.futures.as_completed(futures):
+            path, size, gz, br = future.result()
+            sizes[0] += size
+            sizes[1] += gz or size
+            sizes[2] += br or gz or size
+            progress.update()
+            if (args.verbose):
+                print (path + ': ' + str(size) + ' bytes, ' + str(gz) + ' gzipped, ' + str(br) + ' with brotli')
+    metrics.stop(len(published))
+
+    removed = 0
+    if args.hash:
+        if manifest != previous:
+            with open(os.path.join(root, MANIFEST), 'w') as o:
+                json.dump(manifest, o, indent=1, sort_keys=True)
+        if args.prune:
+            current = set(manifest.values())
+            for hashed in set(hashedFiles(root)) - current:
+                removed += removeFile(os.path.join(root, hashed))
+
+    print (str(len(published)) + ' files, ' + instrument.formatBytes(sizes[0]) + ', ' + instrument.formatBytes(sizes[1]) + ' gzipped' +
+           (', ' + instrument.formatBytes(sizes[2]) + ' with brotli' if brotli else '') + (', ' + str(removed) + ' outdated files removed' if removed else ''))
+    metrics.count(files=len(published), bytes=sizes[0], gzip=sizes[1], brotli=sizes[2], removed=removed)
+    if args.metrics:
+        instrument.writeReport(args.metrics, 'publish_assets', [metrics.report()])
+
+if __name__ == "__main__":
+    # parse arguments
+    parser = argparse.ArgumentParser(description='Write precompressed and content hashed copies of the files under a directory for serving.')
+    parser.add_argument('-v','--verbose', help="increase output verbosity", action='store_true')
+    parser.add_argument('-t','--time', help="calculate and display time taken", action='store_true')
+    parser.add_argument('-j','--jobs', type=int, default=os.cpu_count(), help="the number of files compressed at the same time")
+    parser.add_argument('-i','--include', nargs='+', metavar='PATTERN', help="the file names to publish, by default " + ' '.join(DEFAULT_INCLUDE))
+    parser.add_argument('--hash', help="also write a copy of every file named after its content, and a manifest.json of the names", action='store_true')
+    parser.add_argument('--prune', help="remove the hashed copies that are not in the new manifest.json", action='store_true')
+    parser.add_argument('--force', help="compress files again even when their compressed siblings are newer", action='store_true')
+    parser.add_argument('--gzip-level', type=int, default=9, choices=range(1, 10), help="the gzip compression level")
+    parser.add_argument('--brotli-quality', type=int, default=11, choices=range(0, 12), help="the brotli quality")
+    parser.add_argument('directory', help='the directory with the files, e.g. the output directory of create_lods.py or wwwroot/data/regionids')
+    instrument.addArguments(parser)
+    args = parser.parse_args()
+
+    instrument.runProfiled(args.profile, main, args)
@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+
+# A binary cache of the river graph of a GeoJSON file, so repeated runs of chain_rivers.py
+# and create_lods.py don't have to parse the whole file again.
+#
+# The cache is a directory next to the source file (<name>.cache) holding a header.json and
+# one .npy file per array. The arrays are opened with np.load(mmap_mode='r'), which maps them
+# into memory without copying. The header records the size and modification time of the source
+# file, and the cache is only used while both still match. An edit that keeps the length can't
+# be told from a touch without reading the whole file, so any change of the modification time
+# invalidates the cache. A hash of samples of the file is recorded along with them.
+
+import os
+import json
+import hashlib
+import argparse
+import numpy as np
+
+from geojson_io import loads, setProperties
+
+VERSION = 1
+
+# The graph arrays, every run of chain_rivers.py with a cache writes these
+GRAPH_ARRAYS = ['endpoints', 'source', 'target', 'offsets', 'lengths']
+
+# The stream orders, added once they have been calculated
+ORDER_ARRAYS = ['strahler', 'shreve']
+
+# The sidecar of an output of chain_rivers.py is a cache of the output file itself, holding
+# the graph, the orders and the feature ids, which is all an incremental update needs
+SIDECAR_ARRAYS = GRAPH_ARRAYS + ORDER_ARRAYS + ['ids']
+
+# The number of bytes hashed at the start, middle and end of the source file. Hashing
+# samples keeps writing the signature fast on very large files.
+HASH_BLOCK = 1 << 20
+
+def cachePath(path, cacheDir=None):
+    return os.path.join(cacheDir or os.path.dirname(os.path.abspath(path)), os.path.basename(path) + '.cache')
+
+def sourceHash(path, size):
+    h = hashlib.sha256(str(size).encode('utf-8'))
+    with open(path, 'rb') as f:
+        for offset in sorted(set([0, max(0, size // 2 - HASH_BLOCK // 2), max(0, size - HASH_BLOCK)])):
+            f.seek(offset)
+            h.update(f.read(HASH_BLOCK))
+    return h.hexdigest()
+
+def sourceSignature(path):
+    stat = os.stat(path)
+    return {'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'hash': sourceHash(path, stat.st_size)}
+
+def readHeader(cache):
+    try:
+        with open(os.path.join(cache, 'header.json')) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return None
+
+def writeHeader(cache, header):
+    # Write to a temporary file first, so an interrupted run never leaves a broken header behind
+    name = os.path.join(cache, 'header.json')
+    with open(name + '.tmp', 'w') as f:
+        json.dump(header, f, indent=2)
+    os.replace(name + '.tmp', name)
+
+def isValid(path, header, version=VERSION):
+    if not header or header.get('version') != version:
+        return False
+
+    stat = os.stat(path)
+    return stat.st_size == header['size'] and stat.st_mtime_ns == header['mtime']
+
+# Open the cache of the given source file, returns None when there is no cache or when
+# the source file has changed since it was written. The arrays are returned memory mapped,
+# in a dict together with the header fields. With options, e.g. the snapping tolerance,
+# the cache is only used when it was built with the same options.
+def loadCache(path, cacheDir=None, arrays=GRAPH_ARRAYS, options=None):
+    cache = cachePath(path, cacheDir)
+    header = readHeader(cache)
+    if not isValid(path, header):
+        return None
+    if options is not None and header.get('options') != options:
+        return None
+
+    graph = dict(header)
+    for name in arrays:
+        if not name in header['arrays']:
+            return None
+        graph[name] = np.load(os.path.join(cache, name + '.npy'), mmap_mode='r')
+
+    return graph
+
+# Write the graph arrays of the given source file to its cache, replacing any older cache
+def writeCache(path, nodeCount, arrays, cacheDir=None, options=None):
+    cache = cachePath(path, cacheDir)
+    if not os.path.isdir(cache):
+        os.makedirs(cache)
+
+    for name in arrays:
+        np.save(os.path.join(cache, name + '.npy'), arrays[name])
+
+    header = {'version': VERSION, 'source': os.path.abspath(path), 'count': len(arrays['source']),
+              'nodeCount': int(nodeCount), 'arrays': sorted(arrays), 'options': options or {}}
+    header.update(sourceSignature(path))
+    writeHeader(cache, header)
+
+# Add arrays, e.g. the stream orders, to an existing cache
+def updateCache(path, arrays, cacheDir=None):
+    cache = cachePath(path, cacheDir)
+    header = readHeader(cache)
+    if not isValid(path, header):
+        return False
+
+    for name in arrays:
+        np.save(os.path.join(cache, name + '.npy'), arrays[name])
+
+    header['arrays'] = sorted(set(header['arrays']) | set(arrays))
+    writeHeader(cache, header)
+    return True
+
+# Yield the features of the source file with the orders from the cache added to their properties,
+# reading only the byte ranges of the features
+def readCachedFeatures(path, graph):
+    with open(path, 'rb') as f:
+        for offset, length, strahler, shreve in zip(graph['offsets'], graph['lengths'], graph['strahler'], graph['shreve']):
+            f.seek(offset)
+            feature = loads(f.read(length))
+            yield setProperties(feature, {'STRAHLER': int(strahler), 'SHREVE': int(shreve)})
+
+if __name__ == "__main__":
+    # parse arguments
+    parser = argparse.ArgumentParser(description='Show the state of the river graph caches of the given geojson files.')
+    parser.add_argument('--cache-dir', help='the directory the caches are kept in, next to the source files by default')
+    parser.add_argument('files', nargs='+', help='one or more geojson files')
+    args = parser.parse_args()
+
+    for f in args.files:
+        header = readHeader(cachePath(f, args.cache_dir))
+        if not header:
+            print(f + ': no cache')
+        elif not isValid(f, header):
+            print(f + ': stale cache')
+        else:
+            print(f + ': ' + str(header['count']) + ' segments, ' + str(header['nodeCount']) + ' nodes, arrays: ' + ', '.join(header['arrays']))
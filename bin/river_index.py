@@ -0,0 +1,328 @@
+#!/usr/bin/env python
+
+# A packed static R-tree over the features of a GeoJSON file, so bounding box queries (a
+# catchment, a tile) read only the matching features instead of parsing the whole file.
+#
+# The features are sorted by the Hilbert code of the centre of their bounding box and packed
+# into a tree of NODE_SIZE children per node, laid out level by level from the root down like
+# the index of FlatGeobuf. The leaves are the bounding boxes of the features, in the same
+# order as a table of the byte offsets and lengths of the features in the file.
+#
+# The index is a directory next to the source file (<name>.index) with a header.json and one
+# .npy file per array, validated against the source file like the river graph cache (see
+# river_cache.py). The arrays are memory mapped, a query visits O(log n + k) nodes and only
+# the pages of the tree it touches are read, followed by the byte ranges of the k features.
+#
+# Numeric properties of the features (like the stream orders) can be kept in the index as
+# well, one float64 array per property in the order of the leaves with NaN where a feature
+# doesn't have it, so tools like tile_server.py can select features without reading them.
+
+import os
+import sys
+import argparse
+import numpy as np
+
+from geojson_io import readFeatures as readGeojsonFeatures, FeatureWriter, loads
+from river_cache import readHeader, writeHeader, isValid, sourceSignature
+import instrument
+
+VERSION = 1
+
+# The number of children of every node of the tree
+NODE_SIZE = 16
+
+# The largest Hilbert curve coordinate, the curve is 2^16 x 2^16
+HILBERT_MAX = (1 << 16) - 1
+
+INDEX_ARRAYS = ['boxes', 'offsets', 'lengths', 'ids']
+
+def propertyArray(name):
+    return 'property_' + name
+
+def indexPath(path, indexDir=None):
+    return os.path.join(indexDir or os.path.dirname(os.path.abspath(path)), os.path.basename(path) + '.index')
+
+def interleave(x):
+    x = (x | (x << 8)) & 0x00FF00FF
+    x = (x | (x << 4)) & 0x0F0F0F0F
+    x = (x | (x << 2)) & 0x33333333
+    x = (x | (x << 1)) & 0x55555555
+    return x
+
+# The Hilbert codes of the given uint32 x, y arrays of values up to HILBERT_MAX, computed
+# branch free for whole arrays at once (the algorithm of flatbush and FlatGeobuf)
+def hilbertCodes(x, y):
+    x = np.asarray(x, dtype=np.uint32)
+    y = np.asarray(y, dtype=np.uint32)
+    mask = np.uint32(0xFFFF)
+
+    a = x ^ y
+    b = mask ^ a
+    c = mask ^ (x | y)
+    d = x & (y ^ mask)
+
+    A = a | (b >> 1)
+    B = (a >> 1) ^ a
+    C = ((c >> 1) ^ (b & (d >> 1))) ^ c
+    D = ((a & (c >> 1)) ^ (d >> 1)) ^ d
+
+    for shift in (2, 4):
+        a, b, c, d = A, B, C, D
+        A = (a & (a >> shift)) ^ (b & (b >> shift))
+        B = (a & (b >> shift)) ^ (b & ((a ^ b) >> shift))
+        C = C ^ ((a & (c >> shift)) ^ (b & (d >> shift)))
+        D = D ^ ((b & (c >> shift)) ^ ((a ^ b) & (d >> shift)))
+
+    a, b, c, d = A, B, C, D
+    C = C ^ ((a & (c >> 8)) ^ (b & (d >> 8)))
+    D = D ^ ((b & (c >> 8)) ^ ((a ^ b) & (d >> 8)))
+
+    a = C ^ (C >> 1)
+    b = D ^ (D >> 1)
+    i0 = x ^ y
+    i1 = b | (mask ^ (i0 | a))
+    return (interleave(i1) << 1) | interleave(i0)
+
+# The lists of positions in the nested coordinate arrays of a geometry
+def positionLists(coordinates):
+    stack = [coordinates]
+    while stack:
+        item = stack.pop()
+        if not item:
+            continue
+        if isinstance(item[0], (int, float)):
+            yield [item]
+        elif isinstance(item[0][0], (int, float)):
+            yield item
+        else:
+            stack.extend(item)
+
+# The [west, south, east, north] of the geometry of a feature, or None when it has no positions
+def featureBounds(feature):
+    geometry = feature.get('geometry') or {}
+    bounds = None
+    for g in geometry.get('geometries') or [geometry]:
+        for positions in positionLists(g.get('coordinates')):
+            positions = np.array([p[:2] for p in positions], dtype=np.float64)
+            lower, upper = positions.min(axis=0), positions.max(axis=0)
+            if bounds is None:
+                bounds = [lower[0], lower[1], upper[0], upper[1]]
+            else:
+                bounds = [min(bounds[0], lower[0]), min(bounds[1], lower[1]), max(bounds[2], upper[0]), max(bounds[3], upper[1])]
+    return bounds
+
+# The (start, count) of every level of the tree of n leaves, from the root down to the leaves
+def levelBounds(n, nodeSize=NODE_SIZE):
+    counts = [n]
+    while counts[-1] > 1:
+        counts.append(-(-counts[-1] // nodeSize))
+    counts.reverse()
+    levels = []
+    start = 0
+    for count in counts:
+        levels.append((start, count))
+        start += count
+    return levels
+
+# Sort the boxes by the Hilbert code of their centres and build the tree, returns the boxes of
+# all nodes, from the root down, and the order of the leaves
+def buildTree(boxes, nodeSize=NODE_SIZE):
+    boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+    if len(boxes) == 0:
+        return np.zeros((0, 4)), np.zeros(0, dtype=np.int64), []
+
+    west, south = boxes[:, 0].min(), boxes[:, 1].min()
+    width = max(boxes[:, 2].max() - west, 1e-12)
+    height = max(boxes[:, 3].max() - south, 1e-12)
+    x = np.floor(HILBERT_MAX * ((boxes[:, 0] + boxes[:, 2]) / 2 - west) / width)
+    y = np.floor(HILBERT_MAX * ((boxes[:, 1] + boxes[:, 3]) / 2 - south) / height)
+    order = np.argsort(hilbertCodes(x, y), kind='stable')
+
+    levels = levelBounds(len(boxes), nodeSize)
+    tree = np.empty((levels[-1][0] + levels[-1][1], 4))
+    level = boxes[order]
+    tree[levels[-1][0]:] = level
+
+    # Every node covers the boxes of its children
+    for start, count in reversed(levels[:-1]):
+        groups = np.arange(0, len(level), nodeSize)
+        level = np.column_stack([
+            np.minimum.reduceat(level[:, 0], groups), np.minimum.reduceat(level[:, 1], groups),
+            np.maximum.reduceat(level[:, 2], groups), np.maximum.reduceat(level[:, 3], groups)])
+        tree[start:start + count] = level
+
+    return tree, order, levels
+
+# Read the features of the source file and write its index, replacing any older index.
+# Features without positions can't be found by a bounding box and are left out.
+# The numeric properties named in properties are kept in the index too.
+def buildIndex(path, indexDir=None, nodeSize=NODE_SIZE, metrics=None, properties=()):
+    if metrics:
+        metrics.start('Reading')
+    boxes = []
+    offsets = []
+    lengths = []
+    ids = []
+    values = dict((name, []) for name in properties)
+    with open(path, 'rb') as f:
+        for i, (offset, length, feature) in enumerate(readGeojsonFeatures(f, offsets=True)):
+            bounds = featureBounds(feature)
+            if bounds is None:
+                continue
+            boxes.append(bounds)
+            offsets.append(offset)
+            lengths.append(length)
+            ids.append(i)
+            featureProperties = feature.get('properties') or {}
+            for name in properties:
+                value = featureProperties.get(name)
+                values[name].append(value if isinstance(value, (int, float)) else np.nan)
+
+    if metrics:
+        metrics.stop(len(boxes))
+        metrics.start('Indexing')
+    tree, order, levels = buildTree(boxes, nodeSize)
+    arrays = {
+        'boxes': tree,
+        'offsets': np.asarray(offsets, dtype=np.uint64)[order],
+        'lengths': np.asarray(lengths, dtype=np.uint32)[order],
+        'ids': np.asarray(ids, dtype=np.uint32)[order],
+    }
+    for name in properties:
+        arrays[propertyArray(name)] = np.asarray(values[name], dtype=np.float64)[order]
+
+    index = indexPath(path, indexDir)
+    if not os.path.isdir(index):
+        os.makedirs(index)
+    for name in arrays:
+        np.save(os.path.join(index, name + '.npy'), arrays[name])
+
+    header = {'version': VERSION, 'source': os.path.abspath(path), 'count': len(boxes),
+              'nodeSize': nodeSize, 'levels': levels, 'arrays': list(arrays), 'properties': list(properties)}
+    header.update(sourceSignature(path))
+    writeHeader(index, header)
+    if metrics:
+        metrics.stop(len(boxes))
+    return header
+
+# Open the index of the given source file, returns None when there is no index or when the
+# source file has changed since it was built. The arrays are memory mapped.
+def loadIndex(path, indexDir=None):
+    index = indexPath(path, indexDir)
+    header = readHeader(index)
+    if not isValid(path, header, VERSION):
+        return None
+
+    tree = dict(header)
+    for name in header['arrays']:
+        tree[name] = np.load(os.path.join(index, name + '.npy'), mmap_mode='r')
+    return tree
+
+# The positions in the index (in Hilbert order) of the features whose bounding box intersects
+# the given [west, south, east, north], walking the tree one level at a time
+def query(index, bbox):
+    levels = index['levels']
+    if not levels:
+        return np.zeros(0, dtype=np.int64)
+
+    west, south, east, north = bbox
+    boxes = index['boxes']
+    nodeSize = index['nodeSize']
+    nodes = np.zeros(1, dtype=np.int64)
+    for i, (start, count) in enumerate(levels):
+        b = boxes[start + nodes]
+        nodes = nodes[(b[:, 0] <= east) & (b[:, 2] >= west) & (b[:, 1] <= north) & (b[:, 3] >= south)]
+        if i == len(levels) - 1 or len(nodes) == 0:
+            return nodes
+
+        children = (nodes[:, None] * nodeSize + np.arange(nodeSize)).ravel()
+        nodes = children[children < levels[i + 1][1]]
+
+# Yield the features at the given positions of the index, in the order they have in the
+# file, reading only their byte ranges
+def readIndexedFeatures(path, index, positions):
+    positions = positions[np.argsort(index['ids'][positions], kind='stable')]
+    with open(path, 'rb') as f:
+        for offset, length in zip(index['offsets'][positions], index['lengths'][positions]):
+            f.seek(int(offset))
+            yield loads(f.read(int(length)))
+
+# Yield the features of the source file whose bounding box intersects bbox, in the order they
+# have in the file, reading only their byte ranges
+def readFeatures(path, index, bbox):
+    return readIndexedFeatures(path, index, query(index, bbox))
+
+def intersects(bounds, bbox):
+    return bounds is not None and bounds[0] <= bbox[2] and bounds[2] >= bbox[0] and bounds[1] <= bbox[3] and bounds[3] >= bbox[1]
+
+def parseBbox(text):
+    try:
+        bbox = [float(v) for v in text.split(',')]
+    except ValueError:
+        bbox = []
+    if len(bbox) != 4:
+        raise argparse.ArgumentTypeError('a bounding box is given as west,south,east,north, not ' + text)
+    return bbox
+
+def parseNames(text):
+    return [name.strip() for name in text.split(',') if name.strip()]
+
+# The commands return the reports of their runs, written to the --metrics file
+def build(args):
+    runs = []
+    for f in args.files:
+        metrics = instrument.Metrics(f, args.time, args.verbose, args.tracemalloc)
+        header = buildIndex(f, args.index_dir, args.node_size, metrics, args.properties or ())
+        metrics.count(features=header['count'], levels=len(header['levels']))
+        print (f + ': ' + str(header['count']) + ' features in ' + str(len(header['levels'])) + ' levels')
+        runs.append(metrics.report())
+    return runs
+
+def search(args):
+    metrics = instrument.Metrics(args.file, args.time, args.verbose, args.tracemalloc)
+    index = loadIndex(args.file, args.index_dir)
+    if index is None:
+        buildIndex(args.file, args.index_dir, args.node_size, metrics)
+        index = loadIndex(args.file, args.index_dir)
+
+    metrics.start('Querying')
+    count = 0
+    o = open(args.output, 'wb') if args.output else sys.stdout
+    with FeatureWriter(o, args.ndjson) as writer:
+        for feature in readFeatures(args.file, index, args.bbox):
+            writer.write(feature)
+            count += 1
+    if args.output:
+        o.close()
+    metrics.stop(count)
+    metrics.count(features=count)
+    return [metrics.report()]
+
+if __name__ == "__main__":
+    # parse arguments
+    parser = argparse.ArgumentParser(description='Build packed Hilbert R-tree indexes of geojson files and query them by bounding box.')
+    parser.add_argument('-v','--verbose', help="increase output verbosity", action='store_true')
+    parser.add_argument('-t','--time', help="calculate and display time taken", action='store_true')
+    parser.add_argument('--index-dir', help='the directory the indexes are kept in, next to the source files by default')
+    parser.add_argument('--node-size', type=int, default=NODE_SIZE, help='the number of children of every node of the tree')
+    instrument.addArguments(parser)
+    commands = parser.add_subparsers(dest='name')
+    commands.required = True
+
+    buildParser = commands.add_parser('build', help='build or rebuild the indexes of geojson files')
+    buildParser.add_argument('-p','--properties', type=parseNames, metavar='NAME[,NAME...]', help='comma separated numeric properties to keep in the index, e.g. SHREVE,STRAHLER')
+    buildParser.add_argument('files', nargs='+', help='one or more geojson files')
+    buildParser.set_defaults(command=build)
+
+    queryParser = commands.add_parser('query', help='write the features of a geojson file that intersect a bounding box, building its index when needed')
+    queryParser.add_argument('--bbox', type=parseBbox, required=True, help='west,south,east,north')
+    queryParser.add_argument('-n','--ndjson', help="write newline delimited geojson instead of a FeatureCollection", action='store_true')
+    queryParser.add_argument('-o','--output', help='the file to write the features to, standard output by default')
+    queryParser.add_argument('file', help='a geojson file')
+    queryParser.set_defaults(command=search)
+
+    args = parser.parse_args()
+    runs = instrument.runProfiled(args.profile, args.command, args)
+
+    if args.metrics:
+        instrument.writeReport(args.metrics, 'river_index', runs)
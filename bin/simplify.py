@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+
+# In-process polyline simplification for the LOD pipeline, replacing the mapshaper -filter
+# and -simplify steps of simplify_rivers.sh.
+#
+# Douglas-Peucker is run on a whole batch of polylines at once: every iteration handles the
+# open ranges of all polylines together with array operations, so the number of iterations
+# is the depth of the recursion rather than the number of polylines.
+
+import re
+import argparse
+import numpy as np
+
+# Distances are measured in degrees in the plane, the tolerances are in degrees as well
+def segmentDistances(points, a, b):
+    # The distance of every point to the segment from a to b
+    ab = b - a
+    lengths = (ab ** 2).sum(axis=1)
+    t = np.where(lengths > 0, ((points - a) * ab).sum(axis=1) / np.where(lengths > 0, lengths, 1), 0)
+    t = np.clip(t, 0, 1)
+    return np.sqrt(((points - (a + t[:, None] * ab)) ** 2).sum(axis=1))
+
+# Simplify a list of polylines (arrays of positions, x and y first) with the given tolerance.
+# Returns the simplified polylines, which always keep their first and last positions.
+def simplifyPolylines(polylines, tolerance):
+    polylines = [np.asarray(p, dtype=np.float64) for p in polylines]
+    if tolerance <= 0 or not polylines:
+        return polylines
+
+    counts = np.array([len(p) for p in polylines], dtype=np.int64)
+    ends = np.cumsum(counts)
+    starts = ends - counts
+    if ends[-1] == 0:
+        return polylines
+
+    xy = np.concatenate([p[:, :2] for p in polylines if len(p)])
+
+    keep = np.zeros(len(xy), dtype=bool)
+    keep[starts[counts > 0]] = True
+    keep[ends[counts > 0] - 1] = True
+
+    # The open ranges: the positions between a and b are still to be decided on
+    a = starts[counts > 2]
+    b = ends[counts > 2] - 1
+
+    while len(a):
+        interior = b - a - 1
+        a = a[interior > 0]
+        b = b[interior > 0]
+        interior = interior[interior > 0]
+        if len(a) == 0:
+            break
+
+        # All interior positions of all ranges, with the range they belong to
+        offsets = np.cumsum(interior) - interior
+        ranges = np.repeat(np.arange(len(a)), interior)
+        index = np.arange(interior.sum()) - np.repeat(offsets, interior) + np.repeat(a + 1, interior)
+
+        distances = segmentDistances(xy[index], xy[a[ranges]], xy[b[ranges]])
+
+        # The farthest position of every range, the first one when there are several
+        farthest = np.maximum.reduceat(distances, offsets)
+        candidates = np.where(distances == farthest[ranges], index, len(xy))
+        split = np.minimum.reduceat(candidates, offsets)
+
+        # Ranges whose farthest position is within the tolerance are done, the others are split
+        far = farthest > tolerance
+        keep[split[far]] = True
+        a, b = np.concatenate((a[far], split[far])), np.concatenate((split[far], b[far]))
+
+    return [p[keep[s:e]] for p, s, e in zip(polylines, starts, ends)]
+
+# The tolerance of every LOD, from the coarsest to the most detailed LOD. The most detailed LOD
+# gets the given tolerance, and it grows by factor for every coarser LOD.
+def lodTolerances(tolerance, lods, factor=2):
+    return [tolerance * factor ** (lods - 1 - i) for i in range(lods)]
+
+# Simplify the LineString and MultiLineString geometries of a batch of features. Returns copies
+# of the features, so the same features can be simplified with other tolerances as well.
+def simplifyFeatures(features, tolerance):
+    lines = []
+    for feature in features:
+        geometry = feature.get('geometry') or {}
+        if geometry.get('type') == 'LineString':
+            lines.append(geometry['coordinates'])
+        elif geometry.get('type') == 'MultiLineString':
+            lines.extend(geometry['coordinates'])
+
+    simplified = iter(simplifyPolylines(lines, tolerance))
+
+    result = []
+    for feature in features:
+        geometry = feature.get('geometry') or {}
+        if geometry.get('type') == 'LineString':
+            coordinates = next(simplified).tolist()
+        elif geometry.get('type') == 'MultiLineString':
+            coordinates = [next(simplified).tolist() for line in geometry['coordinates']]
+        else:
+            result.append(feature)
+            continue
+
+        copied = dict(feature)
+        copied['geometry'] = dict(geometry, coordinates=coordinates)
+        result.append(copied)
+
+    return result
+
+FILTER = re.compile(r'^\s*(\w+)\s*(>=|<=|==|!=|>|<)\s*(-?[0-9.eE+-]+)\s*$')
+
+OPERATORS = {
+    '>': lambda a, b: a > b,
+    '>=': lambda a, b: a >= b,
+    '<': lambda a, b: a < b,
+    '<=': lambda a, b: a <= b,
+    '==': lambda a, b: a == b,
+    '!=': lambda a, b: a != b
+}
+
+# Parse a filter on a numeric property, like mapshaper's -filter 'UP_CELLS > 2000'.
+# Returns a function that tells whether a feature passes the filter.
+def parseFilter(text):
+    match = FILTER.match(text)
+    if not match:
+        raise argparse.ArgumentTypeError('filters look like "UP_CELLS > 2000", not ' + repr(text))
+
+    key, operator, value = match.group(1), OPERATORS[match.group(2)], float(match.group(3))
+    def passes(feature):
+        v = (feature.get('properties') or {}).get(key)
+        return v is not None and operator(v, value)
+    return passes
@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+
+# Split a catalog init file (e.g. wwwroot/init/nm.json) into a file per top level catalog
+# entry, and merge such files back into an init file. This replaces the jq loops of
+# buildprocess/split-catalog.sh and split-groups.sh, which parsed the init file again for
+# every entry. The init file is parsed once here, and no questions are asked.
+#
+# split writes the init file without its catalog to 000_settings.json and every catalog
+# entry to NN_Name.json as {"catalog": [entry]}. With --groups, the named groups are split
+# further into a directory named after their file, holding a NN_MM_Name.json per item with
+# the group around it, as split-groups.sh did. A named group without items is written whole,
+# like any other entry, so it isn't lost.
+#
+# merge reads the settings and the catalog entries back from a directory, in the order of
+# the file names. Consecutive copies of a group from the same group directory have their
+# items joined again.
+#
+# Both only write the files whose content changed, compared by a hash of their bytes, so
+# that timestamps (and watchers like the gulp datasource task) only see real changes.
+# --prune removes the .json files of the output directory that were not written.
+
+import os
+import json
+import hashlib
+import argparse
+
+import instrument
+
+SETTINGS_FILE = '000_settings.json'
+
+def serialize(value):
+    return (json.dumps(value, indent=2, ensure_ascii=False) + '\n').encode('utf-8')
+
+def contentHash(data):
+    return hashlib.sha1(data).hexdigest()
+
+def fileHash(path):
+    try:
+        with open(path, 'rb') as f:
+            return contentHash(f.read())
+    except IOError:
+        return None
+
+# Zero padded, so that the file names sort in the order of the entries
+def prefix(index, count):
+    return str(index).zfill(max(2, len(str(count - 1))))
+
+def fileName(number, name):
+    # Spaces become underscores like in the shell scripts, path separators can't be kept
+    name = str(name).replace(' ', '_').replace('/', '_').replace(os.sep, '_')
+    return number + '_' + name + '.json'
+
+class Writer(object):
+    '''Writes files whose content changed, keeping track of what it wrote and skipped.'''
+
+    def __init__(self, verbose=False):
+        self.verbose = verbose
+        self.paths = set()
+        self.written = 0
+        self.unchanged = 0
+
+    def write(self, path, value):
+        data = serialize(value)
+        self.paths.add(os.path.abspath(path))
+        if fileHash(path) == contentHash(data):
+            self.unchanged += 1
+            return False
+
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with open(path, 'wb') as o:
+            o.write(data)
+        self.written += 1
+        if (self.verbose):
+            print ('Wrote ' + path)
+        return True
+
+    # Remove the .json files under directory that weren't written or found unchanged
+    def prune(self, directory):
+        removed = 0
+        for root, dirs, files in os.walk(directory):
+            for name in files:
+                path = os.path.abspath(os.path.join(root, name))
+                if name.endswith('.json') and path not in self.paths:
+                    os.remove(path)
+                    removed += 1
+                    if (self.verbose):
+                        print ('Removed ' + path)
+        return removed
+
+# The files of a split init file as (path, content) pairs
+def splitCatalog(init, outputDir, groups=()):
+    settings = dict((key, value) for key, value in init.items() if key != 'catalog')
+    files = [(os.path.join(outputDir, SETTINGS_FILE), settings)]
+
+    catalog = init.get('catalog', [])
+    for i, entry in enumerate(catalog):
+        name = fileName(prefix(i, len(catalog)), entry.get('name'))
+        if entry.get('name') not in groups or not entry.get('items'):
+            files.append((os.path.join(outputDir, name), {'catalog': [entry]}))
+            continue
+
+        # A group split into a file per item, each with the group around it
+        groupDir = os.path.join(outputDir, os.path.splitext(name)[0])
+        items = entry.get('items', [])
+        for j, item in enumerate(items):
+            group = dict(entry)
+            group['items'] = [item]
+            itemName = fileName(prefix(i, len(catalog)) + '_' + prefix(j, len(items)), item.get('name'))
+            files.append((os.path.join(groupDir, itemName), {'catalog': [group]}))
+    return files
+
+# The .json files under a directory in the order of their file names, group directories
+# sorting with the file they replace
+def catalogFiles(directory):
+    entries = []
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        if os.path.isdir(path):
+            entries.extend((name + '/' + sub, os.path.join(path, sub)) for sub in os.listdir(path) if sub.endswith('.json'))
+        elif name.endswith('.json') and name != SETTINGS_FILE:
+            entries.append((os.path.splitext(name)[0], path))
+    return [path for key, path in sorted(entries)]
+
+# The init file of the settings and catalog files in a directory
+def mergeCatalog(directory):
+    settingsPath = os.path.join(directory, SETTINGS_FILE)
+    init = {}
+    if os.path.exists(settingsPath):
+        with open(settingsPath) as f:
+            init.update(json.load(f))
+
+    catalog = []
+    previousDir = None
+    for path in catalogFiles(directory):
+        with open(path) as f:
+            entries = json.load(f).get('catalog', [])
+        fileDir = os.path.dirname(path)
+        for entry in entries:
+            # Join the items of a group that was split into a directory
+            previous = catalog[-1] if catalog else None
+            if (fileDir == previousDir and fileDir != directory and previous is not None
+                    and previous.get('name') == entry.get('name') and 'items' in entry):
+                previous['items'] = previous.get('items', []) + entry['items']
+            else:
+                catalog.append(entry)
+        previousDir = fileDir
+
+    init['catalog'] = catalog
+    return init
+
+def split(args, metrics, writer):
+    metrics.start('Reading')
+    with open(args.init) as f:
+        init = json.load(f)
+    metrics.stop(len(init.get('catalog', [])))
+
+    metrics.start('Writing')
+    files = splitCatalog(init, args.output_dir, set(args.groups or []))
+    for path, content in files:
+        writer.write(path, content)
+    removed = writer.prune(args.output_dir) if args.prune else 0
+    metrics.stop(len(files))
+    return removed
+
+def merge(args, metrics, writer):
+    metrics.start('Reading')
+    init = mergeCatalog(args.input_dir)
+    metrics.stop(len(init['catalog']))
+
+    metrics.start('Writing')
+    writer.write(args.init, init)
+    metrics.stop(1)
+    return 0
+
+def main(args):
+    metrics = instrument.Metrics(args.init, args.time, args.verbose, args.tracemalloc)
+    writer = Writer(args.verbose)
+    removed = args.command(args, metrics, writer)
+
+    print (str(writer.written) + ' files written, ' + str(writer.unchanged) + ' unchanged' +
+           (', ' + str(removed) + ' removed' if removed else ''))
+    metrics.count(written=writer.written, unchanged=writer.unchanged, removed=removed)
+    if args.metrics:
+        instrument.writeReport(args.metrics, 'split_catalog', [metrics.report()])
+
+if __name__ == "__main__":
+    # parse arguments
+    parser = argparse.ArgumentParser(description='Split a catalog init file into a file per catalog entry, or merge such files back into an init file.')
+    parser.add_argument('-v','--verbose', help="increase output verbosity", action='store_true')
+    parser.add_argument('-t','--time', help="calculate and display time taken", action='store_true')
+    instrument.addArguments(parser)
+    commands = parser.add_subparsers(dest='name')
+    commands.required = True
+
+    splitParser = commands.add_parser('split', help='split an init file into a directory')
+    splitParser.add_argument('init', help='the init file, e.g. wwwroot/init/nm.json')
+    splitParser.add_argument('output_dir', nargs='?', default='datasources', help='the directory to write the files to')
+    splitParser.add_argument('-g','--groups', nargs='+', metavar='NAME', help='split these top level groups into a file per item, e.g. "National Data Sets"')
+    splitParser.add_argument('--prune', help="remove the .json files in the output directory that are not part of the init file", action='store_true')
+    splitParser.set_defaults(command=split)
+
+    mergeParser = commands.add_parser('merge', help='merge a directory into an init file')
+    mergeParser.add_argument('input_dir', help='the directory split was written to')
+    mergeParser.add_argument('init', help='the init file to write')
+    mergeParser.set_defaults(command=merge)
+
+    args = parser.parse_args()
+    instrument.runProfiled(args.profile, main, args)
@@ -0,0 +1,147 @@
+import os
+import sys
+import json
+import random
+import subprocess
+import pytest
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from chain_rivers import getStrahlerAndShreve, getStrahlerAndShreveColumnar, getMeasures, buildNodeIds, snapNodes, labelComponents, MEASURES
+
+SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'chain_rivers.py')
+
+def orders(nodeCount, source, target):
+    strahler, shreve = getStrahlerAndShreve(source, target)
+    columnarStrahler, columnarShreve = getStrahlerAndShreveColumnar(nodeCount, np.array(source, dtype=np.int64), np.array(target, dtype=np.int64))
+    return (strahler, shreve), (columnarStrahler.tolist(), columnarShreve.tolist())
+
+class TestChainRivers(object):
+
+    def test_tree(self):
+        # Two pairs of first order streams join, and the resulting second order streams join again
+        source = [0, 1, 2, 3, 4, 5, 6]
+        target = [4, 4, 5, 5, 6, 6, 7]
+        python, columnar = orders(8, source, target)
+        assert python == columnar == ([1, 1, 1, 1, 2, 2, 3], [1, 1, 1, 1, 2, 2, 4])
+
+    def test_loops_are_broken_at_the_same_node(self):
+        # Two tributaries flow into a node where two segments start that both flow back into it
+        python, columnar = orders(3, [1, 1, 0, 0], [0, 0, 0, 0])
+        assert python == columnar == ([1, 1, 2, 2], [1, 1, 2, 2])
+
+    def test_random_cyclic_networks(self):
+        for seed in range(500):
+            rnd = random.Random(seed)
+            nodeCount = rnd.randint(2, 40)
+            count = rnd.randint(1, 60)
+            source = [rnd.randrange(nodeCount) for i in range(count)]
+            target = [rnd.randrange(nodeCount) for i in range(count)]
+            python, columnar = orders(nodeCount, source, target)
+            assert python == columnar, (source, target)
+
+    def test_long_chain(self):
+        count = 10000
+        source = np.arange(count)
+        target = np.arange(1, count + 1)
+        strahler, shreve, measures = getMeasures(count + 1, source, target, np.ones(count), list(MEASURES))
+        assert (strahler == 1).all() and (shreve == 1).all()
+        assert measures['upstream_count'].tolist() == list(range(1, count + 1))
+        assert measures['outlet_distance'].tolist() == list(range(count, 0, -1))
+        assert (measures['main_stem'] == count - 1).all()
+
+# The connected components of the points within the tolerance of each other, comparing all pairs
+def bruteForceLabels(points, tolerance):
+    distances = ((points[:, None] - points[None]) ** 2).sum(axis=2)
+    first, second = np.nonzero(np.triu(distances <= tolerance * tolerance, 1))
+    return labelComponents(len(points), first, second)
+
+def samePartition(a, b):
+    pairs = set(zip(a.tolist(), b.tolist()))
+    return len(pairs) == len(set(a.tolist())) == len(set(b.tolist()))
+
+class TestSnapNodes(object):
+
+    def test_matches_brute_force(self):
+        rnd = random.Random(2)
+        for tolerance in (0.001, 0.01, 0.05):
+            points = np.array([[rnd.uniform(-0.2, 0.2), rnd.uniform(130, 130.3)] for i in range(400)])
+            labels = snapNodes(points, tolerance)
+            assert samePartition(labels, bruteForceLabels(points, tolerance))
+
+    def test_tolerance_bounds(self):
+        # Points exactly at the tolerance join, chains of close points join as a whole
+        points = np.array([[0.0, 0.0], [0.5, 0.0], [1.0, 0.0], [1.5, 0.001], [5.0, 5.0]])
+        labels = snapNodes(points, 0.5)
+        assert len(set(labels[:3].tolist())) == 1
+        assert labels[3] != labels[2] and labels[4] != labels[0]
+        assert len(snapNodes(np.zeros((0, 2)), 1)) == 0
+        with pytest.raises(ValueError):
+            snapNodes(np.array([[-1e20, 0.0], [1e20, 0.0]]), 1e-3)
+
+    def test_snapped_endpoints_share_a_node(self):
+        endpoints = np.array([[[0, 0], [1, 1]], [[1.0000001, 1], [2, 2]], [[2.1, 2], [3, 3]]], dtype=np.float64)
+        nodeCount, source, target = buildNodeIds(endpoints)
+        assert nodeCount == 6
+        nodeCount, source, target = buildNodeIds(endpoints, 1e-6)
+        assert nodeCount == 5 and target[0] == source[1] and target[1] != source[2]
+
+# A random tree of segments flowing towards the outlet of node 0, every segment of node i
+# flows into a node with a lower number
+def riverNetwork(rnd, count):
+    nodes = [[rnd.uniform(140, 150), rnd.uniform(-30, -20)] for i in range(count + 1)]
+    features = []
+    for i in range(1, count + 1):
+        target = rnd.randrange(i)
+        features.append({'type': 'Feature', 'properties': {'ARCID': i},
+                         'geometry': {'type': 'LineString', 'coordinates': [nodes[i], [(nodes[i][0] + nodes[target][0]) / 2, nodes[i][1]], nodes[target]]}})
+    return nodes, features
+
+def readOutput(path):
+    with open(path) as f:
+        return json.load(f)['features']
+
+class TestUpdate(object):
+
+    def run(self, cwd, *args):
+        subprocess.check_call([sys.executable, SCRIPT] + list(args), cwd=cwd, stdout=subprocess.DEVNULL)
+
+    @pytest.mark.parametrize('measures', [None, 'all'])
+    def test_update_matches_a_full_recalculation(self, tmpdir, measures):
+        rnd = random.Random(4)
+        nodes, features = riverNetwork(rnd, 300)
+        options = ['--measures', measures] if measures else []
+        tmpdir.join('rivers.json').write(json.dumps({'type': 'FeatureCollection', 'features': features}))
+        self.run(str(tmpdir), '--sidecar', *(options + ['rivers.json']))
+
+        # Reattach, remove and add segments
+        edits = []
+        edited = []
+        for feature in features:
+            i = feature['properties']['ARCID']
+            if i % 23 == 0:
+                edits.append({'type': 'Feature', 'properties': {'ARCID': i}, 'geometry': None})
+                continue
+            if i % 17 == 0:
+                coordinates = feature['geometry']['coordinates']
+                feature = {'type': 'Feature', 'properties': {'ARCID': i},
+                           'geometry': {'type': 'LineString', 'coordinates': [coordinates[0], nodes[rnd.randrange(i)]]}}
+                edits.append(feature)
+            edited.append(feature)
+        for i in range(5):
+            start = [rnd.uniform(140, 150), rnd.uniform(-30, -20)]
+            feature = {'type': 'Feature', 'properties': {'ARCID': 1000 + i},
+                       'geometry': {'type': 'LineString', 'coordinates': [start, nodes[rnd.randrange(len(nodes))]]}}
+            edits.append(feature)
+            edited.append(feature)
+
+        tmpdir.join('diff.json').write(json.dumps({'type': 'FeatureCollection', 'features': edits}))
+        self.run(str(tmpdir), '--update', 'diff.json', *(options + ['rivers_out.json']))
+
+        tmpdir.join('edited.json').write(json.dumps({'type': 'FeatureCollection', 'features': edited}))
+        self.run(str(tmpdir), '--columnar', *(options + ['edited.json']))
+
+        updated = readOutput(str(tmpdir.join('rivers_out.json')))
+        assert updated == readOutput(str(tmpdir.join('edited_out.json')))
+        assert len(updated) == 300 - 13 + 5
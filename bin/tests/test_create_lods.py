@@ -0,0 +1,186 @@
+import io
+import os
+import sys
+import json
+import struct
+import argparse
+import pytest
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import create_lods
+from create_lods import encodeTile, computeRegion, constructBatchTable, write_lods, lodThresholds, parseThresholds, MAX_SHORT
+from geojson_io import FeatureWriter, readFeatures
+
+SECTIONS = ['featureTableJSON', 'featureTableBinary', 'batchTableJSON', 'batchTableBinary',
+            'polygonIndices', 'polygonPositions', 'polylinePositions', 'pointPositions']
+
+# Split a vctr tile into its sections, the way Cesium reads it
+def readSections(tile):
+    magic, version, length = struct.unpack('<4sII', tile[:12])
+    assert magic == b'vctr' and version == 1 and length == len(tile)
+    lengths = struct.unpack('<8I', tile[12:44])
+    sections = {}
+    offset = 44
+    for name, size in zip(SECTIONS, lengths):
+        sections[name] = tile[offset:offset + size]
+        offset += size
+    assert offset == len(tile)
+    return sections
+
+def zigZagDeltaDecode(values):
+    values = values.astype(np.int64)
+    return np.cumsum((values >> 1) ^ -(values & 1))
+
+# Decode the positions of a section as Cesium does: the vertex count is the byte length divided
+# by 2 per component, the u, v (and h) planes follow each other
+def decodePositions(data, region, heights=True):
+    components = 3 if heights else 2
+    values = np.frombuffer(data, dtype=np.uint16)
+    assert len(values) % components == 0
+    count = len(values) // components
+    west, south, east, north, low, high = region
+    u = zigZagDeltaDecode(values[:count]) / MAX_SHORT
+    v = zigZagDeltaDecode(values[count:2 * count]) / MAX_SHORT
+    positions = [np.degrees(west + u * (east - west)), np.degrees(south + v * (north - south))]
+    if heights:
+        positions.append(low + zigZagDeltaDecode(values[2 * count:]) / MAX_SHORT * (high - low))
+    return np.column_stack(positions)
+
+class TestVctr(object):
+
+    def test_polyline_positions_decode(self):
+        line = [[130.0 + i * 0.1, -30.0 + (i % 3) * 0.05, float(i)] for i in range(7)]
+        other = [[131.0, -29.0, 2.0], [131.5, -29.9, 5.0]]
+        polylines = [{'properties': {'n': 1}, 'positions': line}, {'properties': {'n': 2}, 'positions': other}]
+        region = computeRegion([], polylines, [])
+        sections = readSections(encodeTile([], polylines, [], region))
+
+        # The position sections are not padded, 9 vertices of 3 uint16 components
+        assert len(sections['polylinePositions']) == 9 * 3 * 2
+        header = json.loads(sections['featureTableJSON'].decode('utf-8'))
+        assert header['POLYLINES_LENGTH'] == 2
+        counts = np.frombuffer(sections['featureTableBinary'], dtype=np.uint32, count=2,
+                               offset=header['POLYLINE_COUNTS']['byteOffset'])
+        assert counts.tolist() == [7, 2]
+
+        decoded = decodePositions(sections['polylinePositions'], header['REGION'])
+        expected = np.array(line + other)
+        assert np.allclose(decoded[:, :2], expected[:, :2], atol=1e-3)
+        assert np.allclose(decoded[:, 2], expected[:, 2], atol=1e-3)
+
+    def test_polygon_and_point_sections(self):
+        polygon = {'positions': [[1.0, 1.0, 0.0], [2.0, 2.0, 0.0], [3.0, 1.0, 0.0]], 'indices': [0, 1, 2]}
+        points = [{'position': [1.5, 1.5, 0.0]}]
+        region = [np.radians(0.0), np.radians(0.0), np.radians(4.0), np.radians(4.0), 0.0, 0.0]
+        sections = readSections(encodeTile([polygon], [], points, region))
+
+        assert np.frombuffer(sections['polygonIndices'], dtype=np.uint32).tolist() == [0, 1, 2]
+        assert np.allclose(decodePositions(sections['polygonPositions'], region, heights=False), np.array(polygon['positions'])[:, :2], atol=1e-3)
+        assert np.allclose(decodePositions(sections['pointPositions'], region), [[1.5, 1.5, 0.0]], atol=1e-3)
+
+    def test_table_sections_are_aligned(self):
+        polylines = [{'properties': {'name': 'a' * i}, 'positions': [[0.0, 0.0, 0.0], [1.0, 1.0, 0.0]]} for i in range(3)]
+        tile = encodeTile([], polylines, [])
+        lengths = struct.unpack('<8I', tile[12:44])
+        offset = 44
+        for size in lengths[:4]:
+            offset += size
+            assert offset % 8 == 0
+
+# Read the columns of a batch table, the binary ones as lists
+def readBatchTable(polygons, polylines, points):
+    batch, binary = constructBatchTable(polygons, polylines, points)
+    assert len(binary) % 8 == 0
+    columns = json.loads(batch)
+    rows = len(polygons) + len(polylines) + len(points)
+    for key, column in columns.items():
+        if isinstance(column, dict):
+            dtype = {'UNSIGNED_BYTE': np.uint8, 'BYTE': np.int8, 'UNSIGNED_SHORT': np.uint16, 'SHORT': np.int16,
+                     'UNSIGNED_INT': np.uint32, 'INT': np.int32, 'DOUBLE': np.float64}[column['componentType']]
+            assert column['byteOffset'] % np.dtype(dtype).itemsize == 0
+            columns[key] = (column['componentType'], np.frombuffer(binary, dtype=dtype, count=rows, offset=column['byteOffset']).tolist())
+    return columns
+
+class TestBatchTable(object):
+
+    def test_batch_ids_follow_the_sections(self):
+        polygons = [{'properties': {}}]
+        polylines = [{'properties': {'n': 1}}, {}]
+        points = [{'properties': {'n': 2}}]
+        columns = readBatchTable(polygons, polylines, points)
+        assert [p['batch_id'] for p in polygons + polylines + points] == [0, 1, 2, 3]
+        assert columns['id'] == ('UNSIGNED_SHORT', [0, 1, 2, 3])
+
+    def test_numeric_columns_are_binary(self):
+        features = [{'properties': {'small': i, 'negative': -i, 'large': i * 100000, 'real': i + 0.5}} for i in range(4)]
+        columns = readBatchTable([], features, [])
+        assert columns['small'] == ('UNSIGNED_BYTE', [0, 1, 2, 3])
+        assert columns['negative'] == ('BYTE', [0, -1, -2, -3])
+        assert columns['large'] == ('UNSIGNED_INT', [0, 100000, 200000, 300000])
+        assert columns['real'] == ('DOUBLE', [0.5, 1.5, 2.5, 3.5])
+
+    def test_missing_values_are_null(self):
+        features = [{'properties': {'name': 'a', 'n': 1}}, {'properties': {'other': True}}, {'properties': {'n': 3}}]
+        columns = readBatchTable([], features, [])
+        assert columns['name'] == ['a', None, None]
+        assert columns['other'] == [None, True, None]
+        # A numeric column that some features don't have stays JSON
+        assert columns['n'] == [1, None, 3]
+
+    def test_mixed_columns_are_json(self):
+        features = [{'properties': {'value': v, 'id': 'x%d' % i}} for i, v in enumerate([1, 'two', [3]])]
+        columns = readBatchTable([], features, [])
+        assert columns['value'] == [1, 'two', [3]]
+        # The own id properties of the features replace the batch ids
+        assert columns['id'] == ['x0', 'x1', 'x2']
+
+def riverFeatures():
+    features = []
+    for i, shreve in enumerate([1, 3, 8, None, 2, 40, 5, 1]):
+        properties = {'ARCID': i} if shreve is None else {'ARCID': i, 'SHREVE': shreve}
+        coordinates = [[i, 0.0], [i + 0.5, 0.001], [i + 1.0, 0.0]]
+        features.append({'type': 'Feature', 'properties': properties, 'geometry': {'type': 'LineString', 'coordinates': coordinates}})
+    return features
+
+class TestLodSplit(object):
+
+    def split(self, ndjson=False, tolerances=None, lod_tiles=None):
+        outputs = [io.BytesIO() for i in range(3)]
+        writers = [FeatureWriter(o, ndjson) for o in outputs]
+        counts = write_lods(riverFeatures(), writers, [8, 2, 1], 'SHREVE', lod_tiles, tolerances)
+        for w in writers:
+            w.close()
+        return counts, [list(readFeatures(io.BytesIO(o.getvalue()))) for o in outputs]
+
+    def test_thresholds(self):
+        assert lodThresholds(4) == [8, 4, 2, 1]
+        assert lodThresholds(3, 'log', 3) == [9, 3, 1]
+        assert lodThresholds(3, 'linear') == [3, 2, 1]
+        assert parseThresholds('100,10,1') == [100, 10, 1]
+        with pytest.raises(argparse.ArgumentTypeError):
+            parseThresholds('1,10')
+
+    @pytest.mark.parametrize('ndjson', [False, True])
+    def test_features_go_to_every_lod_they_meet(self, ndjson):
+        counts, lods = self.split(ndjson)
+        assert [[f['properties']['ARCID'] for f in lod] for lod in lods] == [[2, 5], [1, 2, 4, 5, 6], [0, 1, 2, 4, 5, 6, 7]]
+        assert counts == [2, 5, 7]
+        assert lods[2][0] == riverFeatures()[0]
+
+    def test_simplified_lods(self, monkeypatch):
+        # Batches smaller than the input keep the order of the features
+        monkeypatch.setattr(create_lods, 'BATCH_SIZE', 3)
+        counts, lods = self.split(tolerances=[0.01, 0.01, 0.0001])
+        assert counts == [2, 5, 7]
+        assert [[f['properties']['ARCID'] for f in lod] for lod in lods] == [[2, 5], [1, 2, 4, 5, 6], [0, 1, 2, 4, 5, 6, 7]]
+        assert all(len(f['geometry']['coordinates']) == 2 for f in lods[0] + lods[1])
+        assert all(len(f['geometry']['coordinates']) == 3 for f in lods[2])
+
+    def test_lod_tiles(self):
+        lod_tiles = [[], [], []]
+        self.split(lod_tiles=lod_tiles)
+        assert [len(polylines) for polylines in lod_tiles] == [2, 5, 7]
+        assert lod_tiles[0][1]['properties']['ARCID'] == 5
+        assert lod_tiles[0][1]['positions'][:, :2].tolist() == [[5, 0.0], [5.5, 0.001], [6, 0.0]]
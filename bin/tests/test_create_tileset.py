@@ -0,0 +1,89 @@
+import os
+import sys
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from create_tileset import collectPolylines, writeTiles, buildTileset, geometricError
+from simplify import simplifyPolylines
+
+THRESHOLDS = [100, 10, 1]
+
+# A zigzag segment of the given order in every corner of a 4 by 4 degree square
+def features():
+    result = []
+    for i, (x, y) in enumerate([(0.5, 0.5), (3.5, 0.5), (0.5, 3.5), (3.5, 3.5), (1.2, 1.4), (2.9, 2.1)]):
+        coordinates = [[x + j * 0.05, y + (j % 2) * 0.001] for j in range(8)]
+        result.append({'type': 'Feature', 'properties': {'ARCID': i, 'SHREVE': [200, 20, 20, 1, 5, 50][i]},
+                       'geometry': {'type': 'LineString', 'coordinates': coordinates}})
+    result.append({'type': 'Feature', 'properties': {'ARCID': 9}, 'geometry': None})
+    return result
+
+def walk(tile):
+    yield tile
+    for child in tile.get('children', []):
+        for t in walk(child):
+            yield t
+
+class TestCreateTileset(object):
+
+    def tile(self, tmpdir, tolerances=None):
+        store = collectPolylines(features(), THRESHOLDS, 'SHREVE')
+        bounds = [np.degrees(r) for r in store.region()[:4]]
+        try:
+            nodes = writeTiles(store, len(THRESHOLDS), bounds, str(tmpdir), tolerances=tolerances)
+        finally:
+            store.close()
+        return nodes, bounds
+
+    def test_levels_hold_their_lods(self, tmpdir):
+        nodes, bounds = self.tile(tmpdir)
+        # The root has the order 200 segment, every level adds those of the next LOD
+        assert nodes[(0, 0, 0)]['count'] == 1
+        assert sum(n['count'] for k, n in nodes.items() if k[0] == 1) == 4
+        assert sum(n['count'] for k, n in nodes.items() if k[0] == 2) == 6
+        assert sorted(k for k in nodes if k[0] == 1) == [(1, 0, 0), (1, 0, 1), (1, 1, 0), (1, 1, 1)]
+        for key, node in nodes.items():
+            assert os.path.exists(str(tmpdir.join(node['uri'])))
+
+    def test_tileset_tree(self, tmpdir):
+        nodes, bounds = self.tile(tmpdir)
+        tileset = buildTileset(nodes, bounds, len(THRESHOLDS))
+        root = tileset['root']
+        assert tileset['geometricError'] == geometricError(bounds, 0, 3) * 2
+        assert root['content']['uri'] == 'tiles/0/0/0.vctr'
+        assert len(root['children']) == 4
+
+        uris = set()
+        for tile in walk(root):
+            assert tile['refine'] == 'REPLACE'
+            region = tile['boundingVolume']['region']
+            # Every tile covers its children, the errors shrink to 0 at the leaves
+            for child in tile.get('children', []):
+                inner = child['boundingVolume']['region']
+                assert region[0] <= inner[0] and region[1] <= inner[1] and region[2] >= inner[2] and region[3] >= inner[3]
+                assert child['geometricError'] < tile['geometricError']
+            if 'children' not in tile:
+                assert tile['geometricError'] == 0
+            uris.add(tile['content']['uri'])
+        assert uris == set(n['uri'] for n in nodes.values())
+
+    def test_subtree_below_a_tile(self, tmpdir):
+        nodes, bounds = self.tile(tmpdir)
+        below = dict((k, v) for k, v in nodes.items() if k[0] >= 1 and (k[1] >> (k[0] - 1), k[2] >> (k[0] - 1)) == (1, 1))
+        tileset = buildTileset(below, bounds, len(THRESHOLDS), (1, 1, 1))
+        assert tileset['root']['content']['uri'] == 'tiles/1/1/1.vctr'
+        assert tileset['geometricError'] == geometricError(bounds, 1, 3) * 2
+        assert all(child['content']['uri'].startswith('tiles/2/') for child in tileset['root']['children'])
+
+    def test_simplified_once_per_tolerance(self, tmpdir, monkeypatch):
+        import create_tileset
+        calls = []
+        def simplify(polylines, tolerance):
+            calls.append((len(polylines), tolerance))
+            return simplifyPolylines(polylines, tolerance)
+        monkeypatch.setattr(create_tileset, 'simplifyPolylines', simplify)
+
+        self.tile(tmpdir, [0.01, 0.01, 0.001])
+        # The first two levels share their tolerance
+        assert calls == [(4, 0.01), (6, 0.001)]
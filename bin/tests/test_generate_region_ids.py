@@ -0,0 +1,114 @@
+import os
+import sys
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import urlsplit, parse_qs
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from generate_region_ids import readRegionLists, fetchValues, writeRegionList, decodeBinary, deltaDecode
+
+# The values of the stand-in layers, by layer and property
+LAYERS = {
+    ('region_map:FID_LGA_2011_AUST', 'LGA_CODE11'): ['10050', '10110', '10150'],
+    ('region_map:FID_LGA_2011_AUST', 'LGA_NAME11'): ['Albury (C)', 'Armidale Dumaresq (A)', 'Albury (C)'],
+    ('region_map:FID_LGA_2011_AUST', 'STE_NAME11'): ['New South Wales', 'New South Wales', 'Victoria'],
+    ('region_map:FID_POA_2011_AUST', 'POA_CODE'): ['0800', '0810', '2000'],
+    ('region_map:FID_TM_WORLD_BORDERS', 'ISO3'): ['AUS', 'NZL'],
+}
+
+REGION_MAPPING = {'regionWmsMap': {
+    'LGA_2011': {'layerName': 'FID_LGA_2011_AUST', 'regionProp': 'LGA_CODE11',
+                 'regionIdsFile': 'data/regionids/region_map-FID_LGA_2011_AUST_LGA_CODE11.json'},
+    'LGA_NAME_2011': {'layerName': 'FID_LGA_2011_AUST', 'regionProp': 'LGA_NAME11', 'disambigProp': 'STE_NAME11',
+                      'regionIdsFile': 'data/regionids/region_map-FID_LGA_2011_AUST_LGA_NAME11.json',
+                      'regionDisambigIdsFile': 'data/regionids/region_map-FID_LGA_2011_AUST_STE_NAME11.json'},
+    'POA': {'layerName': 'FID_POA_2011_AUST', 'regionProp': 'POA_CODE',
+            'regionIdsFile': 'data/regionids/region_map-FID_POA_2011_AUST_POA_CODE.json'},
+    'CNT3': {'layerName': 'FID_TM_WORLD_BORDERS', 'regionProp': 'ISO3', 'textCodes': True,
+             'regionIdsFile': 'data/regionids/region_map-FID_TM_WORLD_BORDERS_ISO3.json'},
+}}
+
+def response(layer, column):
+    members = ''.join('<wfs:member><region_map:%s>%s</region_map:%s></wfs:member>' % (column, value, column)
+                      for value in LAYERS[(layer, column)])
+    return ('<?xml version="1.0" encoding="UTF-8"?><wfs:ValueCollection xmlns:wfs="http://www.opengis.net/wfs/2.0" '
+            'xmlns:region_map="http://region_map">' + members + '</wfs:ValueCollection>').encode('utf-8')
+
+class StandInWfs(BaseHTTPRequestHandler):
+    def do_GET(self):
+        query = parse_qs(urlsplit(self.path).query)
+        body = response(query['typenames'][0], query['valueReference'][0])
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/xml')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+class TestGenerateRegionIds(object):
+
+    def setup_method(self, method):
+        self.server = HTTPServer(('127.0.0.1', 0), StandInWfs)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = 'http://127.0.0.1:' + str(self.server.server_port) + '/region_map/ows'
+
+    def teardown_method(self, method):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def regionLists(self, tmpdir):
+        os.makedirs(os.path.join(str(tmpdir), 'data'))
+        path = os.path.join(str(tmpdir), 'data', 'regionMapping.json')
+        with open(path, 'w') as o:
+            json.dump(REGION_MAPPING, o)
+        return dict((os.path.basename(l['path']), l) for l in readRegionLists(path, self.url))
+
+    def generate(self, regionList, **options):
+        writeRegionList(regionList, fetchValues(regionList, 10), **options)
+        with open(regionList['path']) as f:
+            return json.load(f)
+
+    def test_disambiguation_lists_are_read(self, tmpdir):
+        lists = self.regionLists(tmpdir)
+        assert sorted(lists) == ['region_map-FID_LGA_2011_AUST_LGA_CODE11.json', 'region_map-FID_LGA_2011_AUST_LGA_NAME11.json',
+                                 'region_map-FID_LGA_2011_AUST_STE_NAME11.json', 'region_map-FID_POA_2011_AUST_POA_CODE.json',
+                                 'region_map-FID_TM_WORLD_BORDERS_ISO3.json']
+        disambig = lists['region_map-FID_LGA_2011_AUST_STE_NAME11.json']
+        assert disambig['layer'] == 'region_map:FID_LGA_2011_AUST'
+        assert disambig['property'] == 'STE_NAME11'
+        assert self.generate(disambig)['values'] == ['New South Wales', 'New South Wales', 'Victoria']
+
+    def test_codes_stay_strings_by_default(self, tmpdir):
+        lists = self.regionLists(tmpdir)
+        assert self.generate(lists['region_map-FID_LGA_2011_AUST_LGA_CODE11.json'])['values'] == ['10050', '10110', '10150']
+        assert self.generate(lists['region_map-FID_POA_2011_AUST_POA_CODE.json'], integers=True)['values'] == ['0800', '0810', '2000']
+
+    def test_existing_type_is_kept(self, tmpdir):
+        regionList = self.regionLists(tmpdir)['region_map-FID_LGA_2011_AUST_LGA_CODE11.json']
+        assert self.generate(regionList, integers=True)['values'] == [10050, 10110, 10150]
+        # A list of numbers stays numbers, a list of strings stays strings
+        assert self.generate(regionList)['values'] == [10050, 10110, 10150]
+        with open(regionList['path'], 'w') as o:
+            json.dump({'values': ['1']}, o)
+        assert self.generate(regionList, integers=True)['values'] == ['10050', '10110', '10150']
+
+    def test_text_codes(self, tmpdir):
+        regionList = self.regionLists(tmpdir)['region_map-FID_TM_WORLD_BORDERS_ISO3.json']
+        assert regionList['textCodes']
+        assert self.generate(regionList, integers=True)['values'] == ['AUS', 'NZL']
+
+    def test_compact_forms_are_written_next_to_the_list(self, tmpdir):
+        regionList = self.regionLists(tmpdir)['region_map-FID_LGA_2011_AUST_LGA_CODE11.json']
+        document = self.generate(regionList, compact=True, binary=True, integers=True)
+        assert document['values'] == [10050, 10110, 10150]
+        assert 'deltas' not in document
+
+        base = os.path.splitext(regionList['path'])[0]
+        with open(base + '.deltas.json') as f:
+            assert deltaDecode(json.load(f)['deltas']) == [10050, 10110, 10150]
+        with open(base + '.bin', 'rb') as f:
+            assert decodeBinary(f.read())[1] == [10050, 10110, 10150]
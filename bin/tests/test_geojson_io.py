@@ -0,0 +1,91 @@
+import io
+import os
+import sys
+import json
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from geojson_io import StreamBuffer, readFeatures, readMembers, FeatureWriter, setProperties
+
+FEATURES = [{'type': 'Feature', 'properties': {'ARCID': i, 'NAME': 'Murray é中' * (i % 3)},
+             'geometry': {'type': 'LineString', 'coordinates': [[i + 0.5, -30.25], [i + 1.5, -31.0]]}} for i in range(25)]
+
+COLLECTION = {'type': 'FeatureCollection', 'features': FEATURES}
+
+def layouts():
+    lines = [json.dumps(f, ensure_ascii=False) for f in FEATURES]
+    return {
+        'lines': '{"type":"FeatureCollection","features":[\n' + ',\n'.join(lines) + '\n]}\n',
+        'minified': json.dumps(COLLECTION, ensure_ascii=False, separators=(',', ':')),
+        'pretty': json.dumps(COLLECTION, ensure_ascii=False, indent=2),
+        'ndjson': '\n'.join(lines) + '\n',
+        'sequence': ''.join('\x1e' + l + '\n' for l in lines),
+    }
+
+class TestStreamBuffer(object):
+
+    @pytest.mark.parametrize('layout', sorted(layouts()))
+    @pytest.mark.parametrize('chunkSize', [1, 7, 64, 1 << 20])
+    def test_layouts(self, layout, chunkSize):
+        data = layouts()[layout].encode('utf-8')
+        items = list(readFeatures(io.BytesIO(data), offsets=True, chunkSize=chunkSize))
+        assert [item[2] for item in items] == FEATURES
+        # The offsets and lengths give the encoded features
+        for offset, length, feature in items:
+            assert json.loads(data[offset:offset + length].decode('utf-8')) == feature
+
+    def test_members_after_the_features(self):
+        data = json.dumps({'features': FEATURES[:2], 'type': 'FeatureCollection', 'count': 123456789}).encode('utf-8')
+        for chunkSize in range(1, 20):
+            members = {}
+            features = list(readMembers(StreamBuffer(io.BytesIO(data), chunkSize), False, members))
+            assert features == FEATURES[:2]
+            assert members == {'type': 'FeatureCollection', 'count': 123456789}
+
+    def test_single_feature(self):
+        data = json.dumps(FEATURES[3], indent=1).encode('utf-8')
+        assert list(readFeatures(io.BytesIO(data), chunkSize=5)) == [FEATURES[3]]
+
+    def test_text_files(self, tmpdir):
+        path = tmpdir.join('rivers.json')
+        path.write_text(layouts()['lines'], encoding='utf-8')
+        with open(str(path)) as f:
+            assert list(readFeatures(f)) == FEATURES
+
+    def test_truncated_input(self):
+        data = layouts()['minified'].encode('utf-8')[:-40]
+        with pytest.raises(ValueError):
+            list(readFeatures(io.BytesIO(data), chunkSize=16))
+
+class TestFeatureWriter(object):
+
+    @pytest.mark.parametrize('newlineDelimited', [False, True])
+    @pytest.mark.parametrize('bufferSize', [1, 100, 1 << 22])
+    def test_round_trip(self, newlineDelimited, bufferSize):
+        o = io.BytesIO()
+        positions = []
+        with FeatureWriter(o, newlineDelimited, bufferSize) as w:
+            for feature in FEATURES:
+                positions.append(w.write(feature))
+        data = o.getvalue()
+
+        if not newlineDelimited:
+            assert json.loads(data.decode('utf-8')) == COLLECTION
+        assert list(readFeatures(io.BytesIO(data))) == FEATURES
+        # The writer returns the positions the reader finds
+        assert [item[:2] for item in readFeatures(io.BytesIO(data), offsets=True)] == positions
+
+    def test_encoded_features_are_copied(self):
+        o = io.BytesIO()
+        with FeatureWriter(o) as w:
+            w.writeEncoded(json.dumps(FEATURES[0]).encode('utf-8'))
+            w.write(setProperties(dict(FEATURES[1]), {'STRAHLER': 2}))
+        features = json.loads(o.getvalue().decode('utf-8'))['features']
+        assert features[0] == FEATURES[0]
+        assert features[1]['properties']['STRAHLER'] == 2
+
+    def test_empty_collection(self):
+        o = io.BytesIO()
+        FeatureWriter(o).close()
+        assert json.loads(o.getvalue().decode('utf-8')) == {'type': 'FeatureCollection', 'features': []}
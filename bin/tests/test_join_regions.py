@@ -0,0 +1,40 @@
+import io
+import os
+import sys
+import json
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from join_regions import joinCsv
+
+REGION_MAPPING = {
+    'POA': {'regionProp': 'POA_CODE', 'aliases': ['postcode'], 'digits': 4, 'regionIdsFile': 'poa.json'},
+    'STE': {'regionProp': 'STE_CODE', 'regionIdsFile': 'ste.json'},
+}
+
+class TestJoinRegions(object):
+
+    def join(self, tmpdir, text):
+        tmpdir.join('poa.json').write(json.dumps({'values': ['0800', '0810', '2000', '3000']}))
+        tmpdir.join('ste.json').write(json.dumps({'values': [1, 2, 3]}))
+        return joinCsv(io.StringIO(text), REGION_MAPPING, str(tmpdir))
+
+    def test_rows_follow_the_region_ids(self, tmpdir):
+        table = self.join(tmpdir, 'postcode,people,name\n3000,5,Melbourne\n800,2.5,Darwin\n9999,1,Nowhere\n')
+        assert table.index.regionType == 'POA'
+        assert dict((name, values) for name, kind, values in table.typedColumns()) == {
+            'people': [2.5, None, None, 5], 'name': ['Darwin', None, None, 'Melbourne']}
+        assert table.unmatched == ['9999']
+        assert table.header()['matched'] == 2
+
+    def test_duplicates_are_left_out(self, tmpdir):
+        table = self.join(tmpdir, 'postcode,people\n2000,1\n2000,2\n')
+        assert table.duplicates == ['2000']
+        assert table.columns[0][2] == '1'
+
+    def test_duplicates_of_rows_without_values(self, tmpdir):
+        # The first row has no values, the second is still a duplicate of it
+        table = self.join(tmpdir, 'postcode,people\n2000\n2000,2\n0810,3\n')
+        assert table.duplicates == ['2000']
+        assert table.columns[0] == [None, '3', None, None]
+        assert table.header()['matched'] == 2
@@ -0,0 +1,74 @@
+import os
+import sys
+import json
+import gzip
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import publish_assets
+from publish_assets import contentHash, hashedName, findFiles, rewriteTileset, MANIFEST
+
+TILESET = {'asset': {'version': '1.0'}, 'geometricError': 100, 'root': {
+    'content': {'uri': 'tiles/0/0/0.vctr'}, 'geometricError': 10,
+    'children': [{'content': {'uri': 'tiles/1/0/0.vctr'}, 'geometricError': 0}, {'content': {'url': 'other/tileset.json'}, 'geometricError': 0}]}}
+
+def options(directory, **overrides):
+    values = {'directory': directory, 'include': None, 'hash': True, 'prune': False, 'force': False, 'jobs': 1,
+              'gzip_level': 9, 'brotli_quality': 11, 'verbose': False, 'time': False, 'tracemalloc': False, 'metrics': None}
+    values.update(overrides)
+    return argparse.Namespace(**values)
+
+class TestPublishAssets(object):
+
+    def write(self, tmpdir, relative, data):
+        path = tmpdir.join(*relative.split('/'))
+        path.dirpath().ensure(dir=True)
+        path.write_binary(data)
+
+    def publish(self, tmpdir, **overrides):
+        publish_assets.main(options(str(tmpdir), **overrides))
+        return json.loads(tmpdir.join(MANIFEST).read_text('utf-8'))
+
+    def test_hashed_copies(self, tmpdir):
+        self.write(tmpdir, 'tiles/0/0/0.vctr', b'vctr tile 0' * 20)
+        self.write(tmpdir, 'tiles/1/0/0.vctr', b'vctr tile 1' * 20)
+        self.write(tmpdir, 'tileset.json', json.dumps(TILESET).encode('utf-8'))
+        manifest = self.publish(tmpdir)
+
+        assert sorted(manifest) == ['tiles/0/0/0.vctr', 'tiles/1/0/0.vctr', 'tileset.json']
+        for logical, hashed in manifest.items():
+            data = tmpdir.join(hashed).read_binary()
+            assert hashed == hashedName(logical, contentHash(data))
+            assert gzip.decompress(tmpdir.join(hashed + '.gz').read_binary()) == data
+
+        # The hashed tileset references the hashed tiles, the others are left alone
+        tileset = json.loads(tmpdir.join(manifest['tileset.json']).read_text('utf-8'))
+        assert tileset['root']['content']['uri'] == manifest['tiles/0/0/0.vctr']
+        assert tileset['root']['children'][0]['content']['uri'] == manifest['tiles/1/0/0.vctr']
+        assert tileset['root']['children'][1]['content']['url'] == 'other/tileset.json'
+
+        # A second run finds the same files, not the hashed copies
+        assert self.publish(tmpdir) == manifest
+
+    def test_rewrite_relative_to_the_tileset(self):
+        manifest = {'a/tiles/0.vctr': 'a/tiles/0.hash-0123456789ab.vctr'}
+        tileset = rewriteTileset({'root': {'content': {'uri': './tiles/0.vctr'}}}, 'a', manifest)
+        assert tileset['root']['content']['uri'] == 'tiles/0.hash-0123456789ab.vctr'
+
+    def test_logical_names_with_hex_digits(self, tmpdir):
+        # Names that end in 12 hex digits are not taken for hashed copies
+        self.write(tmpdir, 'rivers.201507311200.json', b'{}')
+        self.write(tmpdir, 'rivers.json', b'[]')
+        self.write(tmpdir, 'rivers.hash-0123456789ab.json', b'[]')
+        self.write(tmpdir, 'rivers.json.gz', b'')
+        assert findFiles(str(tmpdir), ['*.json']) == ['rivers.201507311200.json', 'rivers.json']
+
+    def test_prune(self, tmpdir):
+        self.write(tmpdir, 'rivers.json', b'[1]' * 50)
+        old = self.publish(tmpdir)['rivers.json']
+        self.write(tmpdir, 'rivers.json', b'[2]' * 50)
+        new = self.publish(tmpdir, prune=True)['rivers.json']
+        assert old != new
+        assert not tmpdir.join(old).exists() and not tmpdir.join(old + '.gz').exists()
+        assert tmpdir.join(new).exists()
@@ -0,0 +1,53 @@
+import os
+import sys
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from river_cache import loadCache, writeCache, updateCache, GRAPH_ARRAYS
+
+def graphArrays(count):
+    return {'endpoints': np.zeros((count, 2, 2)), 'source': np.arange(count), 'target': np.arange(1, count + 1),
+            'offsets': np.arange(count) * 10, 'lengths': np.full(count, 10)}
+
+class TestRiverCache(object):
+
+    def write(self, tmpdir, data=b'x' * 4000):
+        path = str(tmpdir.join('rivers.json'))
+        with open(path, 'wb') as o:
+            o.write(data)
+        writeCache(path, 4, graphArrays(3), options={'snap': 0})
+        return path
+
+    def test_arrays_are_loaded(self, tmpdir):
+        path = self.write(tmpdir)
+        graph = loadCache(path, options={'snap': 0})
+        assert graph['count'] == 3 and graph['nodeCount'] == 4
+        assert graph['target'].tolist() == [1, 2, 3]
+
+    def test_options_must_match(self, tmpdir):
+        path = self.write(tmpdir)
+        assert loadCache(path, options={'snap': 0.5}) is None
+
+    def test_edit_of_the_same_length_invalidates(self, tmpdir):
+        path = self.write(tmpdir, b'x' * (3 << 20))
+        stat = os.stat(path)
+        # Outside the sampled blocks of the hash
+        with open(path, 'r+b') as f:
+            f.seek(600000)
+            f.write(b'y')
+        os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000000000))
+        assert loadCache(path) is None
+        assert not updateCache(path, {'strahler': np.ones(3)})
+
+    def test_touch_invalidates(self, tmpdir):
+        path = self.write(tmpdir)
+        stat = os.stat(path)
+        os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000000000))
+        assert loadCache(path) is None
+
+    def test_update_adds_arrays(self, tmpdir):
+        path = self.write(tmpdir)
+        assert updateCache(path, {'strahler': np.ones(3, dtype=np.int32)})
+        assert loadCache(path, arrays=GRAPH_ARRAYS + ['strahler'])['strahler'].tolist() == [1, 1, 1]
+        assert loadCache(path, arrays=GRAPH_ARRAYS + ['shreve']) is None
@@ -0,0 +1,74 @@
+import os
+import sys
+import json
+import random
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from river_index import buildIndex, loadIndex, query, readFeatures, featureBounds, intersects, propertyArray
+
+# Random segments and points, with a few features without geometry in between
+def writeFeatures(path, count, seed=0):
+    rnd = random.Random(seed)
+    features = []
+    for i in range(count):
+        x, y = rnd.uniform(110, 155), rnd.uniform(-45, -10)
+        if i % 17 == 5:
+            geometry = None
+        elif i % 5 == 0:
+            geometry = {'type': 'Point', 'coordinates': [x, y]}
+        else:
+            geometry = {'type': 'LineString', 'coordinates': [[x, y], [x + rnd.uniform(-1, 1), y + rnd.uniform(-1, 1)]]}
+        features.append({'type': 'Feature', 'properties': {'ARCID': i, 'SHREVE': i % 7}, 'geometry': geometry})
+    with open(path, 'w') as o:
+        json.dump({'type': 'FeatureCollection', 'features': features}, o)
+    return features
+
+def randomBbox(rnd):
+    west, south = rnd.uniform(105, 155), rnd.uniform(-50, -10)
+    return [west, south, west + rnd.uniform(0, 12), south + rnd.uniform(0, 8)]
+
+class TestRiverIndex(object):
+
+    def test_query_matches_brute_force(self, tmpdir):
+        path = str(tmpdir.join('rivers.json'))
+        features = writeFeatures(path, 3000)
+        bounds = [featureBounds(f) for f in features]
+        rnd = random.Random(1)
+        for nodeSize in (2, 16):
+            buildIndex(path, str(tmpdir.join(str(nodeSize))), nodeSize)
+            index = loadIndex(path, str(tmpdir.join(str(nodeSize))))
+            assert index['count'] == sum(b is not None for b in bounds)
+            for i in range(100):
+                bbox = randomBbox(rnd)
+                expected = [f for f, b in zip(features, bounds) if intersects(b, bbox)]
+                assert sorted(index['ids'][query(index, bbox)].tolist()) == [f['properties']['ARCID'] for f in expected]
+                assert list(readFeatures(path, index, bbox)) == expected
+
+    def test_properties_follow_the_leaves(self, tmpdir):
+        path = str(tmpdir.join('rivers.json'))
+        features = writeFeatures(path, 200)
+        buildIndex(path, properties=['SHREVE', 'MISSING'])
+        index = loadIndex(path)
+        assert index[propertyArray('SHREVE')].tolist() == [features[i]['properties']['SHREVE'] for i in index['ids']]
+        assert np.isnan(index[propertyArray('MISSING')]).all()
+
+    def test_small_trees(self, tmpdir):
+        path = str(tmpdir.join('rivers.json'))
+        writeFeatures(path, 0)
+        buildIndex(path)
+        assert len(query(loadIndex(path), [-180, -90, 180, 90])) == 0
+
+        features = writeFeatures(path, 1)
+        buildIndex(path)
+        assert list(readFeatures(path, loadIndex(path), [-180, -90, 180, 90])) == features
+        assert list(readFeatures(path, loadIndex(path), [0, 0, 1, 1])) == []
+
+    def test_edited_source_invalidates(self, tmpdir):
+        path = str(tmpdir.join('rivers.json'))
+        writeFeatures(path, 50)
+        buildIndex(path)
+        stat = os.stat(path)
+        os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000000000))
+        assert loadIndex(path) is None
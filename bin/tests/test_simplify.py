@@ -0,0 +1,87 @@
+import os
+import sys
+import random
+import argparse
+import pytest
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from simplify import simplifyPolylines, simplifyFeatures, lodTolerances, parseFilter, segmentDistances
+
+# Douglas-Peucker one polyline at a time, recursively, the first farthest position splits
+def douglasPeucker(points, tolerance, a=0, b=None):
+    b = len(points) - 1 if b is None else b
+    if b - a < 2:
+        return []
+    distances = segmentDistances(points[a + 1:b, :2], points[a, :2][None], points[b, :2][None])
+    split = a + 1 + int(np.argmax(distances))
+    if distances.max() <= tolerance:
+        return []
+    return douglasPeucker(points, tolerance, a, split) + [split] + douglasPeucker(points, tolerance, split, b)
+
+def randomPolyline(rnd):
+    count = rnd.choice([0, 1, 2, 3, rnd.randint(4, 200)])
+    return np.array([[i * 0.01, rnd.gauss(0, 0.01), rnd.uniform(0, 10)] for i in range(count)]).reshape(-1, 3)
+
+class TestSimplify(object):
+
+    def test_matches_recursive_douglas_peucker(self):
+        rnd = random.Random(0)
+        polylines = [randomPolyline(rnd) for i in range(300)]
+        for tolerance in (0.001, 0.005, 0.02):
+            for polyline, simplified in zip(polylines, simplifyPolylines(polylines, tolerance)):
+                if len(polyline) < 2:
+                    assert np.array_equal(simplified, polyline)
+                    continue
+                keep = [0] + douglasPeucker(polyline, tolerance) + [len(polyline) - 1]
+                # The positions are kept whole, with their heights
+                assert np.array_equal(simplified, polyline[keep])
+
+    def test_endpoints_and_tolerance(self):
+        rnd = random.Random(1)
+        polylines = [randomPolyline(rnd) for i in range(100)]
+        tolerance = 0.01
+        for polyline, simplified in zip(polylines, simplifyPolylines(polylines, tolerance)):
+            if len(polyline) == 0:
+                assert len(simplified) == 0
+                continue
+            assert np.array_equal(simplified[0], polyline[0]) and np.array_equal(simplified[-1], polyline[-1])
+            # Every position that was left out is within the tolerance of the simplified line
+            if len(simplified) > 1:
+                for point in polyline[:, :2]:
+                    distances = segmentDistances(np.repeat(point[None], len(simplified) - 1, axis=0), simplified[:-1, :2], simplified[1:, :2])
+                    assert distances.min() <= tolerance + 1e-12
+
+    def test_straight_lines_and_no_tolerance(self):
+        line = [[i, 2 * i] for i in range(10)]
+        assert simplifyPolylines([line], 0.001)[0].tolist() == [[0, 0], [9, 18]]
+        assert simplifyPolylines([line], 0)[0].tolist() == line
+        assert simplifyPolylines([], 1) == []
+
+    def test_lod_tolerances(self):
+        assert lodTolerances(0.001, 4) == [0.008, 0.004, 0.002, 0.001]
+        assert lodTolerances(0.5, 3, 3) == [4.5, 1.5, 0.5]
+
+    def test_features_are_copied(self):
+        line = [[0, 0], [1, 0.001], [2, 0]]
+        features = [
+            {'type': 'Feature', 'properties': {'n': 1}, 'geometry': {'type': 'LineString', 'coordinates': line}},
+            {'type': 'Feature', 'properties': {'n': 2}, 'geometry': {'type': 'MultiLineString', 'coordinates': [line, line[:2]]}},
+            {'type': 'Feature', 'properties': {'n': 3}, 'geometry': {'type': 'Point', 'coordinates': [1, 1]}},
+            {'type': 'Feature', 'properties': {'n': 4}, 'geometry': None},
+        ]
+        simplified = simplifyFeatures(features, 0.01)
+        assert simplified[0]['geometry']['coordinates'] == [[0, 0], [2, 0]]
+        assert simplified[1]['geometry']['coordinates'] == [[[0, 0], [2, 0]], [[0, 0], [1, 0.001]]]
+        assert simplified[2:] == features[2:]
+        assert features[0]['geometry']['coordinates'] == line
+
+    def test_filter(self):
+        passes = parseFilter('UP_CELLS >= 2000')
+        assert passes({'properties': {'UP_CELLS': 2000}})
+        assert not passes({'properties': {'UP_CELLS': 1999.5}})
+        assert not passes({'properties': {}}) and not passes({'properties': None})
+        assert parseFilter('DEPTH != -1.5')({'properties': {'DEPTH': 1}})
+        with pytest.raises(argparse.ArgumentTypeError):
+            parseFilter('UP_CELLS is large')
@@ -0,0 +1,58 @@
+import os
+import sys
+import json
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from split_catalog import splitCatalog, mergeCatalog, Writer, SETTINGS_FILE
+
+INIT = {
+    'homeCamera': {'north': -8, 'south': -44, 'east': 158, 'west': 109},
+    'catalog': [
+        {'name': 'National Data Sets', 'type': 'group', 'items': [
+            {'name': 'Rivers', 'type': 'geojson', 'url': 'rivers.json'},
+            {'name': 'Basins/Catchments', 'type': 'wms', 'url': 'http://example.com/wms'},
+        ]},
+        {'name': 'Empty', 'type': 'group', 'items': []},
+        {'name': 'Gauges', 'type': 'csv', 'url': 'gauges.csv'},
+    ]
+}
+
+class TestSplitCatalog(object):
+
+    def split(self, directory, writer, init=INIT):
+        for path, content in splitCatalog(init, directory, {'National Data Sets', 'Empty'}):
+            writer.write(path, content)
+
+    def test_round_trip(self, tmpdir):
+        directory = str(tmpdir)
+        self.split(directory, Writer())
+        assert os.path.exists(os.path.join(directory, SETTINGS_FILE))
+        assert sorted(os.listdir(os.path.join(directory, '00_National_Data_Sets'))) == ['00_00_Rivers.json', '00_01_Basins_Catchments.json']
+        assert mergeCatalog(directory) == INIT
+
+    def test_empty_group_is_kept(self, tmpdir):
+        directory = str(tmpdir)
+        self.split(directory, Writer())
+        with open(os.path.join(directory, '01_Empty.json')) as f:
+            assert json.load(f) == {'catalog': [{'name': 'Empty', 'type': 'group', 'items': []}]}
+
+    def test_unchanged_files_are_not_written(self, tmpdir):
+        directory = str(tmpdir)
+        self.split(directory, Writer())
+        writer = Writer()
+        self.split(directory, writer)
+        assert writer.written == 0 and writer.unchanged == 5
+
+    def test_prune(self, tmpdir):
+        directory = str(tmpdir)
+        self.split(directory, Writer())
+        tmpdir.join('README.md').write('kept')
+
+        init = dict(INIT, catalog=INIT['catalog'][1:])
+        writer = Writer()
+        self.split(directory, writer, init)
+        # The two items of the group, and the entries that moved up a number
+        assert writer.prune(directory) == 4
+        assert os.path.exists(os.path.join(directory, 'README.md'))
+        assert mergeCatalog(directory) == init
@@ -0,0 +1,114 @@
+import os
+import sys
+import json
+import time
+import threading
+import urllib.error
+import urllib.request
+from http.server import ThreadingHTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tile_server import Tileset, TileHandler, TileCache, loadOrderIndex
+from create_lods import lodThresholds
+
+# A few segments with orders, spread over a 2 by 2 degree square
+def writeRivers(path, shift=0.0):
+    features = []
+    for i in range(40):
+        x = (i % 8) * 0.25 + shift
+        y = (i // 8) * 0.4
+        features.append({'type': 'Feature', 'properties': {'ARCID': i, 'SHREVE': 1 + i % 9, 'STRAHLER': 1 + i % 3},
+                         'geometry': {'type': 'LineString', 'coordinates': [[x, y], [x + 0.1, y + 0.1]]}})
+    with open(path, 'w') as o:
+        json.dump({'type': 'FeatureCollection', 'features': features}, o)
+
+class TestTileServer(object):
+
+    def setup_method(self, method):
+        self.server = None
+
+    def teardown_method(self, method):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+
+    def serve(self, tmpdir):
+        path = str(tmpdir.join('rivers.json'))
+        writeRivers(path)
+        thresholds = lodThresholds(4, 'log', 2)
+        tileset = Tileset(path, loadOrderIndex(path, 'SHREVE'), thresholds, 'SHREVE', subtreeLevels=2)
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), TileHandler)
+        self.server.tilesets = {'rivers': tileset}
+        self.server.reloading = threading.Lock()
+        self.server.cache = TileCache(1 << 20)
+        self.server.maxAge = 60
+        self.server.verbose = False
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return path, 'http://127.0.0.1:' + str(self.server.server_address[1]) + '/rivers/'
+
+    def get(self, url, etag=None):
+        request = urllib.request.Request(url, headers={'If-None-Match': etag} if etag else {})
+        try:
+            response = urllib.request.urlopen(request)
+            return response.status, response.headers.get('ETag'), response.read()
+        except urllib.error.HTTPError as e:
+            return e.code, e.headers.get('ETag'), b''
+
+    def firstTile(self, base):
+        tileset = json.loads(self.get(base + 'tileset.json')[2].decode('utf-8'))
+        return tileset['root']['content']['uri']
+
+    def test_etag_and_not_modified(self, tmpdir):
+        path, base = self.serve(tmpdir)
+        uri = self.firstTile(base)
+        status, etag, tile = self.get(base + uri)
+        assert status == 200 and tile[:4] == b'vctr'
+        assert self.get(base + uri, etag)[0] == 304
+        assert self.get(base + uri, 'W/' + etag)[0] == 304
+        assert self.get(base + uri, '"other"')[0] == 200
+        assert self.get(base + 'tiles/9/0/0.vctr')[0] == 404
+
+    def test_subtrees_link_down(self, tmpdir):
+        path, base = self.serve(tmpdir)
+        links = []
+        nodes = [json.loads(self.get(base + 'tileset.json')[2].decode('utf-8'))['root']]
+        while nodes:
+            node = nodes.pop()
+            uri = node.get('content', {}).get('uri', '')
+            if uri.startswith('tileset-'):
+                links.append(uri)
+            nodes.extend(node.get('children', []))
+        assert links
+        status, etag, data = self.get(base + links[0])
+        assert status == 200 and json.loads(data.decode('utf-8'))['root']['content']['uri'].endswith('.vctr')
+        assert self.get(base + 'tileset-1-0-0.json')[0] == 404
+
+    def test_edited_source_is_reloaded(self, tmpdir):
+        path, base = self.serve(tmpdir)
+        uri = self.firstTile(base)
+        status, etag, tile = self.get(base + uri)
+
+        # The same length, with moved coordinates and a new modification time
+        writeRivers(path, 0.125)
+        stat = os.stat(path)
+        os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000000000))
+
+        status, newEtag, newTile = self.get(base + self.firstTile(base), etag)
+        assert status == 200 and newEtag != etag and newTile != tile
+
+    def test_concurrent_encodes_are_coalesced(self):
+        cache = TileCache(1 << 20)
+        calls = []
+        def encode():
+            calls.append(1)
+            time.sleep(0.1)
+            return b'tile'
+        threads = [threading.Thread(target=cache.fetch, args=('key', encode)) for i in range(6)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert len(calls) == 1 and cache.coalesced == 5
+        assert cache.fetch('key', encode) == b'tile' and len(calls) == 1
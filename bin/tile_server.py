@@ -0,0 +1,423 @@
+#!/usr/bin/env python
+
+# Serve the quadtree of vctr tiles of create_tileset.py over HTTP, encoding every tile when it
+# is first requested instead of writing them all ahead of time. The deepest levels hold
+# millions of tiles that are rarely viewed, a cold tile costs one encode here.
+#
+# Every GeoJSON file given is served as a tileset named after the file:
+#
+#   /<name>/tileset.json
+#   /<name>/tileset-<level>-<x>-<y>.json
+#   /<name>/tiles/<level>/<x>/<y>.vctr
+#
+# The features are read through the spatial index of river_index.py, which is built (with the
+# stream orders) when it is missing or out of date, also when a source file changes while it
+# is being served. Nothing is enumerated at startup: the
+# tileset.json only describes the top --subtree-levels levels of the quadtree, and its tiles
+# at the level below link to external tilesets of the subtrees under them, which link further
+# down in turn. A subtree tileset is worked out on request from the bounding boxes and orders
+# in the index of the features in its root cell, and a tile reads just the byte ranges of its
+# features. As in create_tileset.py, level k holds the features of LOD k+1 and a feature
+# belongs to the tile that contains the centre of its bounding box (of the whole feature here,
+# the index has no boxes of the lines of a MultiLineString).
+#
+# Encoded tiles and subtrees are kept in a least recently used cache bounded by their size in
+# bytes, and concurrent requests for one that isn't cached wait for a single encode. The ETag
+# of a tile is a hash of the source file signature (its size and modification time), the
+# tiling options and the tile coordinates, which determine its bytes, so If-None-Match is answered with a 304 without
+# encoding the tile even when it isn't cached. It's meant to run behind varnish (see
+# varnish/default.vcl), e.g. on port 3001 in place of the node server or next to it.
+
+import os
+import re
+import json
+import math
+import hashlib
+import argparse
+import threading
+import collections
+import numpy as np
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from simplify import simplifyPolylines, lodTolerances
+import instrument
+import river_cache
+import river_index
+from create_lods import lodThresholds, parseThresholds, featureToPolylines, encodeTile, computeRegion
+from create_tileset import buildTileset
+
+# The stream orders kept in the index, so the LOD of every feature is known without reading it
+ORDER_PROPERTIES = ['SHREVE', 'STRAHLER']
+
+# The number of quadtree levels described by every tileset.json
+SUBTREE_LEVELS = 4
+
+TILE_PATH = re.compile(r'^/([^/]+)/tiles/(\d+)/(\d+)/(\d+)\.vctr$')
+TILESET_PATH = re.compile(r'^/([^/]+)/tileset(?:-(\d+)-(\d+)-(\d+))?\.json$')
+
+class PendingTile(object):
+    '''A tile that is being encoded, which other requests for the same tile wait for.'''
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.tile = None
+        self.error = None
+
+class TileCache(object):
+    '''A thread safe least recently used cache of tiles, bounded by the total size of the tiles in bytes.'''
+
+    def __init__(self, maxBytes):
+        self.maxBytes = maxBytes
+        self.size = 0
+        self.tiles = collections.OrderedDict()
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    def put(self, key, tile):
+        if len(tile) > self.maxBytes:
+            return
+        with self.lock:
+            if key in self.tiles:
+                self.size -= len(self.tiles.pop(key))
+            self.tiles[key] = tile
+            self.size += len(tile)
+            while self.size > self.maxBytes:
+                self.size -= len(self.tiles.popitem(last=False)[1])
+
+    # Get a tile, encoding it with encode() when it isn't cached. While it is being encoded,
+    # other requests for it wait for that encode instead of starting their own.
+    def fetch(self, key, encode):
+        with self.lock:
+            tile = self.tiles.get(key)
+            if tile is not None:
+                self.tiles.move_to_end(key)
+                self.hits += 1
+                return tile
+            pending = self.pending.get(key)
+            owner = pending is None
+            if owner:
+                self.misses += 1
+                pending = self.pending[key] = PendingTile()
+            else:
+                self.coalesced += 1
+
+        if not owner:
+            pending.done.wait()
+            if pending.error is not None:
+                raise pending.error
+            return pending.tile
+
+        try:
+            pending.tile = encode()
+            if pending.tile is not None:
+                self.put(key, pending.tile)
+            return pending.tile
+        except Exception as e:
+            pending.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.pending[key]
+            pending.done.set()
+
+    def __len__(self):
+        return len(self.tiles)
+
+# The index of a source file with the given order in it, building it when needed
+def loadOrderIndex(path, order, indexDir=None, metrics=None):
+    index = river_index.loadIndex(path, indexDir)
+    if index is None or order not in index.get('properties', []):
+        river_index.buildIndex(path, indexDir, metrics=metrics, properties=ORDER_PROPERTIES)
+        index = river_index.loadIndex(path, indexDir)
+    return index
+
+class Tileset(object):
+    '''The tiles of one GeoJSON file, worked out from its index and encoded on request.'''
+
+    def __init__(self, path, index, thresholds, order, tolerances=None, subtreeLevels=SUBTREE_LEVELS, indexDir=None):
+        self.path = path
+        self.index = index
+        self.indexDir = indexDir
+        self.thresholds = thresholds
+        self.order = order
+        self.tolerances = tolerances
+        self.levels = len(thresholds)
+        self.subtreeLevels = subtreeLevels
+
+        # The coarsest LOD of every leaf of the index, the thresholds are descending
+        count = index['count']
+        self.boxes = np.asarray(index['boxes'][len(index['boxes']) - count:])
+        values = np.asarray(index[river_index.propertyArray(order)])
+        lodLevels = (np.asarray(thresholds)[None, :] > values[:, None]).sum(axis=1)
+        lodLevels[np.isnan(values)] = self.levels
+        self.lodLevels = lodLevels
+        self.centres = (self.boxes[:, :2] + self.boxes[:, 2:]) / 2
+
+        selected = lodLevels < self.levels
+        self.count = int(selected.sum())
+        if self.count:
+            lower = self.boxes[selected, :2].min(axis=0)
+            upper = self.boxes[selected, 2:].max(axis=0)
+            self.bounds = [float(lower[0]), float(lower[1]), float(upper[0]), float(upper[1])]
+        else:
+            self.bounds = None
+
+        # Everything the bytes of a tile depend on besides its coordinates
+        signature = {'source': [os.path.abspath(path), index['size'], index['mtime'], index['hash']], 'thresholds': thresholds, 'order': order,
+                     'tolerances': tolerances, 'subtreeLevels': subtreeLevels}
+        self.signature = json.dumps(signature, sort_keys=True)
+
+    # The tileset of the current version of the source file: this one, or one of a rebuilt index
+    # when the file changed since the index was loaded, whose features are at other offsets
+    def current(self):
+        if river_cache.isValid(self.path, self.index, river_index.VERSION):
+            return self
+        index = loadOrderIndex(self.path, self.order, self.indexDir)
+        return Tileset(self.path, index, self.thresholds, self.order, self.tolerances, self.subtreeLevels, self.indexDir)
+
+    # Whether a key is a cell of the quadtree, which may or may not have content
+    def isCell(self, key):
+        level, x, y = key
+        return level < self.levels and x < 2 ** level and y < 2 ** level
+
+    # Whether a key is the root of a subtree with a tileset of its own
+    def isSubtree(self, key):
+        return self.isCell(key) and key[0] % self.subtreeLevels == 0
+
+    # The quadtree cells of the given positions of the index at a level
+    def cells(self, positions, level):
+        west, south, east, north = self.bounds
+        size = 2 ** level
+        centres = self.centres[positions]
+        x = np.clip(((centres[:, 0] - west) / max(east - west, 1e-12) * size).astype(np.int64), 0, size - 1)
+        y = np.clip(((centres[:, 1] - south) / max(north - south, 1e-12) * size).astype(np.int64), 0, size - 1)
+        return x, y
+
+    # The positions in the index of the features up to the given LOD level with their centre in a cell
+    def cellFeatures(self, key, lodLevel):
+        level, x, y = key
+        west, south, east, north = self.bounds
+        size = 2 ** level
+        width = (east - west) / size
+        height = (north - south) / size
+        # The cell, grown a little so centres on its edges aren't lost to rounding
+        margin = max(width, height) * 1e-9
+        bbox = [west + x * width - margin, south + y * height - margin, west + (x + 1) * width + margin, south + (y + 1) * height + margin]
+
+        positions = river_index.query(self.index, bbox)
+        positions = positions[self.lodLevels[positions] <= lodLevel]
+        cellX, cellY = self.cells(positions, level)
+        return positions[(cellX == x) & (cellY == y)]
+
+    # The nodes for buildTileset of the cells with content of the given features at a level, with
+    # regions of the bounding boxes of the features. The uri of a node is made by uri(key).
+    def levelNodes(self, positions, level, uri):
+        nodes = {}
+        if len(positions) == 0:
+            return nodes
+
+        size = 2 ** level
+        x, y = self.cells(positions, level)
+        cells, inverse, counts = np.unique(y * size + x, return_inverse=True, return_counts=True)
+        order = np.argsort(inverse, kind='stable')
+        starts = np.concatenate([[0], np.cumsum(counts)])
+        levelBoxes = self.boxes[positions[order]]
+        lower = np.minimum.reduceat(levelBoxes[:, :2], starts[:-1])
+        upper = np.maximum.reduceat(levelBoxes[:, 2:], starts[:-1])
+
+        for c, cell in enumerate(cells):
+            key = (level, int(cell % size), int(cell // size))
+            region = [math.radians(lower[c, 0]), math.radians(lower[c, 1]), math.radians(upper[c, 0]), math.radians(upper[c, 1]), 0.0, 0.0]
+            nodes[key] = {'region': region, 'uri': uri(key), 'count': int(counts[c])}
+        return nodes
+
+    # The tileset.json of the subtree below a cell: the tiles of its top levels, and at the level
+    # below those tiles linking to the tilesets of the subtrees there. The region of a link covers
+    # the whole subtree, the features of all LODs with their centre in its cell.
+    # Returns None when the cell has no content.
+    def subtree(self, key):
+        positions = self.cellFeatures(key, self.levels - 1)
+        if len(positions) == 0:
+            return None
+
+        nodes = {}
+        bottom = min(key[0] + self.subtreeLevels, self.levels)
+        for level in range(key[0], bottom):
+            nodes.update(self.levelNodes(positions[self.lodLevels[positions] <= level], level,
+                                         lambda k: 'tiles/' + '/'.join(str(c) for c in k) + '.vctr'))
+        if bottom < self.levels:
+            nodes.update(self.levelNodes(positions, bottom, lambda k: 'tileset-' + '-'.join(str(c) for c in k) + '.json'))
+        return json.dumps(buildTileset(nodes, self.bounds, self.levels, key)).encode('utf-8')
+
+    def etag(self, key):
+        return '"' + hashlib.sha1((self.signature + ' ' + str(key)).encode('utf-8')).hexdigest() + '"'
+
+    # The encoded tile, or None when it has no content
+    def encode(self, key):
+        positions = self.cellFeatures(key, key[0])
+        if len(positions) == 0:
+            return None
+
+        polylines = []
+        for feature in river_index.readIndexedFeatures(self.path, self.index, positions):
+            polylines.extend(p for p in featureToPolylines(feature) if len(p['positions']))
+        if self.tolerances:
+            simplified = simplifyPolylines([p['positions'] for p in polylines], self.tolerances[key[0]])
+            polylines = [dict(p, positions=s) for p, s in zip(polylines, simplified)]
+        return encodeTile([], polylines, [], computeRegion([], polylines, []))
+
+class TileHandler(BaseHTTPRequestHandler):
+    '''Answers GET and HEAD requests for the tilesets of the server.'''
+
+    def do_GET(self):
+        self.respond(True)
+
+    def do_HEAD(self):
+        self.respond(False)
+
+    def respond(self, body):
+        path = self.path.split('?', 1)[0]
+        match = TILE_PATH.match(path)
+        if match:
+            tileset = self.currentTileset(match.group(1))
+            key = tuple(int(k) for k in match.group(2, 3, 4))
+            if tileset is None or not tileset.isCell(key):
+                return self.send_error(404)
+            etag = tileset.etag(key)
+            if self.notModified(etag):
+                return
+            # The ETag identifies the version of the tile, an edited source never gets the old one
+            tile = self.server.cache.fetch(etag, lambda: tileset.encode(key))
+            if tile is None:
+                return self.send_error(404)
+            return self.send(tile, 'application/octet-stream', etag, body)
+
+        match = TILESET_PATH.match(path)
+        if match:
+            tileset = self.currentTileset(match.group(1))
+            # The tileset.json of a file is the tileset of the subtree of the root tile
+            key = tuple(int(k) for k in match.group(2, 3, 4)) if match.group(2) else (0, 0, 0)
+            if tileset is None or not tileset.isSubtree(key):
+                return self.send_error(404)
+            etag = tileset.etag(('tileset',) + key)
+            if self.notModified(etag):
+                return
+            data = self.server.cache.fetch(etag, lambda: tileset.subtree(key))
+            if data is None:
+                return self.send_error(404)
+            return self.send(data, 'application/json', etag, body)
+
+        if path == '/':
+            names = sorted(self.server.tilesets)
+            return self.send(json.dumps(names).encode('utf-8'), 'application/json', None, body)
+
+        self.send_error(404)
+
+    # The tileset of a name, reloaded first when its source file changed
+    def currentTileset(self, name):
+        with self.server.reloading:
+            tileset = self.server.tilesets.get(name)
+            if tileset is not None:
+                tileset = self.server.tilesets[name] = tileset.current()
+            return tileset
+
+    def cacheHeaders(self, etag):
+        if etag:
+            self.send_header('ETag', etag)
+        self.send_header('Cache-Control', 'public, max-age=' + str(self.server.maxAge))
+        self.send_header('Access-Control-Allow-Origin', '*')
+
+    # Answer with a 304 when the client already has the current version
+    def notModified(self, etag):
+        tags = [t.strip() for t in self.headers.get('If-None-Match', '').split(',')]
+        # If-None-Match uses the weak comparison, varnish marks ETags weak when it gzips
+        if '*' not in tags and etag not in tags and 'W/' + etag not in tags:
+            return False
+        self.send_response(304)
+        self.cacheHeaders(etag)
+        self.end_headers()
+        return True
+
+    def send(self, data, contentType, etag, body):
+        self.send_response(200)
+        self.send_header('Content-Type', contentType)
+        self.send_header('Content-Length', str(len(data)))
+        self.cacheHeaders(etag)
+        self.end_headers()
+        if body:
+            self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+def main(args):
+    thresholds = args.thresholds or lodThresholds(args.lods, args.spacing, args.base)
+    order = args.order.upper()
+    tolerances = lodTolerances(args.simplify, len(thresholds), args.simplify_factor) if args.simplify else None
+    tilesets = {}
+    runs = []
+
+    for path in args.files:
+        name = os.path.splitext(os.path.basename(path))[0]
+        metrics = instrument.Metrics(path, args.time, args.verbose, args.tracemalloc)
+        index = loadOrderIndex(path, order, args.index_dir, metrics)
+
+        metrics.start('Planning')
+        tileset = Tileset(path, index, thresholds, order, tolerances, args.subtree_levels, args.index_dir)
+        metrics.stop(index['count'])
+        if tileset.bounds is None:
+            print (path + ': no features with a ' + order + ' order')
+            continue
+
+        tilesets[name] = tileset
+        metrics.count(features=tileset.count)
+        runs.append(metrics.report())
+        print ('Serving ' + str(tileset.count) + ' features of ' + path + ' at /' + name + '/tileset.json')
+
+    if args.metrics:
+        instrument.writeReport(args.metrics, 'tile_server', runs)
+
+    server = ThreadingHTTPServer((args.host, args.port), TileHandler)
+    server.tilesets = tilesets
+    server.reloading = threading.Lock()
+    server.cache = TileCache(args.cache_size * 1024 * 1024)
+    server.maxAge = args.max_age
+    server.verbose = args.verbose
+    print ('Listening on http://' + args.host + ':' + str(args.port) + '/')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if (args.verbose):
+            print ('Tile cache: ' + str(server.cache.hits) + ' hits, ' + str(server.cache.misses) + ' misses, ' + str(server.cache.coalesced) + ' coalesced, ' +
+                   str(len(server.cache)) + ' tiles, ' + instrument.formatBytes(server.cache.size))
+
+if __name__ == "__main__":
+    # parse arguments
+    parser = argparse.ArgumentParser(description='Serve the quadtree of vector tiles of create_tileset.py, encoding the tiles on request.')
+    parser.add_argument('-v','--verbose', help="increase output verbosity and log every request", action='store_true')
+    parser.add_argument('-t','--time', help="calculate and display time taken", action='store_true')
+    parser.add_argument('--host', default='127.0.0.1', help='the address to listen on')
+    parser.add_argument('-p','--port', type=int, default=3001, help='the port to listen on, 3001 is the backend of varnish/default.vcl')
+    parser.add_argument('--cache-size', type=int, default=256, help='the size of the tile cache in megabytes')
+    parser.add_argument('--max-age', type=int, default=86400, help='the max-age of the Cache-Control header in seconds')
+    parser.add_argument('--subtree-levels', type=int, default=SUBTREE_LEVELS, help='the number of quadtree levels described by every tileset.json, the levels below are in linked tilesets worked out on request')
+    parser.add_argument('--index-dir', help='the directory the indexes are kept in, next to the source files by default')
+    parser.add_argument('-l','--lods', type=int, default=11, help='the number of LODs, which is the depth of the quadtree')
+    parser.add_argument('--order', choices=['shreve', 'strahler'], default='shreve', help='the stream order the LODs are selected by')
+    parser.add_argument('--spacing', choices=['log', 'linear'], default='log', help='how the order thresholds of the LODs are spaced')
+    parser.add_argument('--base', type=float, default=2, help='the ratio between the thresholds of consecutive LODs with log spacing')
+    parser.add_argument('--thresholds', type=parseThresholds, help='comma separated order thresholds, from the coarsest to the most detailed LOD, instead of --lods and --spacing')
+    parser.add_argument('--simplify', type=float, default=0, help='simplify the deepest level with this tolerance in degrees (Douglas-Peucker)')
+    parser.add_argument('--simplify-factor', type=float, default=2, help='the factor the simplification tolerance grows by for every level up')
+    parser.add_argument('files', nargs='+', help='One or more geojson files')
+    instrument.addArguments(parser)
+    args = parser.parse_args()
+
+    instrument.runProfiled(args.profile, main, args)
@@ -1,6 +1,8 @@
 # This script downloads lists of region map codes from our WFS region mapping server, and transforms them into a minimal
 # JSON file. This is faster to serve, smaller to transfer, and faster to parse.
 # It should be run whenever boundary layers are added or changed.
+# bin/generate_region_ids.py does the same from the lists in regionMapping.json, fetching them in parallel.
+# bin/publish_assets.py writes precompressed and content hashed copies of the lists for serving.
 
 # This JQ filter can be used to automatically update regionMapping.json to follow the naming convention defined here:
 # .regionWmsMap |= (map_values(.regionIdList = @uri "data/regionids/\( .layerName)_\(.regionProp).json"))
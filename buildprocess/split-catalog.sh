@@ -1,3 +1,4 @@
+# bin/split_catalog.py does this in a single pass, without prompting, and can merge the files back.
 SOURCE=wwwroot/init/nm.json
 OUTDIR=datasources
 
@@ -1,3 +1,4 @@
+# bin/split_catalog.py does this in a single pass, without prompting, and can merge the files back.
 SOURCE=datasources/00_National_Data_Sets.json
 OUTDIR=datasources/00_National_Data_Sets
 
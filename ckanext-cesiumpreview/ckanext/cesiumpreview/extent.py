@@ -0,0 +1,180 @@
+'''Streaming computation of the extent and feature count of GeoJSON resources.
+
+The extent is computed once on the server, when a resource is created or
+updated, so the viewer doesn't have to download the whole resource to zoom to
+it. The file is read in chunks and the features of a FeatureCollection are
+decoded one at a time, so only a bounded part of it is ever in memory.
+'''
+import json
+import codecs
+
+CHUNK_SIZE = 1 << 16
+
+WHITESPACE = u' \t\r\n\x1e'
+
+decoder = json.JSONDecoder()
+
+
+class Extent(object):
+    '''Accumulates the bounding box and the number of features of GeoJSON objects.'''
+
+    def __init__(self):
+        self.west = self.south = float('inf')
+        self.east = self.north = float('-inf')
+        self.count = 0
+
+    def add_positions(self, coordinates):
+        # Walk down the nested arrays until the positions, which are arrays of numbers
+        stack = [coordinates]
+        while stack:
+            item = stack.pop()
+            if not item:
+                continue
+            if isinstance(item[0], (list, tuple)):
+                stack.extend(item)
+            elif len(item) >= 2:
+                x, y = item[0], item[1]
+                if x < self.west:
+                    self.west = x
+                if x > self.east:
+                    self.east = x
+                if y < self.south:
+                    self.south = y
+                if y > self.north:
+                    self.north = y
+
+    def add_geometry(self, geometry):
+        if not geometry:
+            return
+        if geometry.get('type') == 'GeometryCollection':
+            for g in geometry.get('geometries') or []:
+                self.add_geometry(g)
+        else:
+            self.add_positions(geometry.get('coordinates'))
+
+    def add(self, value):
+        # A Feature, a bare geometry or a FeatureCollection with its features already removed
+        if not isinstance(value, dict):
+            return
+        if value.get('type') == 'Feature':
+            self.count += 1
+            self.add_geometry(value.get('geometry'))
+        elif value.get('type') == 'FeatureCollection':
+            for feature in value.get('features') or []:
+                self.add(feature)
+        else:
+            self.add_geometry(value)
+
+    def bbox(self):
+        '''The [west, south, east, north] of everything added, or None.'''
+        if self.west > self.east:
+            return None
+        return [self.west, self.south, self.east, self.north]
+
+
+class TextStream(object):
+    '''A window on a file that is decoded and refilled in chunks while it is scanned.'''
+
+    def __init__(self, f, chunk_size=CHUNK_SIZE):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.decoder = codecs.getincrementaldecoder('utf-8')('replace')
+        self.text = u''
+        self.pos = 0
+        self.eof = False
+
+    def fill(self, size=None):
+        if self.eof:
+            return False
+        chunk = self.f.read(size or self.chunk_size)
+        if not chunk:
+            self.eof = True
+            self.text += self.decoder.decode(b'', True)
+            return False
+        # Drop what has been scanned already
+        self.text = self.text[self.pos:] + self.decoder.decode(chunk)
+        self.pos = 0
+        return True
+
+    def peek(self, skip=WHITESPACE):
+        while True:
+            while self.pos < len(self.text) and self.text[self.pos] in skip:
+                self.pos += 1
+            if self.pos < len(self.text):
+                return self.text[self.pos]
+            if not self.fill():
+                return u''
+
+    def expect(self, token):
+        if self.peek() != token:
+            raise ValueError('expected %r in the GeoJSON' % token)
+        self.pos += 1
+
+    def value(self):
+        # Decode the JSON value at the current position, reading more until it is complete
+        self.peek()
+        size = self.chunk_size
+        while True:
+            try:
+                value, end = decoder.raw_decode(self.text, self.pos)
+                # A number at the end of the window might continue in the next chunk
+                if end < len(self.text) or self.eof:
+                    self.pos = end
+                    return value
+            except ValueError:
+                pass
+            if not self.fill(size):
+                value, end = decoder.raw_decode(self.text, self.pos)
+                self.pos = end
+                return value
+            # Grow the reads, so very large values don't take quadratic time
+            size *= 2
+
+
+def read_objects(f, chunk_size=CHUNK_SIZE):
+    '''Yield the GeoJSON objects in a file: the features of collections one by one,
+    other top level objects (features, geometries, newline delimited features) whole.'''
+    stream = TextStream(f, chunk_size)
+    while True:
+        c = stream.peek()
+        if not c:
+            return
+        if c != u'{':
+            raise ValueError('expected a GeoJSON object')
+
+        stream.expect(u'{')
+        members = {}
+        while True:
+            c = stream.peek(WHITESPACE + u',')
+            if c == u'}':
+                stream.pos += 1
+                break
+            if not c:
+                raise ValueError('unterminated GeoJSON object')
+
+            key = stream.value()
+            stream.expect(u':')
+            if key == 'features':
+                stream.expect(u'[')
+                while True:
+                    c = stream.peek(WHITESPACE + u',')
+                    if c == u']':
+                        stream.pos += 1
+                        break
+                    if not c:
+                        raise ValueError('unterminated features array')
+                    yield stream.value()
+            else:
+                members[key] = stream.value()
+
+        if members.get('type') != 'FeatureCollection':
+            yield members
+
+
+def geojson_extent(f, chunk_size=CHUNK_SIZE):
+    '''Returns the [west, south, east, north] bounding box (or None) and the
+    number of features of the GeoJSON in the binary file f.'''
+    extent = Extent()
+    for value in read_objects(f, chunk_size):
+        extent.add(value)
+    return extent.bbox(), extent.count
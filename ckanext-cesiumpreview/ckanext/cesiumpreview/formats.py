@@ -0,0 +1,177 @@
+'''Resolution of resource formats to Cesium view qualities.
+
+CKAN asks every view plugin whether it can show a resource, for every resource
+on every dataset page. The formats are looked up in a dict built once from the
+configuration, and the answers are kept in a small LRU cache keyed on the
+format and the URL suffix of the resource.
+'''
+import re
+import threading
+from collections import OrderedDict
+
+# The formats National Map can show, with the quality of the view
+DEFAULT_FORMATS = OrderedDict([
+    ('wms', 2), ('wfs', 2), ('kml', 2), ('kmz', 2),
+    ('gjson', 2), ('geojson', 2), ('czml', 2),
+])
+
+# MIME types (and other aliases) that name one of the formats
+DEFAULT_ALIASES = {
+    'application/vnd.google-earth.kml+xml': 'kml',
+    'application/vnd.google-earth.kmz': 'kmz',
+    'application/geo+json': 'geojson',
+    'application/vnd.geo+json': 'geojson',
+    'application/vnd.ogc.wms_xml': 'wms',
+    'ogc:wms': 'wms',
+    'ogc:wfs': 'wfs',
+}
+
+DEFAULT_CACHE_SIZE = 1024
+
+SEPARATORS = re.compile(r'[\s,]+')
+
+
+def normalize(value):
+    '''Lower case a format, MIME type or extension and strip MIME parameters.'''
+    if not value:
+        return ''
+    return value.split(';', 1)[0].strip().lstrip('.').lower()
+
+
+def url_suffix(url):
+    '''The lower cased file name at the end of a URL, without query or fragment.'''
+    if not url:
+        return ''
+    path = url.split('#', 1)[0].split('?', 1)[0]
+    return path.rstrip('/').rsplit('/', 1)[-1].lower()
+
+
+def parse_formats(text):
+    '''Parse "wms kml:2 3dtiles:3" into an OrderedDict of format to quality.'''
+    formats = OrderedDict()
+    for item in SEPARATORS.split(text or ''):
+        if not item:
+            continue
+        name, _, quality = item.partition(':')
+        formats[normalize(name)] = int(quality) if quality else 2
+    return formats
+
+
+def parse_aliases(text):
+    '''Parse "application/x-vctr=vctr tileset.json=3dtiles" into a dict.'''
+    aliases = {}
+    for item in SEPARATORS.split(text or ''):
+        if not item:
+            continue
+        alias, _, name = item.partition('=')
+        if not name:
+            raise ValueError('format aliases look like alias=format, not %r' % item)
+        aliases[normalize(alias)] = normalize(name)
+    return aliases
+
+
+class LRUCache(object):
+    '''A thread safe least recently used cache on an OrderedDict.'''
+
+    def __init__(self, size=DEFAULT_CACHE_SIZE):
+        self.size = size
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                value = self.items.pop(key)
+            except KeyError:
+                return default
+            # Reinserting marks the key as the most recently used
+            self.items[key] = value
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.items.pop(key, None)
+            self.items[key] = value
+            while len(self.items) > self.size:
+                self.items.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+
+    def __len__(self):
+        return len(self.items)
+
+
+# Cached as the answer for resources that can't be viewed
+UNSUPPORTED = (None, None)
+
+
+class FormatRegistry(object):
+    '''Maps formats, MIME types and URL suffixes to a format name and view quality.'''
+
+    def __init__(self, formats=None, aliases=None, cache_size=DEFAULT_CACHE_SIZE):
+        if formats is None:
+            formats = DEFAULT_FORMATS
+        if aliases is None:
+            aliases = DEFAULT_ALIASES
+
+        lookup = {}
+        for name, quality in formats.items():
+            lookup[normalize(name)] = (normalize(name), quality)
+        for alias, name in aliases.items():
+            if normalize(name) in lookup:
+                lookup[normalize(alias)] = lookup[normalize(name)]
+
+        self.lookup = lookup
+        self.names = frozenset(name for name, quality in lookup.values())
+        self.cache = LRUCache(cache_size)
+
+    @classmethod
+    def from_config(cls, config):
+        '''Build the registry from the ckanext.cesiumpreview.* options.
+
+        ckanext.cesiumpreview.formats replaces the default formats and
+        ckanext.cesiumpreview.extra_formats adds to them, both as a list of
+        format[:quality]. ckanext.cesiumpreview.format_aliases adds aliases
+        as alias=format, where an alias is a MIME type, extension or file name.
+        '''
+        formats = OrderedDict(DEFAULT_FORMATS)
+        if config.get('ckanext.cesiumpreview.formats'):
+            formats = parse_formats(config.get('ckanext.cesiumpreview.formats'))
+        formats.update(parse_formats(config.get('ckanext.cesiumpreview.extra_formats')))
+
+        aliases = dict(DEFAULT_ALIASES)
+        aliases.update(parse_aliases(config.get('ckanext.cesiumpreview.format_aliases')))
+
+        cache_size = int(config.get('ckanext.cesiumpreview.format_cache_size', DEFAULT_CACHE_SIZE))
+        return cls(formats, aliases, cache_size)
+
+    def resolve(self, resource_format, url=None):
+        '''Returns the (name, quality) of a resource, or (None, None).
+
+        The format of the resource is used when it has one, otherwise the file
+        name at the end of its URL and then the extension of that file name.
+        '''
+        resource_format = normalize(resource_format)
+        suffix = '' if resource_format else url_suffix(url)
+        key = (resource_format, suffix)
+
+        result = self.cache.get(key)
+        if result is None:
+            result = self._resolve(resource_format, suffix)
+            self.cache.put(key, result)
+        return result
+
+    def _resolve(self, resource_format, suffix):
+        if resource_format:
+            return self.lookup.get(resource_format, UNSUPPORTED)
+        if suffix in self.lookup:
+            return self.lookup[suffix]
+        if '.' in suffix:
+            return self.lookup.get(suffix.rsplit('.', 1)[1], UNSUPPORTED)
+        return UNSUPPORTED
+
+    def quality(self, resource_format, url=None):
+        '''The view quality of a resource, or None when it can't be viewed.'''
+        return self.resolve(resource_format, url)[1]
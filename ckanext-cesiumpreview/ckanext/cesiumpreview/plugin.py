@@ -4,25 +4,138 @@ import ckan.plugins as p
 
 from ckan.common import json
 
+from ckanext.cesiumpreview.formats import FormatRegistry, DEFAULT_FORMATS
+from ckanext.cesiumpreview.extent import geojson_extent
+from ckanext.cesiumpreview.proxy_urls import ProxyUrlMap, script_json
+
 log = logging.getLogger(__name__)
 
 try:
-    import os
     import ckanext.resourceproxy.plugin as proxy
 except ImportError:
-    pass
+    proxy = None
+
+try:
+    from urllib2 import urlopen
+except ImportError:
+    from urllib.request import urlopen
+
+# The formats whose extent is computed on the server
+EXTENT_FORMATS = frozenset(['geojson', 'gjson'])
+
+# Set in the context of the update that stores an extent, so it doesn't trigger another one
+EXTENT_CONTEXT_KEY = 'cesiumpreview_extent'
+
+DEFAULT_EXTENT_MAX_SIZE = 200 * 1024 * 1024
+
+# Without background jobs the extent is computed during the request that saves the resource,
+# only for resources up to this size
+DEFAULT_SYNC_EXTENT_MAX_SIZE = 10 * 1024 * 1024
+
+
+class LimitedReader(object):
+    '''Reads a file, raising a ValueError once more than limit bytes were read.'''
+
+    def __init__(self, f, limit):
+        self.f = f
+        self.limit = limit
+        self.size = 0
+
+    def read(self, size=-1):
+        data = self.f.read(size)
+        self.size += len(data)
+        if self.size > self.limit:
+            raise ValueError('the resource is larger than %d bytes' % self.limit)
+        return data
+
+    def close(self):
+        self.f.close()
+
+
+def open_resource(resource, max_size):
+    if resource.get('url_type') == 'upload':
+        from ckan.lib import uploader
+        if hasattr(uploader, 'get_resource_uploader'):
+            upload = uploader.get_resource_uploader(resource)
+        else:
+            upload = uploader.ResourceUpload(resource)
+        return LimitedReader(open(upload.get_path(resource['id']), 'rb'), max_size)
+    return LimitedReader(urlopen(resource['url'], timeout=30), max_size)
+
+
+def resource_proxy_url(resource):
+    # CKAN's resource proxy route takes the dataset id as well as its name
+    return proxy.get_proxified_resource_url({'resource': resource, 'package': {'name': resource['package_id']}})
+
+
+def extent_source(resource):
+    # The extent is recomputed when any of these change
+    return '%s|%s|%s' % (resource.get('url'), resource.get('last_modified'), resource.get('size'))
+
+
+def parse_extent(value):
+    '''The [west, south, east, north] stored in a resource, or None when it isn't valid.'''
+    try:
+        extent = json.loads(value)
+        extent = [float(v) for v in extent] if isinstance(extent, list) else []
+    except (TypeError, ValueError):
+        return None
+    # Extras can be edited by users, only pass on plain finite numbers to the page
+    if len(extent) != 4 or not all(abs(v) < float('inf') for v in extent):
+        return None
+    return extent
+
+
+def parse_count(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def update_extent(resource_id, max_size=DEFAULT_EXTENT_MAX_SIZE):
+    '''Compute the extent and feature count of a GeoJSON resource and store them
+    in its extras. Runs as a background job where CKAN has those.'''
+    site_user = p.toolkit.get_action('get_site_user')({'ignore_auth': True}, {})
+    context = {'ignore_auth': True, 'user': site_user['name'], EXTENT_CONTEXT_KEY: True}
+    resource = p.toolkit.get_action('resource_show')(context, {'id': resource_id})
+
+    try:
+        f = open_resource(resource, max_size)
+        try:
+            extent, count = geojson_extent(f)
+        finally:
+            f.close()
+    except (IOError, ValueError, TypeError) as e:
+        log.warning('Could not compute the extent of resource %s: %s', resource_id, e)
+        return
+    except Exception:
+        log.exception('Could not compute the extent of resource %s', resource_id)
+        return
+
+    resource['cesium_extent'] = json.dumps(extent) if extent else ''
+    resource['cesium_feature_count'] = count
+    resource['cesium_extent_source'] = extent_source(resource)
+    p.toolkit.get_action('resource_update')(context, resource)
+
 
 class CesiumPreview(p.SingletonPlugin):
     '''This extension adds Cesium. '''
     p.implements(p.IConfigurer, inherit=True)
     p.implements(p.IConfigurable, inherit=True)
+    p.implements(p.IResourceController, inherit=True)
     if p.toolkit.check_ckan_version('2.3'):
         p.implements(p.IResourceView, inherit=True)
     else:
-    	p.implements(p.IResourcePreview, inherit=True)
+        p.implements(p.IResourcePreview, inherit=True)
 
-    Cesium_Formats = ['wms','wfs','kml', 'kmz','gjson', 'geojson', 'czml']
+    Cesium_Formats = list(DEFAULT_FORMATS)
     proxy_is_enabled = False
+    formats = FormatRegistry()
+    proxy_urls = ProxyUrlMap()
+    extent_is_enabled = True
+    extent_max_size = DEFAULT_EXTENT_MAX_SIZE
+    sync_extent_max_size = DEFAULT_SYNC_EXTENT_MAX_SIZE
 
     def update_config(self, config):
         p.toolkit.add_public_directory(config, 'theme/public')
@@ -33,38 +146,77 @@ class CesiumPreview(p.SingletonPlugin):
         enabled = config.get('ckan.resource_proxy_enabled', False)
         self.proxy_is_enabled = enabled
 
+        # Off-domain resources go through the cached National Map /proxy, or else CKAN's resource proxy
+        fallback = resource_proxy_url if proxy and p.toolkit.asbool(enabled) else None
+        self.proxy_urls = ProxyUrlMap.from_config(config, fallback)
+        self.proxy_is_enabled = self.proxy_urls.is_enabled
+
+        # The formats can be extended in the config, e.g. with 3D Tiles and vctr tiles
+        self.formats = FormatRegistry.from_config(config)
+        self.Cesium_Formats = sorted(self.formats.names)
+
+        self.extent_is_enabled = p.toolkit.asbool(config.get('ckanext.cesiumpreview.extent', True))
+        self.extent_max_size = int(config.get('ckanext.cesiumpreview.extent_max_size', DEFAULT_EXTENT_MAX_SIZE))
+        self.sync_extent_max_size = int(config.get('ckanext.cesiumpreview.sync_extent_max_size', DEFAULT_SYNC_EXTENT_MAX_SIZE))
+
+    def after_create(self, context, resource):
+        self.queue_extent(context, resource)
+
+    def after_update(self, context, resource):
+        self.queue_extent(context, resource)
+
+    def queue_extent(self, context, resource):
+        # Compute the extent of GeoJSON resources once, instead of in every browser that views them
+        if not self.extent_is_enabled or context.get(EXTENT_CONTEXT_KEY):
+            return
+        if self.formats.resolve(resource.get('format'), resource.get('url'))[0] not in EXTENT_FORMATS:
+            return
+        if resource.get('cesium_extent_source') == extent_source(resource):
+            return
+
+        if hasattr(p.toolkit, 'enqueue_job'):
+            p.toolkit.enqueue_job(update_extent, [resource['id'], self.extent_max_size],
+                                  title='Cesium extent of resource ' + resource['id'])
+            return
+
+        # Without background jobs the resource is read while the user waits for the save, so
+        # only small resources are, and a failure must not fail the save
+        max_size = min(self.extent_max_size, self.sync_extent_max_size)
+        size = parse_count(resource.get('size'))
+        if size is not None and size > max_size:
+            log.info('Skipping the extent of resource %s, %d bytes is too large without background jobs', resource['id'], size)
+            return
+        try:
+            update_extent(resource['id'], max_size)
+        except Exception:
+            log.exception('Could not store the extent of resource %s', resource['id'])
+
     def can_preview(self, data_dict):
         resource = data_dict['resource']
-        format_lower = resource['format'].lower()
-        if (format_lower == ''):
-            format_lower = os.path.splitext(resource['url'])[1][1:].lower()
-#        print format_lower
-        if format_lower in self.Cesium_Formats:
+        quality = self.formats.quality(resource.get('format'), resource.get('url'))
+        if quality is not None:
             if resource.get('on_same_domain') or self.proxy_is_enabled:
-                return {'can_preview': True, 'quality': 2}
+                return {'can_preview': True, 'quality': quality}
             else:
                 return {'can_preview': True,
                         'fixable': 'Enable resource_proxy',
-                        'quality': 2}
+                        'quality': quality}
         return {'can_preview': False}
 
     def info(self): return {'name': 'cesium_view', 'title': 'National Map Beta', 'always_available': True, 'default_title': 'National Map Beta', 'icon': 'globe' }
 
     def can_view(self, data_dict):
         resource = data_dict['resource']
-        format_lower = resource['format'].lower()
-        if (format_lower == ''):
-            format_lower = os.path.splitext(resource['url'])[1][1:].lower()
-#        print format_lower
-        if format_lower in self.Cesium_Formats:
-	    return True
-        return False
-
-#    def setup_template_variables(self, context, data_dict):
-#        if (self.proxy_is_enabled
-#                and not data_dict['resource']['on_same_domain']):
-#            url = proxy.get_proxified_resource_url(data_dict)
-#            p.toolkit.c.resource['url'] = url
+        return self.formats.quality(resource.get('format'), resource.get('url')) is not None
+
+    def setup_template_variables(self, context, data_dict):
+        resource = data_dict['resource']
+        return {
+            # These end up in a <script> block of cesium.html, and editors control the URL
+            'resource_url': script_json(self.proxy_urls.url(resource)),
+            'resource_extent': script_json(parse_extent(resource.get('cesium_extent'))),
+            'resource_feature_count': script_json(parse_count(resource.get('cesium_feature_count'))),
+        }
 
     def preview_template(self, context, data_dict):
         return 'cesium.html'
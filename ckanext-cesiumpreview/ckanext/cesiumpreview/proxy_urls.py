@@ -0,0 +1,108 @@
+'''Rewriting of off-domain resource URLs to go through a caching proxy.
+
+Browsers can't read most WMS, WFS and KML servers directly, and going to them
+directly bypasses the Varnish cache in front of the National Map /proxy route.
+Off-domain resources are rewritten to that route (or CKAN's own resource
+proxy), and the rewritten URLs are kept in a small LRU cache, since the same
+resources are viewed over and over.
+'''
+import json
+
+try:
+    from urlparse import urlsplit
+except ImportError:
+    from urllib.parse import urlsplit
+
+from ckanext.cesiumpreview.formats import LRUCache, DEFAULT_CACHE_SIZE
+
+# Characters that end or confuse an inline <script> block, and the line
+# separators that older JavaScript engines don't allow in string literals
+SCRIPT_ESCAPES = {
+    '<': '\\u003c',
+    '>': '\\u003e',
+    '&': '\\u0026',
+    u'\u2028': '\\u2028',
+    u'\u2029': '\\u2029',
+}
+
+
+def script_json(value):
+    '''value as JSON that is safe to put inside a <script> element.
+
+    json.dumps leaves </script> alone, so a resource URL containing it would
+    end the script block and run whatever follows as HTML.
+    '''
+    text = json.dumps(value)
+    for character, escape in SCRIPT_ESCAPES.items():
+        text = text.replace(character, escape)
+    return text
+
+
+def host(url):
+    '''The lower cased host (and port) of a URL, '' for relative URLs.'''
+    if not url:
+        return ''
+    if url.startswith('//'):
+        url = 'http:' + url
+    return urlsplit(url).netloc.lower()
+
+
+class ProxyUrlMap(object):
+    '''Maps resource URLs to the URL the viewer should load them from.
+
+    proxy_url is the prefix of a Terria style proxy, that takes the URL to
+    fetch as its path, e.g. http://nationalmap.nicta.com.au/proxy/. max_age
+    (e.g. 1d) asks that proxy to cache the response for that long. When there
+    is no proxy_url, fallback (a function of the resource) is used instead,
+    e.g. CKAN's resource proxy.
+    '''
+
+    def __init__(self, site_url=None, proxy_url=None, max_age=None, fallback=None,
+                 cache_size=DEFAULT_CACHE_SIZE):
+        self.site_host = host(site_url)
+        self.prefix = None
+        if proxy_url:
+            self.prefix = proxy_url.rstrip('/') + '/'
+            if max_age:
+                self.prefix += '_' + max_age.strip('_/') + '/'
+        self.fallback = fallback
+        self.cache = LRUCache(cache_size)
+
+    @classmethod
+    def from_config(cls, config, fallback=None):
+        '''Build the map from ckan.site_url and the ckanext.cesiumpreview.proxy_* options.'''
+        return cls(config.get('ckan.site_url'),
+                   config.get('ckanext.cesiumpreview.proxy_url'),
+                   config.get('ckanext.cesiumpreview.proxy_max_age'),
+                   fallback,
+                   int(config.get('ckanext.cesiumpreview.proxy_cache_size', DEFAULT_CACHE_SIZE)))
+
+    @property
+    def is_enabled(self):
+        return bool(self.prefix or self.fallback)
+
+    def on_same_domain(self, resource):
+        if resource.get('on_same_domain') is not None:
+            return bool(resource['on_same_domain'])
+        resource_host = host(resource.get('url'))
+        return not resource_host or resource_host == self.site_host
+
+    def url(self, resource):
+        '''The URL to load a resource from: its own on the same domain, otherwise proxied.'''
+        url = resource.get('url')
+        if not url or not self.is_enabled or self.on_same_domain(resource):
+            return url
+
+        key = (resource.get('id'), url)
+        proxied = self.cache.get(key)
+        if proxied is None:
+            proxied = self._proxify(resource, url)
+            self.cache.put(key, proxied)
+        return proxied
+
+    def _proxify(self, resource, url):
+        if self.prefix:
+            if url.startswith('//'):
+                url = 'http:' + url
+            return self.prefix + url
+        return self.fallback(resource)
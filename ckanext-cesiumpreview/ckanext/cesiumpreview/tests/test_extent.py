@@ -0,0 +1,70 @@
+import io
+import json
+
+from ckanext.cesiumpreview.extent import geojson_extent, read_objects
+
+
+def extent_of(value, chunk_size=7):
+    if not isinstance(value, str):
+        value = json.dumps(value)
+    return geojson_extent(io.BytesIO(value.encode('utf-8')), chunk_size)
+
+
+def feature(geometry, **properties):
+    return {'type': 'Feature', 'properties': properties, 'geometry': geometry}
+
+
+class TestGeojsonExtent(object):
+
+    def test_feature_collection(self):
+        collection = {'type': 'FeatureCollection', 'features': [
+            feature({'type': 'Point', 'coordinates': [150.5, -33.25]}),
+            feature({'type': 'LineString', 'coordinates': [[140, -30], [145.125, -20.5]]}, name='river'),
+            feature({'type': 'MultiPolygon', 'coordinates': [[[[141, -40], [142, -41], [141, -40]]]]}),
+            feature(None),
+        ]}
+        assert extent_of(collection) == ([140, -41, 150.5, -20.5], 4)
+
+    def test_chunk_sizes_agree(self):
+        collection = {'type': 'FeatureCollection', 'features': [
+            feature({'type': 'LineString', 'coordinates': [[i * 0.001, -i * 0.002] for i in range(50)]})
+            for _ in range(20)
+        ]}
+        expected = extent_of(collection, 1 << 16)
+        for chunk_size in (1, 3, 64):
+            assert extent_of(collection, chunk_size) == expected
+
+    def test_members_after_features(self):
+        text = '{"features": [{"type": "Feature", "geometry": {"type": "Point", "coordinates": [1, 2]}}],' \
+               ' "type": "FeatureCollection", "crs": {"type": "name"}}'
+        assert extent_of(text) == ([1, 2, 1, 2], 1)
+
+    def test_geometry_collection(self):
+        geometry = {'type': 'GeometryCollection', 'geometries': [
+            {'type': 'Point', 'coordinates': [-10, 5, 100]},
+            {'type': 'Point', 'coordinates': [10, -5]},
+        ]}
+        assert extent_of(geometry) == ([-10, -5, 10, 5], 0)
+
+    def test_newline_delimited_features(self):
+        lines = '\n'.join(json.dumps(feature({'type': 'Point', 'coordinates': [i, i]})) for i in range(3))
+        assert extent_of(lines) == ([0, 0, 2, 2], 3)
+
+    def test_empty(self):
+        assert extent_of({'type': 'FeatureCollection', 'features': []}) == (None, 0)
+        assert extent_of('') == (None, 0)
+
+    def test_invalid(self):
+        for text in ('[1, 2]', '{"type": "FeatureCollection", "features": [', '{"type": '):
+            try:
+                extent_of(text)
+            except ValueError:
+                pass
+            else:
+                assert False, 'invalid GeoJSON should be rejected: %r' % text
+
+    def test_features_are_read_one_at_a_time(self):
+        text = '{"type": "FeatureCollection", "features": [{"type": "Feature"}, {"type": "Feature"}'
+        objects = read_objects(io.BytesIO(text.encode('utf-8')), 4)
+        assert next(objects) == {'type': 'Feature'}
+        assert next(objects) == {'type': 'Feature'}
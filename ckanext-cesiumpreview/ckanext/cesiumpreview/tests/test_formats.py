@@ -0,0 +1,79 @@
+from ckanext.cesiumpreview.formats import FormatRegistry, LRUCache, parse_formats, parse_aliases
+
+
+class TestFormatRegistry(object):
+
+    def test_default_formats(self):
+        registry = FormatRegistry()
+        assert registry.quality('KML') == 2
+        assert registry.quality(' geojson ') == 2
+        assert registry.quality('pdf') is None
+        assert registry.quality('', 'http://example.com/data.pdf') is None
+
+    def test_mime_types(self):
+        registry = FormatRegistry()
+        assert registry.resolve('application/vnd.google-earth.kml+xml') == ('kml', 2)
+        assert registry.resolve('application/geo+json; charset=utf-8') == ('geojson', 2)
+
+    def test_url_fallback(self):
+        registry = FormatRegistry()
+        assert registry.resolve('', 'http://example.com/rivers.GeoJSON?v=2#top') == ('geojson', 2)
+        assert registry.resolve(None, 'http://example.com/a.kmz') == ('kmz', 2)
+        assert registry.resolve('', 'http://example.com/') == (None, None)
+
+    def test_format_wins_over_url(self):
+        registry = FormatRegistry()
+        assert registry.quality('csv', 'http://example.com/data.kml') is None
+
+    def test_results_are_cached(self):
+        registry = FormatRegistry()
+        registry.resolve('', 'http://example.com/one/data.kml')
+        registry.resolve('', 'http://example.com/two/data.kml')
+        registry.resolve('KML', 'http://example.com/ignored.txt')
+        assert len(registry.cache) == 2
+
+    def test_from_config(self):
+        registry = FormatRegistry.from_config({
+            'ckanext.cesiumpreview.extra_formats': '3dtiles:3 vctr',
+            'ckanext.cesiumpreview.format_aliases': 'tileset.json=3dtiles application/x-vctr=vctr',
+        })
+        assert registry.quality('kml') == 2
+        assert registry.resolve('', 'http://example.com/rivers/tileset.json') == ('3dtiles', 3)
+        assert registry.resolve('', 'http://example.com/rivers/lod1.vctr') == ('vctr', 2)
+        assert registry.resolve('application/x-vctr') == ('vctr', 2)
+        assert registry.quality('', 'http://example.com/other.json') is None
+
+    def test_formats_replaced_from_config(self):
+        registry = FormatRegistry.from_config({'ckanext.cesiumpreview.formats': 'wms, wfs'})
+        assert registry.names == frozenset(['wms', 'wfs'])
+        assert registry.quality('kml') is None
+
+
+class TestParsing(object):
+
+    def test_parse_formats(self):
+        assert list(parse_formats('wms KML:3\n czml').items()) == [('wms', 2), ('kml', 3), ('czml', 2)]
+        assert len(parse_formats(None)) == 0
+
+    def test_parse_aliases(self):
+        assert parse_aliases('text/x-czml=CZML') == {'text/x-czml': 'czml'}
+        try:
+            parse_aliases('czml')
+        except ValueError:
+            pass
+        else:
+            assert False, 'an alias without a format should be rejected'
+
+
+class TestLRUCache(object):
+
+    def test_least_recently_used_is_evicted(self):
+        cache = LRUCache(2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        assert cache.get('a') == 1
+        cache.put('c', 3)
+        assert cache.get('b') is None
+        assert cache.get('a') == 1
+        assert cache.get('c') == 3
+        assert len(cache) == 2
@@ -0,0 +1,80 @@
+import json
+
+from ckanext.cesiumpreview.proxy_urls import ProxyUrlMap, host, script_json
+
+
+def resource(url, **extras):
+    extras.update({'id': 'abc', 'package_id': 'rivers', 'url': url})
+    return extras
+
+
+class TestProxyUrlMap(object):
+
+    def test_off_domain_resources_are_proxied(self):
+        urls = ProxyUrlMap('http://data.gov.au', 'http://nationalmap.nicta.com.au/proxy')
+        assert urls.url(resource('http://example.com/wms?service=WMS')) == \
+            'http://nationalmap.nicta.com.au/proxy/http://example.com/wms?service=WMS'
+        assert urls.url(resource('//example.com/a.kml')) == \
+            'http://nationalmap.nicta.com.au/proxy/http://example.com/a.kml'
+
+    def test_same_domain_resources_are_not_proxied(self):
+        urls = ProxyUrlMap('http://data.gov.au/', 'http://nationalmap.nicta.com.au/proxy/')
+        assert urls.url(resource('http://DATA.gov.au/dataset/a.kml')) == 'http://DATA.gov.au/dataset/a.kml'
+        assert urls.url(resource('/dataset/a.kml')) == '/dataset/a.kml'
+        assert urls.url(resource('http://example.com/a.kml', on_same_domain=True)) == 'http://example.com/a.kml'
+
+    def test_max_age(self):
+        urls = ProxyUrlMap('http://data.gov.au', 'http://nationalmap.nicta.com.au/proxy/', '1d')
+        assert urls.url(resource('http://example.com/a.kml')) == \
+            'http://nationalmap.nicta.com.au/proxy/_1d/http://example.com/a.kml'
+
+    def test_fallback(self):
+        calls = []
+
+        def fallback(res):
+            calls.append(res['id'])
+            return 'http://data.gov.au/dataset/rivers/resource/abc/proxy'
+
+        urls = ProxyUrlMap('http://data.gov.au', fallback=fallback)
+        for _ in range(3):
+            assert urls.url(resource('http://example.com/a.kml')) == 'http://data.gov.au/dataset/rivers/resource/abc/proxy'
+        assert calls == ['abc']
+
+    def test_disabled(self):
+        urls = ProxyUrlMap('http://data.gov.au')
+        assert not urls.is_enabled
+        assert urls.url(resource('http://example.com/a.kml')) == 'http://example.com/a.kml'
+
+    def test_from_config(self):
+        urls = ProxyUrlMap.from_config({
+            'ckan.site_url': 'http://data.gov.au',
+            'ckanext.cesiumpreview.proxy_url': 'http://nationalmap.nicta.com.au/proxy/',
+            'ckanext.cesiumpreview.proxy_cache_size': '2',
+        })
+        for name in ('a', 'b', 'c'):
+            urls.url(resource('http://example.com/%s.kml' % name))
+        assert len(urls.cache) == 2
+
+    def test_host(self):
+        assert host('http://Example.com:8080/a') == 'example.com:8080'
+        assert host('//example.com/a') == 'example.com'
+        assert host('/a') == ''
+        assert host(None) == ''
+
+
+class TestScriptJson(object):
+
+    def test_script_cannot_be_closed(self):
+        url = 'http://example.com/x</script><script>alert(1)</script>'
+        text = script_json(ProxyUrlMap('http://data.gov.au').url(resource(url)))
+        assert '<' not in text and '>' not in text
+        assert json.loads(text) == url
+
+    def test_escapes(self):
+        text = script_json(u'a&b<!--\u2028\u2029')
+        assert '&' not in text and u'\u2028' not in text and u'\u2029' not in text
+        assert json.loads(text) == u'a&b<!--\u2028\u2029'
+
+    def test_values(self):
+        assert script_json(None) == 'null'
+        assert script_json([1.5, -2, 3, 4]) == '[1.5, -2, 3, 4]'
@@ -37,8 +37,15 @@ ckan.module('cesiumpreview', function (jQuery, _) {
                 ]
 
             };
-            // load dataset spatial extent as default home camera if available
-            if (spatial != '') {
+            // use the resource extent computed on the server if available, so the resource isn't downloaded to find it
+            if (typeof resource_extent != 'undefined' && resource_extent && resource_extent[0] != resource_extent[2]) {
+                config["initSources"][0]['homeCamera']['west'] = resource_extent[0];
+                config["initSources"][0]['homeCamera']['south'] = resource_extent[1];
+                config["initSources"][0]['homeCamera']['east'] = resource_extent[2];
+                config["initSources"][0]['homeCamera']['north'] = resource_extent[3];
+            }
+            // otherwise load dataset spatial extent as default home camera if available
+            else if (spatial != '') {
                 extent = geojsonExtent(JSON.parse(spatial)); //[WSEN]
                 if (extent[0] != extent[2]) {
                     config["initSources"][0]['homeCamera']['west'] = extent[0];
@@ -48,9 +55,11 @@ ckan.module('cesiumpreview', function (jQuery, _) {
                 }
             }
 
-            config["initSources"][0]['catalog'][0]['items'][0]['url'] = preload_resource['url'];
-                if (preload_resource['url'].indexOf('http') !== 0) {
-                    config["initSources"][0]['catalog'][0]['items'][0]['url'] = "http:" + preload_resource['url'];
+            // use the proxied url of off-domain resources if the server set one up
+            var url = (typeof resource_url != 'undefined' && resource_url) ? resource_url : preload_resource['url'];
+            config["initSources"][0]['catalog'][0]['items'][0]['url'] = url;
+                if (url.indexOf('http') !== 0) {
+                    config["initSources"][0]['catalog'][0]['items'][0]['url'] = "http:" + url;
                 }
             config["initSources"][0]['catalog'][0]['items'][0]['type'] = preload_resource['format'].toLowerCase();
 